@@ -15,4 +15,6 @@
 # along with Quagmire.  If not, see <http://www.gnu.org/licenses/>.
 
 from .diffusion import DiffusionEquation
-from .erosion_deposition import ErosionDepositionEquation
\ No newline at end of file
+from .erosion_deposition import ErosionDepositionEquation
+from .integrators import EmbeddedRungeKutta
+from .landscape_evolution import LandscapeEvolution
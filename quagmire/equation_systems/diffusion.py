@@ -16,10 +16,12 @@
 
 
 from quagmire import function as _fn
+from quagmire.mesh import PixMesh as _PixMesh
 
 
 import numpy as np
 from mpi4py import MPI
+from petsc4py import PETSc
 comm = MPI.COMM_WORLD
 
 # To do ... an interface for (iteratively) dealing with
@@ -59,6 +61,13 @@ class DiffusionEquation(object):
         self._dirichlet_mask = None
         self._non_linear = False
 
+        # assembled operators of the implicit solver (see time_integration_implicit)
+        self._stiffness_matrix = None
+        self._implicit_ksp = None
+        self._free_nodes = None
+        self._implicit_timestep = None
+        self._stiffness_versions = None
+
         if diffusivity_fn is not None:
             self.diffusivity = diffusivity_fn
 
@@ -80,6 +89,7 @@ class DiffusionEquation(object):
     def mesh(self, meshobject):
         self._mesh = meshobject
         self._phi   = meshobject.add_variable(name="phi_{}".format(self.id))
+        self._reset_implicit_operators()
         return
 
     @property
@@ -94,6 +104,7 @@ class DiffusionEquation(object):
     @diffusivity.setter
     def diffusivity(self, fn_object):
         self._diffusivity = fn_object
+        self._reset_implicit_operators()
 
         if _fn.check_dependency(self._diffusivity, self._phi):
             # Set the flag directly, bypassing .setter checks
@@ -109,6 +120,7 @@ class DiffusionEquation(object):
     def neumann_x_mask(self, fn_object):
         _fn.check_object_is_a_q_function_and_raise(fn_object)
         self._neumann_x_mask = fn_object
+        self._reset_implicit_operators()
         return
 
     @property
@@ -119,6 +131,7 @@ class DiffusionEquation(object):
     def neumann_y_mask(self, fn_object):
         _fn.check_object_is_a_q_function_and_raise(fn_object)
         self._neumann_y_mask = fn_object
+        self._reset_implicit_operators()
         return
 
     @property
@@ -129,6 +142,7 @@ class DiffusionEquation(object):
     def dirichlet_mask(self, fn_object):
         _fn.check_object_is_a_q_function_and_raise(fn_object)
         self._dirichlet_mask = fn_object
+        self._reset_implicit_operators()
         return
 
     @property
@@ -190,6 +204,386 @@ class DiffusionEquation(object):
 
 
 
+    def _reset_implicit_operators(self):
+        """ Discard the assembled operators (after the mesh or the coefficients change) """
+
+        for name in ["_stiffness_matrix", "_implicit_ksp", "_free_nodes"]:
+            if getattr(self, name, None) is not None:
+                getattr(self, name).destroy()
+            setattr(self, name, None)
+
+        self._implicit_timestep = None
+        self._stiffness_versions = None
+
+        return
+
+
+    def _operator_versions(self):
+        """
+        Versions of the variables and parameters that the diffusivity and the masks
+        depend on (None if any of them cannot be tracked)
+        """
+
+        versions = []
+        for lazyFn in [self._diffusivity, self._neumann_x_mask, self._neumann_y_mask, self._dirichlet_mask]:
+            if lazyFn is None:
+                versions.append(None)
+                continue
+
+            dependencies = lazyFn.dependency_versions()
+            if dependencies is None:
+                return None
+            versions.append(dependencies)
+
+        return tuple(versions)
+
+
+    def _update_stiffness_matrix(self):
+        """
+        Assemble the stiffness matrix unless it was assembled from the current values
+        of the diffusivity and the masks. The implicit operators are discarded with it.
+        """
+
+        versions = self._operator_versions()
+
+        if self._stiffness_matrix is None or self._non_linear or versions is None \
+           or versions != self._stiffness_versions:
+            self._reset_implicit_operators()
+            self._stiffness_matrix = self._assemble_stiffness_matrix()
+            self._stiffness_versions = versions
+
+        return
+
+
+    def _mask_values(self, mask_fn):
+        """ Nodal values of a mask (all ones if it is not set) """
+
+        if mask_fn is None:
+            return np.ones(self._mesh.npoints)
+        else:
+            return np.ones(self._mesh.npoints) * mask_fn.evaluate(self._mesh)
+
+
+    def _stiffness_entries(self):
+        """
+        Rows, columns and values (local node numbers) of the stiffness matrix K of
+        the diffusion operator, so that div(D grad phi) = - K phi / area with
+        D = diag(kappa * neumann_x_mask, kappa * neumann_y_mask). K comes from linear
+        elements on the triangulation (in the plane of each triangle on the sphere)
+        or the 5 point stencil of a PixMesh. Only the rows of owned nodes are
+        returned so that each entry is set by exactly one process.
+        """
+
+        mesh = self._mesh
+
+        kappa = np.ones(mesh.npoints) * self._diffusivity.evaluate(mesh)
+        kappa_x = kappa * self._mask_values(self._neumann_x_mask)
+        kappa_y = kappa * self._mask_values(self._neumann_y_mask)
+
+        if isinstance(mesh, _PixMesh):
+            nodes = np.arange(0, mesh.npoints).reshape(mesh.ny, mesh.nx)
+
+            edges = [(nodes[:,:-1], nodes[:,1:], kappa_x, mesh.dy/mesh.dx),
+                     (nodes[:-1,:], nodes[1:,:], kappa_y, mesh.dx/mesh.dy)]
+
+            rows, cols, values = [], [], []
+            for a, b, k, ratio in edges:
+                a, b = a.ravel(), b.ravel()
+                conductance = 0.5 * (k[a] + k[b]) * ratio
+                rows.extend([a, b, a, b])
+                cols.extend([a, b, b, a])
+                values.extend([conductance, conductance, -conductance, -conductance])
+
+            rows, cols, values = np.hstack(rows), np.hstack(cols), np.hstack(values)
+
+        else:
+            simplices = mesh.tri.simplices
+            points = mesh.data[simplices]
+
+            if points.shape[-1] == 3:
+                # local east / north coordinates at the centroid of each triangle
+                centroid = points.mean(axis=1)
+                lon = np.arctan2(centroid[:,1], centroid[:,0])
+                lat = np.arcsin(centroid[:,2] / np.linalg.norm(centroid, axis=1))
+
+                east = np.column_stack((-np.sin(lon), np.cos(lon), np.zeros_like(lon)))
+                north = np.column_stack((-np.sin(lat)*np.cos(lon), -np.sin(lat)*np.sin(lon), np.cos(lat)))
+
+                relative = points - centroid[:,np.newaxis,:]
+                points = np.stack((np.einsum("ijk,ik->ij", relative, east),
+                                   np.einsum("ijk,ik->ij", relative, north)), axis=-1)
+
+            x, y = points[...,0], points[...,1]
+
+            # gradients of the linear basis functions of each vertex
+            area2 = (x[:,1] - x[:,0]) * (y[:,2] - y[:,0]) - (x[:,2] - x[:,0]) * (y[:,1] - y[:,0])
+            grad_x = (np.roll(y, -1, axis=1) - np.roll(y, -2, axis=1)) / area2[:,np.newaxis]
+            grad_y = (np.roll(x, -2, axis=1) - np.roll(x, -1, axis=1)) / area2[:,np.newaxis]
+
+            weight_x = 0.5 * np.abs(area2) * kappa_x[simplices].mean(axis=1)
+            weight_y = 0.5 * np.abs(area2) * kappa_y[simplices].mean(axis=1)
+
+            element = weight_x[:,np.newaxis,np.newaxis] * grad_x[:,:,np.newaxis] * grad_x[:,np.newaxis,:] \
+                    + weight_y[:,np.newaxis,np.newaxis] * grad_y[:,:,np.newaxis] * grad_y[:,np.newaxis,:]
+
+            rows = np.broadcast_to(simplices[:,:,np.newaxis], element.shape).ravel()
+            cols = np.broadcast_to(simplices[:,np.newaxis,:], element.shape).ravel()
+            values = element.ravel()
+
+        gnodes = mesh.lgmap_row.apply(np.arange(0, mesh.npoints, dtype=PETSc.IntType))
+        gstart, gend = mesh.gvec.getOwnershipRange()
+        owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+        keep = owned[rows]
+
+        return rows[keep], cols[keep], values[keep]
+
+
+    def _assemble_stiffness_matrix(self):
+        """ Assemble the stiffness matrix K (see _stiffness_entries) into a PETSc Mat """
+
+        from scipy.sparse import coo_matrix
+
+        mesh = self._mesh
+
+        rows, cols, values = self._stiffness_entries()
+
+        # sum the contributions of the elements sharing each node pair
+        stiffness = coo_matrix((values, (rows, cols)), shape=(mesh.npoints, mesh.npoints)).tocsr()
+        stiffness.sort_indices()
+
+        gstart, gend = mesh.gvec.getOwnershipRange()
+        gcols = mesh.lgmap_col.apply(stiffness.indices.astype(PETSc.IntType))
+        on_process = np.logical_and(gcols >= gstart, gcols < gend)
+        row_of_entry = np.repeat(np.arange(0, mesh.npoints), np.diff(stiffness.indptr))
+
+        nnz = []
+        for block in [on_process, ~on_process]:
+            mesh.lvec.setArray(np.bincount(row_of_entry[block], minlength=mesh.npoints).astype(float))
+            count = mesh.gvec.duplicate()
+            count.zeroEntries()
+            mesh.dm.localToGlobal(mesh.lvec, count, addv=PETSc.InsertMode.ADD_VALUES)
+            nnz.append(count.array.astype(PETSc.IntType))
+            count.destroy()
+
+        matrix = mesh._adjacency_matrix_template(nnz=tuple(nnz))
+        matrix.setValuesLocalCSR(stiffness.indptr.astype(PETSc.IntType),
+                                 stiffness.indices.astype(PETSc.IntType),
+                                 stiffness.data)
+        matrix.assemble()
+
+        return matrix
+
+
+    def _build_implicit_ksp(self, timestep, theta):
+        """
+        Set up a KSP for (M + theta dt K) dphi = - dt K phi where M holds the nodal
+        areas. The rows and columns of the nodes outside the dirichlet_mask are
+        replaced by the identity so that these nodes do not change and the operator
+        stays symmetric. The defaults are CG preconditioned by block Jacobi / ILU;
+        options can be changed with the "diffusion_" prefix, e.g. -diffusion_pc_type gamg
+        """
+
+        mesh = self._mesh
+
+        operator = self._stiffness_matrix.copy()
+        operator.scale(theta * timestep)
+
+        area = mesh.gvec.duplicate()
+        mesh.lvec.setArray(np.ones(mesh.npoints) * mesh.area)
+        mesh.dm.localToGlobal(mesh.lvec, area, addv=PETSc.InsertMode.INSERT_VALUES)
+        operator.setDiagonal(area, addv=PETSc.InsertMode.ADD_VALUES)
+        area.destroy()
+
+        # nodes held fixed
+        fixed = self._mask_values(self._dirichlet_mask) == 0.0
+
+        gnodes = mesh.lgmap_row.apply(np.arange(0, mesh.npoints, dtype=PETSc.IntType))
+        gstart, gend = mesh.gvec.getOwnershipRange()
+        owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+        operator.zeroRowsColumns(gnodes[np.logical_and(fixed, owned)], diag=1.0)
+
+        if self._free_nodes is None:
+            self._free_nodes = mesh.gvec.duplicate()
+        mesh.lvec.setArray((~fixed).astype(float))
+        mesh.dm.localToGlobal(mesh.lvec, self._free_nodes, addv=PETSc.InsertMode.INSERT_VALUES)
+
+        ksp = PETSc.KSP().create(comm=mesh.dm.comm)
+        ksp.setOptionsPrefix("diffusion_")
+        ksp.setOperators(operator)
+        ksp.setType("cg")
+        ksp.getPC().setType("bjacobi")
+        ksp.setTolerances(rtol=1.0e-10)
+        ksp.setFromOptions()
+        ksp.setUp()
+
+        operator.destroy()
+
+        if self._implicit_ksp is not None:
+            self._implicit_ksp.destroy()
+
+        self._implicit_ksp = ksp
+        self._implicit_timestep = (timestep, theta)
+
+        return ksp
+
+
+    def diffusion_rate_ensemble(self, phi, diffusivity_scale=1.0):
+        """
+        dphi/dt for each column of the (npoints, members) block phi, member j having
+        diffusivity diffusivity_scale[j] * diffusivity. The members share the assembled
+        stiffness matrix (see time_integration_implicit) and the masks, so each member
+        only adds its field data. The diffusivity cannot depend on phi.
+        """
+
+        if self._non_linear:
+            raise ValueError("Ensembles need a diffusivity that does not depend on phi")
+
+        mesh = self._mesh
+
+        self._update_stiffness_matrix()
+
+        phi = np.asarray(phi).reshape(mesh.npoints, -1)
+        scale = np.ones(phi.shape[1]) * diffusivity_scale
+
+        free = self._mask_values(self._dirichlet_mask) != 0.0
+        weight = free / (np.ones(mesh.npoints) * mesh.area)
+
+        rate = np.empty_like(phi, dtype=float)
+
+        x = mesh.gvec.duplicate()
+        Kx = mesh.gvec.duplicate()
+
+        for j in range(0, phi.shape[1]):
+            mesh.lvec.setArray(phi[:,j])
+            mesh.dm.localToGlobal(mesh.lvec, x, addv=PETSc.InsertMode.INSERT_VALUES)
+            self._stiffness_matrix.mult(x, Kx)
+            mesh.dm.globalToLocal(Kx, mesh.lvec)
+            rate[:,j] = -scale[j] * weight * mesh.lvec.array
+
+        x.destroy()
+        Kx.destroy()
+
+        return rate
+
+
+    def time_integration_ensemble(self, phi, timestep, steps=1, Delta_t=None, diffusivity_scale=1.0, feedback=None):
+        """
+        Integrate an ensemble of fields, the columns of the (npoints, members) block
+        phi (updated in place), with the midpoint scheme of time_integration and the
+        rates of diffusion_rate_ensemble. The timestep should not exceed
+        diffusion_timestep() / max(diffusivity_scale).
+        """
+
+        if Delta_t is not None:
+            steps = Delta_t // timestep
+            timestep = Delta_t / steps
+
+        elapsed_time = 0.0
+
+        for step in range(0, int(steps)):
+
+            phi_half = phi + 0.5 * timestep * self.diffusion_rate_ensemble(phi, diffusivity_scale)
+            phi += timestep * self.diffusion_rate_ensemble(phi_half, diffusivity_scale)
+
+            elapsed_time += timestep
+
+            if feedback is not None and step%feedback == 0 or step == steps:
+                print("{:05d} - t = {:.3g}".format(step, elapsed_time))
+
+        return steps, elapsed_time
+
+
+    def time_integration_adaptive(self, Delta_t, timestep=None, method="RK23", rtol=1.0e-3, atol=1.0e-6, feedback=None):
+        """
+        Integrate over Delta_t with an embedded Runge-Kutta pair (see
+        integrators.EmbeddedRungeKutta) that picks each timestep from the estimated
+        error of the last one. The first trial timestep is the last one suggested
+        (or diffusion_timestep on the first call).
+
+        Returns the number of accepted and rejected steps and the elapsed time.
+        """
+
+        from .integrators import EmbeddedRungeKutta
+
+        mesh = self._mesh
+
+        if timestep is None:
+            timestep = getattr(self, "_adaptive_timestep", None) or self.diffusion_timestep()
+
+        # the rate function is built once and evaluated with phi set to each stage
+        dPhi_dt_fn = self.diffusion_rate_fn(self.phi)
+
+        def rate(phi):
+            self.phi.data = phi
+            return dPhi_dt_fn.evaluate(mesh)
+
+        phi = mesh._workspace_vectors(self.id)[0].array
+        phi[:] = self.phi.data
+
+        integrator = EmbeddedRungeKutta(mesh, method=method, rtol=rtol, atol=atol,
+                                        workspace="integrator_{}".format(self.id))
+        steps, rejected, elapsed_time, self._adaptive_timestep = integrator.integrate(rate, phi, Delta_t, timestep, feedback=feedback)
+
+        self.phi.data = phi
+
+        return steps, rejected, elapsed_time
+
+
+    def time_integration_implicit(self, timestep, steps=1, Delta_t=None, theta=1.0, feedback=None):
+        """
+        Integrate the diffusion equation with the theta scheme on the assembled
+        operator: theta=1.0 is backward Euler and theta=0.5 is Crank-Nicolson
+        (which may oscillate for timesteps well above diffusion_timestep).
+        Both are stable for any timestep. The operator is assembled once and kept
+        while the timestep and the values of the diffusivity and the masks are
+        unchanged (it is reassembled every step if the diffusivity depends on phi).
+        """
+
+        mesh = self._mesh
+
+        if Delta_t is not None:
+            steps = Delta_t // timestep
+            timestep = Delta_t / steps
+
+        elapsed_time = 0.0
+
+        phi = mesh.gvec.duplicate()
+        rhs = mesh.gvec.duplicate()
+        dphi = mesh.gvec.duplicate()
+
+        self.phi.getGlobalVector(phi)
+
+        for step in range(0, int(steps)):
+
+            self._update_stiffness_matrix()
+
+            if self._implicit_timestep != (timestep, theta):
+                self._build_implicit_ksp(timestep, theta)
+
+            self._stiffness_matrix.mult(phi, rhs)
+            rhs.scale(-timestep)
+            rhs.pointwiseMult(rhs, self._free_nodes)
+
+            self._implicit_ksp.solve(rhs, dphi)
+            phi.axpy(1.0, dphi)
+
+            mesh.dm.globalToLocal(phi, mesh.lvec)
+            self.phi.data = mesh.lvec.array
+
+            elapsed_time += timestep
+
+            if feedback is not None and step%feedback == 0 or step == steps:
+                print("{:05d} - t = {:.3g}".format(step, elapsed_time))
+
+        phi.destroy()
+        rhs.destroy()
+        dphi.destroy()
+
+        return steps, elapsed_time
+
+
     def time_integration(self, timestep, steps=1, Delta_t=None, feedback=None):
 
         from quagmire import function as fn
@@ -208,9 +602,10 @@ class DiffusionEquation(object):
             dPhi_dt_fn   = self.diffusion_rate_fn(self.phi)
 
 
-            phi0 = self.phi.copy()
+            phi0 = self._mesh._workspace_vectors(self.id)[0].array
+            phi0[:] = self.phi.data
             self.phi.data = self.phi.data  +  0.5 * timestep * dPhi_dt_fn.evaluate(self._mesh)
-            self.phi.data = phi0.data +  timestep * dPhi_dt_fn.evaluate(self._mesh)
+            self.phi.data = phi0 +  timestep * dPhi_dt_fn.evaluate(self._mesh)
 
             elapsed_time += timestep
 
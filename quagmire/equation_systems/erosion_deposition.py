@@ -15,15 +15,125 @@
 # along with Quagmire.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import warnings
 import numpy as np
 from mpi4py import MPI
+from petsc4py import PETSc
 comm = MPI.COMM_WORLD
 
 from quagmire.function import LazyEvaluation as _LazyEvaluation
+from quagmire.function import evaluation_context as _evaluation_context
 
 # To do ... an interface for (iteratively) dealing with
 # boundaries with normals that are not aligned to the coordinates
 
+
+def _stream_power_drop(drop, coefficient, n, tolerance=1.0e-10, max_its=100):
+    """
+    Solve x + coefficient * x**n = drop for 0 < x <= drop (drop > 0) with
+    Newton iterations kept inside the bracket (bisecting when they leave it)
+    """
+
+    lower = np.zeros_like(drop)
+    upper = drop.copy()
+    x = drop.copy()
+
+    for its in range(0, max_its):
+        residual = x + coefficient * x**n - drop
+
+        upper = np.where(residual > 0.0, x, upper)
+        lower = np.where(residual > 0.0, lower, x)
+
+        x_new = x - residual / (1.0 + n * coefficient * x**(n-1.0))
+
+        outside = np.logical_or(x_new <= lower, x_new >= upper)
+        x_new = np.where(outside, 0.5*(lower + upper), x_new)
+
+        converged = np.all(np.abs(x_new - x) <= tolerance * drop)
+        x = x_new
+
+        if converged:
+            break
+
+    return x
+
+
+def _implicit_stream_power_sweep(mesh, height, h, coefficient, n):
+    """
+    One pass of the implicit stream power solve over the local domain (see
+    _implicit_stream_power_solve). The levels of the receiver graph are taken
+    from the outlets upstream, so every steepest receiver is already known.
+    The values of h at the shadow nodes are used as they are.
+    """
+
+    src, dst, wts = mesh._flow_edges
+    ptr = mesh._flow_edge_ptr
+    steepest = mesh._flow_edge_steepest()
+
+    for l in range(ptr.size-2, -1, -1):
+        s = slice(ptr[l], ptr[l+1])
+        edges = steepest[s]
+
+        nodes = src[s][edges]
+        h_receiver = h[dst[s][edges]]
+        drop = height[nodes] - h_receiver
+        coefficient_l = coefficient[nodes]
+
+        eroding = np.logical_and(drop > 0.0, coefficient_l > 0.0)
+        if not eroding.any():
+            continue
+
+        nodes = nodes[eroding]
+        drop = drop[eroding]
+        coefficient_l = coefficient_l[eroding]
+
+        if n == 1.0:
+            drop = drop / (1.0 + coefficient_l)
+        else:
+            drop = _stream_power_drop(drop, coefficient_l, n)
+
+        h[nodes] = h_receiver[eroding] + drop
+
+    return h
+
+
+def _implicit_stream_power_solve(mesh, height, coefficient, n):
+    """
+    Heights h of an implicit stream power step, h_i + F_i (h_i - h_r)^n = height_i
+    with r the steepest receiver (down_neighbour[1]) of node i and F_i the
+    coefficient (dt K A^m / L^n). Outlets keep their height and nodes that are
+    not above their receiver do not erode.
+
+    In parallel the local sweep is repeated with the heights of the shadow nodes
+    from their owners until those no longer change (as for uphill scans, the
+    number of passes depends on how many partition boundaries the flow paths cross).
+    """
+
+    if mesh._flow_edges is None:
+        raise RuntimeError("The receiver graph has cycles and cannot be solved in order")
+
+    if mesh.dm.comm.Get_size() == 1:
+        return _implicit_stream_power_sweep(mesh, height, height.copy(), coefficient, n)
+
+    owned = mesh._flow_owned
+    h = height.copy()
+
+    while True:
+        h_new = _implicit_stream_power_sweep(mesh, height, np.where(owned, height, h), coefficient, n)
+        h_new = mesh.sync(h_new)
+
+        local_change = np.array(np.abs(h_new - h)[~owned].max(initial=0.0))
+        global_change = np.array(0.0)
+        comm.Allreduce([local_change, MPI.DOUBLE], [global_change, MPI.DOUBLE], op=MPI.MAX)
+
+        h = h_new
+
+        if global_change == 0.0:
+            break
+
+    return h
+
+
 class ErosionDepositionEquation(object):
 
     ## it is helpful to have a unique ID for each instance so we
@@ -71,6 +181,7 @@ class ErosionDepositionEquation(object):
         self._mesh = meshobject
         self._erosion_rate   = meshobject.add_variable(name="qs_{}".format(self.id))
         self._deposition_rate   = meshobject.add_variable(name="ed_{}".format(self.id))
+        self._rate_fns = dict()
         return
 
     @property
@@ -90,6 +201,7 @@ class ErosionDepositionEquation(object):
     def rainfall(self, fn_object):
         # Should verify it is a function
         self._rainfall = fn_object
+        self._rate_fns = dict()
         return
 
     @property
@@ -138,18 +250,52 @@ class ErosionDepositionEquation(object):
         qs = UpInt(rainfall)^m * (grad H(x,y))^2
         """
         slope = self._mesh.topography.slope()
-        rainfall_fn = self._rainfall
         m = self._m
         n = self._n
 
         # integrate upstream rainfall
-        upstream_precipitation_integral_fn = self._mesh.upstream_integral_fn(rainfall_fn)
+        upstream_precipitation_integral_fn = self._upstream_rainfall_fn()
 
         # create stream power function
         stream_power_law_fn = upstream_precipitation_integral_fn**m * slope**n * self._mesh.mask
         return stream_power_law_fn
 
 
+    def _upstream_rainfall_fn(self):
+        """ The upstream integral of the rainfall (kept until the mesh or the rainfall change) """
+
+        upstream_rainfall_fn = self._rate_fns.get("upstream_rainfall")
+
+        if upstream_rainfall_fn is None:
+            upstream_rainfall_fn = self._mesh.upstream_integral_fn(self._rainfall)
+            self._rate_fns["upstream_rainfall"] = upstream_rainfall_fn
+
+        return upstream_rainfall_fn
+
+
+    def _erosion_rate_fn(self, efficiency):
+        """
+        The compiled erosion rate, efficiency * stream_power_fn(). It is kept for
+        each (efficiency, m, n) so that repeated calls reuse the same function
+        (and its cached values) instead of compiling a new one.
+        """
+
+        from quagmire import function as fn
+
+        if fn.check_object_is_a_q_function(efficiency):
+            key = ("erosion_rate", efficiency.id, self._m, self._n)
+        else:
+            key = ("erosion_rate", efficiency, self._m, self._n)
+
+        erosion_rate_fn = self._rate_fns.get(key)
+
+        if erosion_rate_fn is None:
+            erosion_rate_fn = (efficiency*self.stream_power_fn()).compile()
+            self._rate_fns[key] = erosion_rate_fn
+
+        return erosion_rate_fn
+
+
 ## Built-in erosion / deposition functions
 
     def erosion_deposition_local_equilibrium(self, efficiency):
@@ -157,8 +303,7 @@ class ErosionDepositionEquation(object):
         Local equilibrium model
         """
 
-        stream_power_fn = self.stream_power_fn()
-        erosion_rate_fn = efficiency*stream_power_fn
+        erosion_rate_fn = self._erosion_rate_fn(efficiency)
 
         # store erosion rate so we do not have to evaluate it
         # again to compute the deposition rate
@@ -179,6 +324,54 @@ class ErosionDepositionEquation(object):
         return erosion_rate.data, deposition_rate.data
 
 
+    def erosion_deposition_ensemble(self, efficiency, m=None, n=None, rainfall=None):
+        """
+        Local equilibrium erosion and deposition rates (as in
+        erosion_deposition_local_equilibrium) of an ensemble of parameter sets on
+        the current topography. All members share the mesh, the slope and the
+        downhill matrices, and the upstream integrals of all members are
+        accumulated together as one block.
+
+        efficiency, m and n are numbers or one value per member (m and n default to
+        those of the equation). rainfall is a quagmire function (by default the one of
+        the equation) or an (npoints, members) array. Returns (npoints, members)
+        blocks of the erosion and deposition rates.
+        """
+
+        from quagmire import function as fn
+
+        mesh = self._mesh
+
+        m = self._m if m is None else m
+        n = self._n if n is None else n
+        rainfall = self._rainfall if rainfall is None else rainfall
+
+        if fn.check_object_is_a_q_function(rainfall):
+            rainfall = np.ones(mesh.npoints) * rainfall.evaluate(mesh)
+
+        rainfall = np.asarray(rainfall, dtype=float).reshape(mesh.npoints, -1)
+
+        efficiency = np.asarray(efficiency, dtype=float).reshape(1, -1)
+        m = np.asarray(m, dtype=float).reshape(1, -1)
+        n = np.asarray(n, dtype=float).reshape(1, -1)
+
+        members = max(efficiency.shape[1], m.shape[1], n.shape[1], rainfall.shape[1])
+
+        area = (np.ones(mesh.npoints) * mesh.area).reshape(-1, 1)
+        slope = mesh.topography.slope().evaluate(mesh).reshape(-1, 1)
+        mask = mesh.mask.data.reshape(-1, 1)
+
+        # a rainfall shared by all members is integrated once
+        upstream_precipitation = mesh.cumulative_flow(rainfall * area)
+
+        erosion_rate = efficiency * upstream_precipitation**m * slope**n * mask
+        erosion_rate = np.ascontiguousarray(np.broadcast_to(erosion_rate, (mesh.npoints, members)))
+
+        deposition_rate = mesh.cumulative_flow(erosion_rate * area)
+
+        return erosion_rate, deposition_rate
+
+
     def fn_local_equilibrium(self, efficiency):
 
         import quagmire
@@ -219,21 +412,14 @@ class ErosionDepositionEquation(object):
         """
         Transport-limited
         """
-        slope = self._mesh.topography.slope()
-        rainfall_fn = self._rainfall
-        m = self._m
-        n = self._n
         area = self._mesh.pointwise_area
 
         # integrate upstream / calculate rate
-        upstream_precipitation_integral_fn = self._mesh.upstream_integral_fn(rainfall_fn)
+        upstream_precipitation_integral_fn = self._upstream_rainfall_fn()
         upstream_precipitation_rate_fn = upstream_precipitation_integral_fn / area
 
-        # construct stream power function
-        stream_power_fn = upstream_precipitation_integral_fn**m * slope**n * self._mesh.mask
-
-        # only some is eroded
-        erosion_rate_fn = stream_power_fn*efficiency
+        # only some of the stream power is eroded
+        erosion_rate_fn = self._erosion_rate_fn(efficiency)
 
         # integrate upstream / calculate rate
         upstream_eroded_material_integral_fn = self._mesh.upstream_integral_fn(erosion_rate_fn)
@@ -241,14 +427,20 @@ class ErosionDepositionEquation(object):
 
         deposition_rate_fn = upstream_precipitation_rate_fn / (alpha * upstream_eroded_material_rate_fn)
 
+        # the upstream rainfall and the erosion rate are shared by both rates
+
+        with _evaluation_context():
+            erosion_rate_values = erosion_rate_fn.evaluate(self._mesh)
+            deposition_rate_values = deposition_rate_fn.evaluate(self._mesh)
+
         erosion_rate = self._erosion_rate
         erosion_rate.unlock()
-        erosion_rate.data = erosion_rate_fn.evaluate(self._mesh)
+        erosion_rate.data = erosion_rate_values
         erosion_rate.lock()
 
         deposition_rate = self._deposition_rate
         deposition_rate.unlock()
-        deposition_rate.data = deposition_rate_fn.evaluate(self._mesh)
+        deposition_rate.data = deposition_rate_values
         deposition_rate.lock()
 
         return erosion_rate, deposition_rate
@@ -283,6 +475,190 @@ class ErosionDepositionEquation(object):
 
 
 
+    def _stream_power_coefficient(self, efficiency):
+        """
+        K A^m / L^n for each node, where A is the upstream integral of rainfall and
+        L the distance to the steepest receiver (down_neighbour[1]). It is zero where
+        the mesh mask is zero and at outlets, which do not erode.
+        """
+
+        from quagmire import function as fn
+
+        mesh = self._mesh
+
+        receivers = mesh.down_neighbour[1]
+        length = np.linalg.norm(mesh.data - mesh.data[receivers], axis=1)
+
+        area = self._upstream_rainfall_fn().evaluate(mesh)
+        efficiency = fn.convert(efficiency).evaluate(mesh) * np.ones(mesh.npoints)
+
+        eroding = np.logical_and(length > 0.0, mesh.mask.data > 0.0)
+
+        coefficient = np.zeros(mesh.npoints)
+        coefficient[eroding] = efficiency[eroding] * area[eroding]**self._m / length[eroding]**self._n
+
+        return coefficient
+
+
+    def time_integration_implicit(self, timestep, steps=1, Delta_t=None, efficiency=1.0, uplift=None, feedback=None):
+        """
+        Detachment-limited stream power erosion, dH/dt = U - K A^m S^n, with the
+        implicit scheme of Braun & Willett (2013): the slope of each node is taken
+        to its steepest receiver at the end of the step and the nodes are solved in
+        receiver order from the outlets (with a Newton iteration where n != 1).
+        The scheme is stable for any timestep.
+
+        efficiency (K) and uplift (U) may be quagmire functions or numbers.
+        The erosion rate of the last step is stored in erosion_rate.
+        """
+
+        from quagmire import function as fn
+
+        mesh = self._mesh
+        topography = mesh.topography
+
+        if Delta_t is not None:
+            steps = Delta_t // timestep
+            timestep = Delta_t / steps
+
+        elapsed_time = 0.0
+
+        for step in range(0, int(steps)):
+
+            height = topography.data.copy()
+            if uplift is not None:
+                height += timestep * fn.convert(uplift).evaluate(mesh)
+
+            coefficient = timestep * self._stream_power_coefficient(efficiency)
+
+            new_height = _implicit_stream_power_solve(mesh, height, coefficient, self._n)
+
+            erosion_rate = self._erosion_rate
+            erosion_rate.unlock()
+            erosion_rate.data = (height - new_height) / timestep
+            erosion_rate.lock()
+
+            with mesh.deform_topography():
+                # a single rebuild of the downhill matrices per step
+                topography.data = new_height
+
+            elapsed_time += timestep
+
+            if feedback is not None and step%feedback == 0 or step == steps:
+                print("{:05d} - t = {:.3g}".format(step, elapsed_time))
+
+        return steps, elapsed_time
+
+
+    def solve_steady_state(self, uplift, efficiency=1.0, m=None, n=None, max_its=10, tolerance=0.0, verbose=False):
+        """
+        Topography in equilibrium between uplift and detachment-limited stream
+        power erosion, U = K A^m S^n (m and n default to those of the equation).
+        The steady slope of each node, S = (U / (K A^m))^(1/n), is integrated
+        along the steepest flow paths (down_neighbour[1]) up from the outlets and
+        the nodes where the mesh mask is zero, which keep their height. The new
+        topography changes the receivers and upstream areas, so this is repeated
+        (with one rebuild of the downhill matrices each time) until the fraction of
+        nodes whose receiver changes is no more than tolerance, or for max_its
+        iterations (with a RuntimeWarning if it has not converged by then). Where
+        drainage divides are still migrating this takes about as many iterations
+        as the reorganisation would take response times.
+
+        Interior low points are also outlets, so depressions should be filled first
+        (e.g. low_points_priority_flood_fill with epsilon > 0).
+        uplift (U) and efficiency (K) may be quagmire functions or numbers.
+        Returns the number of iterations and the number of receivers that changed
+        in the last one (zero when the topography is in steady state).
+        """
+
+        from quagmire import function as fn
+
+        mesh = self._mesh
+        topography = mesh.topography
+
+        m = self._m if m is None else m
+        n = self._n if n is None else n
+
+        nodes = np.arange(0, mesh.npoints)
+
+        gnodes = mesh.lgmap_row.apply(nodes.astype(PETSc.IntType))
+        gstart, gend = mesh.gvec.getOwnershipRange()
+        owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+        for its in range(1, max_its+1):
+
+            receivers = mesh.down_neighbour[1].copy()
+
+            area = self._upstream_rainfall_fn().evaluate(mesh)
+            uplift_rate = np.maximum(fn.convert(uplift).evaluate(mesh) * np.ones(mesh.npoints), 0.0)
+            erodibility = fn.convert(efficiency).evaluate(mesh) * area**m
+
+            slope = (uplift_rate / erodibility)**(1.0/n)
+
+            # fixed nodes keep their height and stop the paths from their donors
+
+            height = topography.data
+            fixed = np.logical_or(receivers == nodes, mesh.mask.data == 0.0)
+
+            src, dst, wts = mesh._flow_edges
+            passed = np.logical_and(mesh._flow_edge_steepest(), ~fixed[src])
+            rise = slope[src] * mesh._flow_edge_lengths()
+
+            steady_height = mesh.flow_scan(np.where(fixed, height, 0.0), operator="sum", uphill=True,
+                                           edge_values=rise, weighted=passed)
+
+            with mesh.deform_topography():
+                topography.data = steady_height
+
+            changed = np.array(np.count_nonzero((mesh.down_neighbour[1] != receivers)[owned]), dtype=float)
+            comm.Allreduce(MPI.IN_PLACE, [changed, MPI.DOUBLE], op=MPI.SUM)
+
+            if comm.rank == 0 and verbose:
+                print("{:03d} - steady state: {} receivers changed".format(its, int(changed)))
+
+            if changed <= tolerance * mesh.gvec.getSize():
+                break
+        else:
+            warnings.warn("steady state not reached in {} iterations ({} receivers changed in the last one)".format(max_its, int(changed)), RuntimeWarning)
+
+        return its, int(changed)
+
+
+    def time_integration_adaptive(self, Delta_t, timestep=None, efficiency=1.0, method="RK23", rtol=1.0e-3, atol=1.0e-6, feedback=None):
+        """
+        Integrate the local equilibrium model (deposition_rate - erosion_rate) over
+        Delta_t with an embedded Runge-Kutta pair (see integrators.EmbeddedRungeKutta)
+        that picks each timestep from the estimated error of the last one. The
+        downhill matrices are rebuilt for every stage. The first trial timestep is
+        the last one suggested (or estimated on the first call).
+
+        Returns the number of accepted and rejected steps and the elapsed time.
+        """
+
+        from .integrators import EmbeddedRungeKutta
+
+        mesh = self._mesh
+        topography = mesh.topography
+
+        if timestep is None:
+            timestep = getattr(self, "_adaptive_timestep", None)
+
+        def rate(height):
+            with mesh.deform_topography():
+                topography.data = height
+            erosion_rate, deposition_rate = self.erosion_deposition_local_equilibrium(efficiency)
+            return deposition_rate - erosion_rate
+
+        height = mesh._workspace_vectors("ed_{}".format(self.id))[0].array
+        height[:] = topography.data
+
+        integrator = EmbeddedRungeKutta(mesh, method=method, rtol=rtol, atol=atol,
+                                        workspace="integrator_ed_{}".format(self.id))
+        steps, rejected, elapsed_time, self._adaptive_timestep = integrator.integrate(rate, height, Delta_t, timestep, feedback=feedback)
+
+        return steps, rejected, elapsed_time
+
+
     def time_integration(self, timestep, steps=1, Delta_t=None, feedback=None):
 
         from quagmire import function as fn
@@ -303,7 +679,8 @@ class ErosionDepositionEquation(object):
             erosion_rate, deposition_rate = self.erosion_deposition_local_equilibrium()
 
             # half timestep
-            topography0 = topography.copy()
+            topography0 = self._mesh._workspace_vectors("ed_{}".format(self.id))[0].array
+            topography0[:] = topography.data
             topography.unlock()
             topography.data = topography.data + 0.5*timestep*(deposition_rate - erosion_rate)
             topography.lock()
@@ -313,7 +690,7 @@ class ErosionDepositionEquation(object):
 
             with self._mesh.deform_topography():
                 # rebuild downhill matrix structure
-                topography.data = topography0.data + timestep*(deposition_rate - erosion_rate)
+                topography.data = topography0 + timestep*(deposition_rate - erosion_rate)
 
             elapsed_time += timestep
 
@@ -0,0 +1,217 @@
+# Copyright 2016-2020 Louis Moresi, Ben Mather, Romain Beucher
+#
+# This file is part of Quagmire.
+#
+# Quagmire is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or any later version.
+#
+# Quagmire is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Quagmire.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Embedded Runge-Kutta time integration with error control, shared by the
+equation systems. The timestep is chosen from the estimated local error of
+each step rather than from a stability bound, and the stage buffers are local
+vectors kept on the mesh and reused from step to step.
+"""
+
+import numpy as np
+from mpi4py import MPI
+from petsc4py import PETSc
+comm = MPI.COMM_WORLD
+
+
+## Butcher tableaus of the embedded pairs: (c, a, b, b_hat, order of b_hat).
+## Both have the first-same-as-last property: the last stage is the rate at
+## the new solution, and is the first stage of the next step.
+
+_tableaus = dict()
+
+_tableaus["RK23"] = ( # Bogacki - Shampine
+    [0.0, 1.0/2.0, 3.0/4.0, 1.0],
+    [[],
+     [1.0/2.0],
+     [0.0, 3.0/4.0],
+     [2.0/9.0, 1.0/3.0, 4.0/9.0]],
+    [2.0/9.0, 1.0/3.0, 4.0/9.0, 0.0],
+    [7.0/24.0, 1.0/4.0, 1.0/3.0, 1.0/8.0],
+    2 )
+
+_tableaus["RK45"] = ( # Dormand - Prince
+    [0.0, 1.0/5.0, 3.0/10.0, 4.0/5.0, 8.0/9.0, 1.0, 1.0],
+    [[],
+     [1.0/5.0],
+     [3.0/40.0, 9.0/40.0],
+     [44.0/45.0, -56.0/15.0, 32.0/9.0],
+     [19372.0/6561.0, -25360.0/2187.0, 64448.0/6561.0, -212.0/729.0],
+     [9017.0/3168.0, -355.0/33.0, 46732.0/5247.0, 49.0/176.0, -5103.0/18656.0],
+     [35.0/384.0, 0.0, 500.0/1113.0, 125.0/192.0, -2187.0/6784.0, 11.0/84.0]],
+    [35.0/384.0, 0.0, 500.0/1113.0, 125.0/192.0, -2187.0/6784.0, 11.0/84.0, 0.0],
+    [5179.0/57600.0, 0.0, 7571.0/16695.0, 393.0/640.0, -92097.0/339200.0, 187.0/2100.0, 1.0/40.0],
+    4 )
+
+
+class EmbeddedRungeKutta(object):
+    """
+    Adaptive integration of dy/dt = rate(y) for a field y on the mesh nodes.
+
+    Parameters
+    ----------
+    mesh : quagmire mesh object
+    method : str
+        "RK23" (Bogacki-Shampine) or "RK45" (Dormand-Prince)
+    rtol, atol : float
+        relative and absolute tolerance of the error of each step, measured
+        as the root mean square over the nodes of the mesh
+    safety, min_factor, max_factor : float
+        the next timestep is safety * (1/error)**(1/(order+1)) times the last,
+        limited to [min_factor, max_factor]
+    workspace : str
+        name of the mesh workspace vectors that hold the stages (by default one
+        for each integrator). Integrators that may run at the same time, e.g.
+        one inside the rate of another, must not share it.
+    """
+
+    __count = 0
+
+    @classmethod
+    def _count(cls):
+        EmbeddedRungeKutta.__count += 1
+        return EmbeddedRungeKutta.__count
+
+    def __init__(self, mesh, method="RK23", rtol=1.0e-3, atol=1.0e-6, safety=0.9, min_factor=0.2, max_factor=5.0,
+                 workspace=None):
+
+        if method not in _tableaus:
+            raise ValueError("Choose a valid method: {}".format(list(_tableaus.keys())))
+
+        self.mesh = mesh
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+        self.safety = safety
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+
+        if workspace is None:
+            workspace = "integrator_{}".format(self._count())
+        self.workspace = workspace
+
+        c, a, b, b_hat, order = _tableaus[method]
+        self._c = c
+        self._a = a
+        self._error_weights = np.array(b) - np.array(b_hat)
+        self._exponent = 1.0 / (order + 1.0)
+
+        gnodes = mesh.lgmap_row.apply(np.arange(0, mesh.npoints, dtype=PETSc.IntType))
+        gstart, gend = mesh.gvec.getOwnershipRange()
+        self._owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+
+    def _error_norm(self, error, y0, y1):
+        """ Root mean square of the scaled error over the (owned) nodes of the whole mesh """
+
+        scale = self.atol + self.rtol * np.maximum(np.abs(y0), np.abs(y1))
+        scaled = (error / scale)[self._owned]
+
+        local_sums = np.array([(scaled**2).sum(), scaled.size], dtype=float)
+        global_sums = np.zeros_like(local_sums)
+        comm.Allreduce([local_sums, MPI.DOUBLE], [global_sums, MPI.DOUBLE], op=MPI.SUM)
+
+        return np.sqrt(global_sums[0] / max(global_sums[1], 1.0))
+
+
+    def integrate(self, rate, y, Delta_t, timestep=None, max_steps=1000000, feedback=None):
+        """
+        Advance y (an array of node values, updated in place) by Delta_t.
+
+        rate(y) returns dy/dt for the node values y. It is called with the
+        accepted solution last, so any state it sets (e.g. the topography of the
+        mesh) is left consistent with the result. timestep is the first trial step
+        (if None it is estimated from the size of y and of its rate).
+
+        Returns the number of accepted and rejected steps, the elapsed time and
+        the next trial timestep (to start the next call with).
+        """
+
+        nstages = len(self._c)
+
+        buffers = self.mesh._workspace_vectors(self.workspace, nstages + 3)
+        k = [v.array for v in buffers[:nstages]]
+        y_stage = buffers[nstages].array
+        error = buffers[nstages+1].array
+        scratch = buffers[nstages+2].array
+
+        k[0][:] = rate(y)
+
+        if timestep is None:
+            size_y = self._error_norm(y, y, y)
+            size_rate = self._error_norm(k[0], y, y)
+
+            if size_y < 1.0e-5 or size_rate < 1.0e-5:
+                timestep = 1.0e-6 * Delta_t
+            else:
+                timestep = 0.01 * size_y / size_rate
+
+        steps = 0
+        rejected = 0
+        elapsed_time = 0.0
+        accepted = True
+
+        while elapsed_time < Delta_t * (1.0 - 1.0e-12) and steps + rejected < max_steps:
+
+            h = min(timestep, Delta_t - elapsed_time)
+
+            for s in range(1, nstages):
+                y_stage[:] = y
+                for j, a_sj in enumerate(self._a[s]):
+                    if a_sj != 0.0:
+                        np.multiply(k[j], h * a_sj, out=scratch)
+                        y_stage += scratch
+
+                k[s][:] = rate(y_stage)
+
+            # the last stage is at the new solution (y_stage)
+
+            error[:] = 0.0
+            for j, e_j in enumerate(self._error_weights):
+                if e_j != 0.0:
+                    np.multiply(k[j], h * e_j, out=scratch)
+                    error += scratch
+
+            norm = self._error_norm(error, y, y_stage)
+            accepted = norm <= 1.0
+
+            if accepted:
+                y[:] = y_stage
+                k[0][:] = k[-1]
+                elapsed_time += h
+                steps += 1
+
+                if norm == 0.0:
+                    factor = self.max_factor
+                else:
+                    factor = min(self.max_factor, max(self.min_factor, self.safety * norm**-self._exponent))
+
+                if feedback is not None and steps%feedback == 0:
+                    if comm.rank == 0:
+                        print("{:05d} - t = {:.3g}, dt = {:.3g}".format(steps, elapsed_time, h))
+
+            else:
+                rejected += 1
+                factor = max(self.min_factor, self.safety * norm**-self._exponent)
+
+            timestep = h * factor
+
+        # leave any state set by rate at the accepted solution
+
+        if not accepted:
+            rate(y)
+
+        return steps, rejected, elapsed_time, timestep
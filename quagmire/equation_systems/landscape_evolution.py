@@ -0,0 +1,158 @@
+# Copyright 2016-2020 Louis Moresi, Ben Mather, Romain Beucher
+#
+# This file is part of Quagmire.
+#
+# Quagmire is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or any later version.
+#
+# Quagmire is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Quagmire.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+from mpi4py import MPI
+comm = MPI.COMM_WORLD
+
+
+class LandscapeEvolution(object):
+    """
+    Evolve the topography of a mesh under uplift, erosion / deposition and
+    hillslope diffusion by operator splitting. In each step the processes are
+    applied one after the other to a working copy of the heights, with the
+    downhill matrices of the topography at the start of the step, and the
+    result is written to the topography in a single deform_topography (one
+    rebuild of the downhill matrices, upstream areas and low points per step).
+
+    Parameters
+    ----------
+    mesh : quagmire mesh object
+    diffusion : DiffusionEquation (optional)
+        applied to the topography (its phi is used as a work variable)
+    erosion_deposition : ErosionDepositionEquation (optional)
+        the local equilibrium model with the given efficiency
+    efficiency : quagmire function or number
+    uplift : quagmire function or number (optional)
+        uplift rate
+    """
+
+    def __init__(self, mesh, diffusion=None, erosion_deposition=None, efficiency=1.0, uplift=None):
+
+        self.mesh = mesh
+        self.diffusion = diffusion
+        self.erosion_deposition = erosion_deposition
+        self.efficiency = efficiency
+        self.uplift = uplift
+
+        return
+
+
+    def _set_heights(self, height):
+        """
+        Set the topography without rebuilding the downhill matrices. The
+        deform_topography at the end of the step compares the heights with those
+        the matrices were built from, so these writes are included in its update.
+        """
+
+        topography = self.mesh.topography
+        topography.unlock()
+        topography.data = height
+        topography.lock()
+
+        return
+
+
+    def _erode(self, height, timestep, substeps):
+        """ Erosion / deposition of height (in place) on the current downhill matrices """
+
+        dt = timestep / substeps
+
+        for substep in range(0, substeps):
+            self._set_heights(height)
+            erosion_rate, deposition_rate = self.erosion_deposition.erosion_deposition_local_equilibrium(self.efficiency)
+            height += dt * (deposition_rate - erosion_rate)
+
+        return
+
+
+    def _diffuse(self, height, timestep, substeps, implicit):
+        """ Hillslope diffusion of height (in place) """
+
+        diffusion = self.diffusion
+        phi = diffusion.phi
+
+        phi.data = height
+
+        if implicit:
+            diffusion.time_integration_implicit(timestep, steps=1)
+        else:
+            dt = timestep / substeps
+            dPhi_dt_fn = diffusion.diffusion_rate_fn(phi)
+
+            for substep in range(0, substeps):
+                height_half = height + 0.5 * dt * dPhi_dt_fn.evaluate(self.mesh)
+                phi.data = height_half
+                height += dt * dPhi_dt_fn.evaluate(self.mesh)
+                phi.data = height
+
+        height[:] = phi.data
+
+        return
+
+
+    def time_integration(self, timestep, steps=1, Delta_t=None, erosion_substeps=1, diffusion_substeps=None,
+                               implicit_diffusion=False, feedback=None):
+        """
+        Advance the topography by steps of timestep (or over Delta_t).
+
+        The faster process can be sub-cycled within each step: erosion_substeps
+        erosion / deposition updates (on the downhill matrices of the start of the
+        step), and diffusion_substeps explicit diffusion updates (by default enough to
+        keep within diffusion_timestep). With implicit_diffusion the diffusion is a
+        single backward Euler solve (see DiffusionEquation.time_integration_implicit).
+        """
+
+        from quagmire import function as fn
+
+        mesh = self.mesh
+        topography = mesh.topography
+
+        if Delta_t is not None:
+            steps = Delta_t // timestep
+            timestep = Delta_t / steps
+
+        if self.diffusion is not None and not implicit_diffusion and diffusion_substeps is None:
+            diffusion_substeps = max(1, int(np.ceil(timestep / self.diffusion.diffusion_timestep())))
+
+        height = mesh._workspace_vectors("landscape_evolution")[0].array
+
+        elapsed_time = 0.0
+
+        for step in range(0, int(steps)):
+
+            height[:] = topography.data
+
+            if self.uplift is not None:
+                height += timestep * fn.convert(self.uplift).evaluate(mesh)
+
+            if self.erosion_deposition is not None:
+                self._erode(height, timestep, erosion_substeps)
+
+            if self.diffusion is not None:
+                self._diffuse(height, timestep, diffusion_substeps, implicit_diffusion)
+
+            with mesh.deform_topography():
+                topography.data = height
+
+            elapsed_time += timestep
+
+            if feedback is not None and step%feedback == 0 or step == steps:
+                if comm.rank == 0:
+                    print("{:05d} - t = {:.3g}".format(step, elapsed_time))
+
+        return steps, elapsed_time
@@ -1,7 +1,9 @@
 from .function_classes import LazyEvaluation, parameter, symbol, vector_field, convert
+from .function_classes import evaluation_context
 from . import math
 from . import misc
 from . import stats
+from . import compiler
 from . import coordinate_geometry as coordinates
 from . import coordinate_geometry as geometry
 
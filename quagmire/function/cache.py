@@ -0,0 +1,146 @@
+# Copyright 2016-2020 Louis Moresi, Ben Mather, Romain Beucher
+#
+# This file is part of Quagmire.
+#
+# Quagmire is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or any later version.
+#
+# Quagmire is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Quagmire.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Storage for the evaluation of lazy functions on a mesh.
+
+`FunctionCache` is a least recently used store in which each function keeps
+its last values together with the versions of the mesh variables and
+parameters they were computed from. The values are reused (and kept read
+only) until one of those versions changes; evaluate hands the caller a copy.
+
+`ScratchBuffers` is a pool of node arrays that are handed out for the
+intermediate values of an evaluation and reclaimed afterwards, so that
+repeated evaluations do not allocate new arrays.
+"""
+
+from collections import OrderedDict as _OrderedDict
+import numpy as _np
+
+
+class FunctionCache(object):
+    """
+    Values of lazy functions keyed by the function id, within a memory budget
+    of max_bytes (the least recently used values are dropped first).
+    """
+
+    def __init__(self, max_bytes):
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._values = _OrderedDict()
+
+        return
+
+
+    def __len__(self):
+        return len(self._values)
+
+
+    def get(self, fn_id, versions):
+        """ The stored values of fn_id if they were computed from these versions (otherwise None) """
+
+        entry = self._values.get(fn_id, None)
+
+        if entry is None or entry[0] != versions:
+            self.misses += 1
+            return None
+
+        self._values.move_to_end(fn_id)
+        self.hits += 1
+
+        return entry[1]
+
+
+    def put(self, fn_id, versions, values):
+        """ Store the values of fn_id and return a read only view of them """
+
+        self.discard(fn_id)
+
+        if not isinstance(values, _np.ndarray) or values.nbytes > self.max_bytes:
+            return values
+
+        view = values.view()
+        view.setflags(write=False)
+
+        self._values[fn_id] = (versions, view)
+        self.nbytes += view.nbytes
+
+        while self.nbytes > self.max_bytes:
+            old_id, (old_versions, old_values) = self._values.popitem(last=False)
+            self.nbytes -= old_values.nbytes
+
+        return view
+
+
+    def discard(self, fn_id):
+
+        entry = self._values.pop(fn_id, None)
+        if entry is not None:
+            self.nbytes -= entry[1].nbytes
+
+        return
+
+
+    def clear(self):
+
+        self._values.clear()
+        self.nbytes = 0
+
+        return
+
+
+class ScratchBuffers(object):
+    """
+    Pool of arrays of npoints values. get hands out a free array (or a new
+    one if there is none) and release returns it to the pool.
+    """
+
+    def __init__(self, npoints):
+
+        self.npoints = npoints
+        self._free = dict()
+
+        return
+
+
+    def __len__(self):
+        return sum(len(free) for free in self._free.values())
+
+
+    def get(self, dtype=float):
+
+        free = self._free.get(_np.dtype(dtype), None)
+        if free:
+            return free.pop()
+
+        return _np.empty(self.npoints, dtype=dtype)
+
+
+    def release(self, buffer):
+
+        self._free.setdefault(buffer.dtype, []).append(buffer)
+
+        return
+
+
+    def clear(self):
+
+        self._free.clear()
+
+        return
@@ -0,0 +1,299 @@
+# Copyright 2016-2020 Louis Moresi, Ben Mather, Romain Beucher
+#
+# This file is part of Quagmire.
+#
+# Quagmire is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or any later version.
+#
+# Quagmire is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Quagmire.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fuse the pointwise operations of a lazy function into a single kernel.
+
+The arithmetic, comparison, `math` and `where` nodes of the expression tree
+are gathered into one kernel. Every other node (mesh variables, gradients,
+upstream integrals ...) is a leaf that is evaluated as usual, and every
+`parameter` is a scalar input read when the kernel runs, so changing
+`parameter.value` does not need a new compile.
+
+The kernel is a numexpr expression if numexpr is installed, otherwise the
+operations are applied in blocks of nodes with buffers that are reused from
+block to block (and call to call) instead of allocating a full-size
+temporary for each node of the tree.
+"""
+
+import numpy as _np
+
+try:
+    import numexpr as _numexpr
+except:
+    _numexpr = None
+
+
+from .function_classes import _negative, _operand_values
+from .misc import _where
+
+
+## operation: (numpy function, numexpr format or None if numexpr has no equivalent)
+
+_operations = {
+    "+"  : (_np.add,           "({} + {})"),
+    "-"  : (_np.subtract,      "({} - {})"),
+    "*"  : (_np.multiply,      "({} * {})"),
+    "/"  : (_np.true_divide,   "({} / {})"),
+    "^"  : (_np.power,         "({} ** {})"),
+    "neg": (_negative,         "(-1.0 * {})"),
+    "<"  : (_np.less,          "({} < {})"),
+    "<=" : (_np.less_equal,    "({} <= {})"),
+    "==" : (_np.equal,         "({} == {})"),
+    "!=" : (_np.not_equal,     "({} != {})"),
+    ">=" : (_np.greater_equal, "({} >= {})"),
+    ">"  : (_np.greater,       "({} > {})"),
+    "where": (_where,          "where({} > 0.0, {}, {})"),
+}
+
+_numexpr_functions = {
+    _np.sin: "sin", _np.cos: "cos", _np.tan: "tan",
+    _np.arcsin: "arcsin", _np.arccos: "arccos", _np.arctan: "arctan",
+    _np.sinh: "sinh", _np.cosh: "cosh", _np.tanh: "tanh",
+    _np.arcsinh: "arcsinh", _np.arccosh: "arccosh", _np.arctanh: "arctanh",
+    _np.exp: "exp", _np.log: "log", _np.log10: "log10", _np.sqrt: "sqrt",
+    _np.fabs: "abs", _np.arctan2: "arctan2",
+}
+
+
+def _lookup(operation):
+    """ numpy function and numexpr format of an operation (None if it cannot be fused) """
+
+    if isinstance(operation, str):
+        return _operations.get(operation, None)
+
+    if isinstance(operation, _np.ufunc):
+        name = _numexpr_functions.get(operation, None)
+        if name is None:
+            return (operation, None)
+        return (operation, name + "(" + ", ".join(["{}"] * operation.nin) + ")")
+
+    return None
+
+
+class CompiledKernel(object):
+    """
+    The fused operations of a lazy function.
+
+    Attributes:
+        leaves      : the functions that are evaluated to give the inputs of the kernel
+        parameters  : the parameters that are read when the kernel is evaluated
+        instructions: (numpy function, input registers) of each operation. The
+                      registers are the leaves, then the parameters, then the results
+                      of the instructions
+        expression  : the numexpr expression (None if there is an operation that
+                      numexpr does not have)
+        backend     : "numexpr" or "numpy"
+    """
+
+    block_size = 4096
+
+    def __init__(self, lazyFn, backend=None):
+
+        from .function_classes import parameter
+
+        self.leaves = []
+        self.parameters = []
+        self.instructions = []
+
+        operations = []
+        register = dict()
+
+        # walk the tree once: shared subtrees become one register
+
+        def walk(node):
+            if id(node) in register:
+                return
+
+            if isinstance(node, parameter):
+                self.parameters.append(node)
+                register[id(node)] = None
+                return
+
+            operation = _lookup(getattr(node, "_operation", None))
+            if operation is None:
+                self.leaves.append(node)
+                register[id(node)] = None
+                return
+
+            for operand in node._operands:
+                walk(operand)
+
+            register[id(node)] = None
+            operations.append((node, operation))
+
+        walk(lazyFn)
+
+        for i, node in enumerate(self.leaves + self.parameters):
+            register[id(node)] = i
+
+        strings = ["v{}".format(i) for i in range(0, len(self.leaves))]
+        strings += ["p{}".format(i) for i in range(0, len(self.parameters))]
+
+        numexpr_ok = True
+
+        for node, (np_function, ne_format) in operations:
+            inputs = tuple(register[id(operand)] for operand in node._operands)
+            register[id(node)] = len(strings)
+            self.instructions.append((np_function, inputs))
+
+            if ne_format is None:
+                numexpr_ok = False
+                strings.append(None)
+            else:
+                strings.append(ne_format.format(*[strings[i] for i in inputs]) if numexpr_ok else None)
+
+        self.expression = strings[-1] if numexpr_ok else None
+
+        if backend is None:
+            backend = "numexpr" if (_numexpr is not None and self.expression is not None) else "numpy"
+
+        if backend == "numexpr":
+            if _numexpr is None:
+                raise ImportError("numexpr is not installed")
+            if self.expression is None:
+                raise ValueError("numexpr has no equivalent of some of the operations of {}".format(lazyFn.description))
+        elif backend != "numpy":
+            raise ValueError("Choose a valid backend: numexpr or numpy")
+
+        self.backend = backend
+        self._buffers = dict()
+
+        return
+
+
+    def __call__(self, *args, out=None, nodes=None, **kwargs):
+
+        values = [_np.asarray(v) for v in _operand_values(self.leaves, args, kwargs, nodes)]
+        parameter_values = [p.value for p in self.parameters]
+
+        # numexpr does not do arithmetic on booleans
+
+        if self.backend == "numexpr" and not any(v.dtype == bool for v in values):
+            local_dict = dict(("v{}".format(i), v) for i, v in enumerate(values))
+            local_dict.update(("p{}".format(i), p) for i, p in enumerate(parameter_values))
+            return _numexpr.evaluate(self.expression, local_dict=local_dict, out=out)
+
+        return self._evaluate_blocked(values, parameter_values, out)
+
+
+    def _evaluate_blocked(self, values, parameter_values, out=None):
+        """ Apply the instructions to blocks of the inputs (into out if given) """
+
+        if any(v.ndim > 1 for v in values) or all(v.ndim == 0 for v in values):
+            result = self._run(values + parameter_values, None)
+            if out is None:
+                return result
+            out[...] = result
+            return out
+
+        size = max(v.shape[0] for v in values if v.ndim == 1)
+        block = self.block_size
+
+        signature = tuple(v.dtype.str for v in values)
+        buffers = self._buffers.get(signature, None)
+
+        result = out
+
+        for start in range(0, size, block):
+            end = min(start + block, size)
+
+            registers = [v[start:end] if v.ndim == 1 and v.shape[0] == size else v for v in values]
+            registers += parameter_values
+
+            if buffers is None:
+                buffers = self._keep_buffers(registers, signature)
+
+            values_block = self._run(registers, [None if b is None else b[:end-start] for b in buffers])
+
+            if result is None:
+                result = _np.empty(size, dtype=values_block.dtype)
+
+            result[start:end] = values_block
+
+        return result
+
+
+    def _run(self, registers, buffers):
+
+        registers = list(registers)
+
+        for i, (function, inputs) in enumerate(self.instructions):
+            operands = [registers[j] for j in inputs]
+            if buffers is None or buffers[i] is None:
+                registers.append(function(*operands))
+            else:
+                registers.append(function(*operands, out=buffers[i]))
+
+        return registers[-1]
+
+
+    def _keep_buffers(self, registers, signature):
+        """ Block-sized buffers for the results of the instructions, from the types of a first block """
+
+        registers = list(registers)
+        buffers = []
+
+        for function, inputs in self.instructions:
+            value = _np.asarray(function(*[registers[j] for j in inputs]))
+            registers.append(value)
+
+            # operations of parameters only stay scalars
+            if value.ndim == 0:
+                buffers.append(None)
+            else:
+                buffers.append(_np.empty(self.block_size, dtype=value.dtype))
+
+        self._buffers[signature] = buffers
+
+        return buffers
+
+
+def compile(lazyFn, backend=None):
+    """
+    Compile the pointwise operations of a lazy function into one kernel (see
+    CompiledKernel). Returns an equivalent lazy function that evaluates the
+    kernel (or lazyFn itself if there is nothing to fuse).
+
+    backend is "numexpr" or "numpy" (by default numexpr if it is installed and
+    has all of the operations).
+    """
+
+    from .function_classes import LazyEvaluation, convert
+
+    lazyFn = convert(lazyFn)
+
+    kernel = CompiledKernel(lazyFn, backend=backend)
+
+    if len(kernel.instructions) == 0 or len(kernel.leaves) == 0:
+        return lazyFn
+
+    newLazyFn = LazyEvaluation()
+    newLazyFn.evaluate = kernel
+    newLazyFn.description = lazyFn.description
+    newLazyFn.latex = lazyFn.latex
+    newLazyFn.math = lazyFn.math
+    newLazyFn.exposed_operator = lazyFn.exposed_operator
+    newLazyFn.coordinate_system = lazyFn.coordinate_system
+    newLazyFn.derivative = lazyFn.derivative
+    newLazyFn.dependency_list |= lazyFn.dependency_list
+
+    # the compiled function can be fused into larger expressions
+    newLazyFn._operation = lazyFn._operation
+    newLazyFn._operands = lazyFn._operands
+    newLazyFn._kernel = kernel
+
+    return newLazyFn
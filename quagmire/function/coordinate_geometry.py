@@ -42,13 +42,15 @@ class CoordinateSystem2D(object):
         
         def extract_coord(dirn):
             
-            def parse_args(*args, **kwargs):
+            def parse_args(*args, nodes=None, **kwargs):
 
                 import quagmire
             
                 if len(args) == 1:
                     if  quagmire.mesh.check_object_is_a_q_mesh(args[0]):
                         mesh = args[0]
+                        if nodes is not None:
+                            return mesh.coords[nodes,dirn]
                         return mesh.coords[:,dirn]
                     else:
                         # coerce to np.array 
@@ -66,6 +68,7 @@ class CoordinateSystem2D(object):
         self.xi0.latex = r"\xi_0"
         self.xi0.math = lambda : self.xi0.latex
         self.xi0.derivative = lambda ddirn : _parameter(1.0) if str(ddirn) in '0' else _parameter(0.0)
+        self.xi0._depends_on = ()
     
         self.xi1 = _LazyEvaluation()
         self.xi1.evaluate = extract_coord(1)
@@ -73,6 +76,7 @@ class CoordinateSystem2D(object):
         self.xi1.latex = r"\xi_1"
         self.xi1.math = lambda : self.xi1.latex
         self.xi1.derivative = lambda ddirn : _parameter(1.0) if str(ddirn) in '1' else _parameter(0.0)
+        self.xi1._depends_on = ()
         
         self.xi = (self.xi0, self.xi1)
 
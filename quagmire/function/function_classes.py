@@ -18,6 +18,268 @@ import numpy as np
 import quagmire
 
 
+class _EvaluationContext(object):
+    """
+    Values of the functions evaluated within one top-level evaluate call,
+    keyed by the function id and the mesh they were evaluated on, so that
+    functions shared between the branches of an expression are evaluated
+    once. The values, and the scratch arrays borrowed to hold them, are
+    released when the outermost evaluate returns. evaluations counts the
+    evaluate calls in progress (the outermost one has none around it).
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.evaluations = 0
+        self.values = dict()
+        self.borrowed = dict()
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, *args):
+        self.depth -= 1
+        if self.depth == 0:
+            self.values.clear()
+            for pool, buffer in self.borrowed.values():
+                pool.release(buffer)
+            self.borrowed.clear()
+
+
+_context = _EvaluationContext()
+
+
+def evaluation_context():
+    """
+    Share the values of common functions between several evaluate calls, e.g.
+
+        with fn.evaluation_context():
+            dx = grad_x.evaluate(mesh)
+            s  = slope.evaluate(mesh)
+
+    computes the mesh gradient once. Any variables should not be modified
+    within the context.
+    """
+
+    return _context
+
+
+def _scratch(args):
+    """
+    A scratch node array from the pool of the mesh in args (None if the input
+    is not a mesh), held until the outermost evaluate returns
+    """
+
+    if len(args) != 1 or _context.depth == 0 or not quagmire.mesh.check_object_is_a_q_mesh(args[0]):
+        return None
+
+    pool = args[0].scratch_buffers
+    buffer = pool.get()
+    _context.borrowed[id(buffer)] = (pool, buffer)
+
+    return buffer
+
+
+def _node_indices(nodes):
+    """ nodes as an array of node indices (nodes may also be a boolean mask of the mesh nodes) """
+
+    nodes = np.asarray(nodes)
+    if nodes.dtype == bool:
+        return np.nonzero(nodes)[0]
+
+    return nodes
+
+
+def _operand_values(operands, args, kwargs, nodes=None):
+    """
+    Values of the operands of a pointwise operation. Parameters are used as
+    scalars (unless all of the operands are parameters), mesh variables as their
+    data and other functions are evaluated into scratch arrays of the mesh.
+    If nodes is given the operands are evaluated on those nodes only.
+    """
+
+    scalars = not all(isinstance(operand, parameter) for operand in operands)
+
+    values = []
+    for operand in operands:
+        if scalars and isinstance(operand, parameter):
+            values.append(operand.value)
+        elif nodes is not None:
+            values.append(operand.evaluate(*args, nodes=nodes, **kwargs))
+        elif getattr(operand, "mesh_data", False):
+            values.append(operand.evaluate(*args, **kwargs))
+        else:
+            buffer = _scratch(args)
+            if buffer is None:
+                values.append(operand.evaluate(*args, **kwargs))
+            else:
+                values.append(operand.evaluate(*args, out=buffer, **kwargs))
+
+    return values
+
+
+def _negative(values, out=None):
+    return np.multiply(-1.0, values, out=out)
+
+
+def _pointwise_evaluate(function, *operands):
+    """ evaluate of a node that applies function (a numpy ufunc or similar) to the values of operands """
+
+    def evaluate(*args, out=None, nodes=None, **kwargs):
+        return function(*_operand_values(operands, args, kwargs, nodes), out=out)
+
+    return evaluate
+
+
+def _accepts_keyword(evaluate, name):
+    """ Does this evaluate function take the keyword argument name (e.g. an out array) ? """
+
+    import inspect
+
+    try:
+        return name in inspect.signature(evaluate).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _cached_evaluate(lazyFn, evaluate, mesh, out):
+    """
+    Values of lazyFn on the nodes of mesh from the function cache of the mesh
+    if none of the variables and parameters it depends on have changed since
+    they were stored (see LazyEvaluation.dependency_versions). Values computed
+    into an out array belong to the caller and are not stored.
+    """
+
+    versions = lazyFn.dependency_versions()
+    cache = getattr(mesh, "_function_cache", None)
+
+    if versions is None or cache is None:
+        return evaluate((mesh,), {}, out)
+
+    values = cache.get(lazyFn.id, versions)
+    if values is None:
+        values = evaluate((mesh,), {}, out)
+        if out is None:
+            values = cache.put(lazyFn.id, versions, values)
+
+    return values
+
+
+def _memoised(lazyFn, evaluate):
+    """
+    Wrap evaluate to reuse its values on a mesh within the evaluation context,
+    to return them in an out array if one is given and to evaluate them on a
+    subset of the mesh nodes. Functions that cannot be evaluated on a subset
+    (e.g. upstream integrals) are evaluated on all of the nodes and indexed.
+    The values in the function cache are read only, so the outermost evaluate
+    returns a copy of them that the caller may modify.
+    """
+
+    fn_id = lazyFn.id
+    accepts_out = _accepts_keyword(evaluate, "out")
+    accepts_nodes = _accepts_keyword(evaluate, "nodes")
+
+    def evaluate_into(args, kwargs, out):
+        if out is not None and accepts_out:
+            return evaluate(*args, out=out, **kwargs)
+        return evaluate(*args, **kwargs)
+
+    def evaluate_nodes(args, kwargs, nodes):
+        if accepts_nodes and len(args) == 1 and quagmire.mesh.check_object_is_a_q_mesh(args[0]):
+            return evaluate(*args, nodes=nodes, **kwargs)
+
+        values = memo_evaluate(*args, **kwargs)
+        if np.ndim(values) == 0:
+            return np.full(nodes.shape[0], values)
+        return values[nodes]
+
+    def memo_evaluate(*args, out=None, nodes=None, **kwargs):
+
+        outermost = _context.evaluations == 0
+        _context.evaluations += 1
+
+        try:
+            values = memo_values(args, kwargs, out, nodes)
+        finally:
+            _context.evaluations -= 1
+
+        if outermost and isinstance(values, np.ndarray) and not values.flags.writeable:
+            values = values.copy()
+
+        return values
+
+    def memo_values(args, kwargs, out, nodes):
+
+        with _context:
+
+            if nodes is not None:
+                nodes = _node_indices(nodes)
+
+                if kwargs or len(args) != 1 or not quagmire.mesh.check_object_is_a_q_mesh(args[0]):
+                    values = evaluate_nodes(args, kwargs, nodes)
+                else:
+                    # the entry holds the nodes so that their id is not reused
+                    key = (fn_id, id(args[0]), id(nodes))
+                    if key in _context.values:
+                        values = _context.values[key][1]
+                    else:
+                        values = evaluate_nodes(args, kwargs, nodes)
+                        _context.values[key] = (nodes, values)
+
+            elif kwargs or len(args) > 1 or (len(args) == 1 and not quagmire.mesh.check_object_is_a_q_mesh(args[0])):
+                values = evaluate_into(args, kwargs, out)
+
+            else:
+                key = (fn_id, id(args[0]) if args else None)
+
+                if key in _context.values:
+                    values = _context.values[key]
+                else:
+                    if args:
+                        values = _cached_evaluate(lazyFn, evaluate_into, args[0], out)
+                    else:
+                        values = evaluate_into(args, kwargs, out)
+
+                    # values in the out array of the caller can change after we return
+                    if out is None or id(out) in _context.borrowed:
+                        _context.values[key] = values
+
+            if out is not None and values is not out and id(out) not in _context.borrowed:
+                out[...] = values
+                values = out
+
+        return values
+
+    return memo_evaluate
+
+
+def _versioned_dependencies(lazyFn):
+    """ The variables and parameters in the expression tree of lazyFn (None if it has other inputs) """
+
+    variables = dict()
+    stack = [lazyFn]
+
+    while stack:
+        node = stack.pop()
+
+        if hasattr(node, "version"):
+            variables[node.id] = node
+            continue
+
+        if getattr(node, "_operation", None) is not None:
+            operands = node._operands
+        else:
+            operands = getattr(node, "_depends_on", None)
+
+        if operands is None:
+            return None
+
+        stack.extend(operands)
+
+    return list(variables.values())
+
+
 class LazyEvaluation(object):
 
     __count = 0
@@ -40,8 +302,25 @@ class LazyEvaluation(object):
         self.math = lambda : self.latex
         self.coordinate_system = None
 
+        # operation and operands of the node in the expression tree (see compile)
+        self._operation = None
+        self._operands = ()
+
+        # functions that the values of a node without an operation are computed
+        # from (None if not known, in which case the values are never cached)
+        self._depends_on = None
+
         return
 
+    def __setattr__(self, name, value):
+
+        # evaluate functions of each node are memoised within one top-level evaluate
+
+        if name == "evaluate" and callable(value):
+            value = _memoised(self, value)
+
+        super(LazyEvaluation, self).__setattr__(name, value)
+
     def __repr__(self):
         return("quagmire.fn: {}".format(self.description))
 
@@ -94,6 +373,41 @@ class LazyEvaluation(object):
     def evaluate(self, *args, **kwargs):
         raise(NotImplementedError)
 
+    def dependency_versions(self):
+        """
+        The (id, version) of each mesh variable and parameter that the values
+        of this function are computed from, or None if the function also depends
+        on something without a version (its values are then not cached).
+        """
+
+        try:
+            variables = self._versioned_variables
+        except AttributeError:
+            variables = _versioned_dependencies(self)
+            self._versioned_variables = variables
+
+        if variables is None:
+            return None
+
+        return tuple((v.id, v.version) for v in variables)
+
+    def compile(self, backend=None):
+        """
+        Fuse the arithmetic, comparison and math operations of this function
+        into a single kernel (numexpr if available, otherwise blocked numpy
+        with reused buffers). Parameters are read each time the compiled
+        function is evaluated, so changing their values does not require
+        compiling again.
+
+        Returns
+        -------
+
+        LazyEvaluation function with the same values as this one.
+        """
+
+        from .compiler import compile
+        return compile(self, backend=backend)
+
     @property
     def description(self):
         return self._description
@@ -165,13 +479,15 @@ class LazyEvaluation(object):
         # Will handle things like float / int combined with lazy operation (or define rmul, rsub etc )
  
         newLazyFn = LazyEvaluation()
-        newLazyFn.evaluate = lambda *args, **kwargs : self.evaluate(*args, **kwargs) * other.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(np.multiply, self, other)
         newLazyFn.description = fstring.format(self.description, other.description)
         newLazyFn.latex       = lstring.format(self.latex, other.latex)
         newLazyFn.math        = lambda : lstring.format(self.math(), other.math() )
         
         newLazyFn.dependency_list |= self.dependency_list | other.dependency_list
         newLazyFn.exposed_operator = "*"
+        newLazyFn._operation = "*"
+        newLazyFn._operands = (self, other)
 
         newLazyFn.derivative = lambda dirn : self.derivative (dirn) * other +  \
                                               self * other.derivative(dirn) 
@@ -225,13 +541,15 @@ class LazyEvaluation(object):
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.compatible_coordinate_system(other)
 
-        newLazyFn.evaluate = lambda *args, **kwargs : self.evaluate(*args, **kwargs) + other.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(np.add, self, other)
         newLazyFn.description = "{} + {}".format(self.description, other.description)
         newLazyFn.latex       = "{} + {}".format(self.latex, other.latex)
         newLazyFn.math        = lambda : r"{} \, + \, {}".format(self.math(), other.math() )
 
         newLazyFn.dependency_list |= self.dependency_list | other.dependency_list
         newLazyFn.exposed_operator = "+"
+        newLazyFn._operation = "+"
+        newLazyFn._operands = (self, other)
 
         newLazyFn.derivative = lambda dirn : self.derivative(dirn) + other.derivative(dirn)
 
@@ -277,13 +595,15 @@ class LazyEvaluation(object):
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.compatible_coordinate_system(other)
 
-        newLazyFn.evaluate = lambda *args, **kwargs : self.evaluate(*args, **kwargs) / other.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(np.true_divide, self, other)
         newLazyFn.description = "({})/({})".format(self.description, other.description)
         newLazyFn.latex = r"\frac{{ {} }}{{ {}  }}".format(self.latex, other.latex)
         newLazyFn.math  = lambda : r"\frac{{ {} }}{{ {}  }}".format(self.math(), other.math())
 
         newLazyFn.dependency_list |= self.dependency_list | other.dependency_list
         newLazyFn.exposed_operator = "/"
+        newLazyFn._operation = "/"
+        newLazyFn._operands = (self, other)
 
         newLazyFn.derivative = lambda dirn : -1.0 *  self * other.derivative(dirn) / (other * other) + self.derivative(dirn) / other
 
@@ -322,13 +642,15 @@ class LazyEvaluation(object):
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.compatible_coordinate_system(other)
 
-        newLazyFn.evaluate = lambda *args, **kwargs : self.evaluate(*args, **kwargs) - other.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(np.subtract, self, other)
         newLazyFn.description = "{} - {}".format(self.description, other.description)
         newLazyFn.latex       = "{} - {}".format(self.latex, other.latex)
         newLazyFn.math  = lambda : "{} - {}".format(self.math(), other.math())
 
         newLazyFn.dependency_list |= self.dependency_list | other.dependency_list
         newLazyFn.exposed_operator = "-"
+        newLazyFn._operation = "-"
+        newLazyFn._operands = (self, other)
 
         newLazyFn.derivative = lambda dirn : self.derivative(dirn) - other.derivative(dirn)
 
@@ -366,13 +688,15 @@ class LazyEvaluation(object):
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.coordinate_system
 
-        newLazyFn.evaluate = lambda *args, **kwargs : -1.0 * self.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(_negative, self)
         newLazyFn.description = "-{}".format(self.description)
         newLazyFn.latex       = "-{}".format(self.latex)
         newLazyFn.math = lambda : "-{}".format(self.math())
 
         newLazyFn.dependency_list |= self.dependency_list
         newLazyFn.exposed_operator = "S"
+        newLazyFn._operation = "neg"
+        newLazyFn._operands = (self,)
 
         newLazyFn.derivative = lambda dirn : -1.0 * self.derivative(dirn)
 
@@ -396,12 +720,14 @@ class LazyEvaluation(object):
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.coordinate_system
 
-        newLazyFn.evaluate = lambda *args, **kwargs : np.power(self.evaluate(*args, **kwargs), exponent.evaluate(*args, **kwargs))
+        newLazyFn.evaluate = _pointwise_evaluate(np.power, self, exponent)
         newLazyFn.description = fstring.format(self.description, exponent.description)
         newLazyFn.latex       = lstring.format(self.latex, exponent.latex)
         newLazyFn.math = lambda : lstring.format(self.math(), exponent.math())
         newLazyFn.dependency_list |= self.dependency_list | exponent.dependency_list
         newLazyFn.exposed_operator = "^"
+        newLazyFn._operation = "^"
+        newLazyFn._operands = (self, exponent)
 
         newLazyFn.derivative = lambda dirn : exponent * self.derivative(dirn) * (self) ** (exponent-parameter(1.0))
         
@@ -417,54 +743,66 @@ class LazyEvaluation(object):
         other = self.convert(other)
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.compatible_coordinate_system(other)
-        newLazyFn.evaluate = lambda *args, **kwargs : self.evaluate(*args, **kwargs) < other.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(np.less, self, other)
         newLazyFn.description = "({})<({})".format(self.description, other.description)
         newLazyFn.dependency_list |= self.dependency_list | other.dependency_list
+        newLazyFn._operation = "<"
+        newLazyFn._operands = (self, other)
         return newLazyFn
 
     def __le__(self, other):
         other = self.convert(other)
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.compatible_coordinate_system(other)
-        newLazyFn.evaluate = lambda *args, **kwargs : self.evaluate(*args, **kwargs) <= other.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(np.less_equal, self, other)
         newLazyFn.description = "({})<=({})".format(self.description, other.description)
         newLazyFn.dependency_list |= self.dependency_list | other.dependency_list
+        newLazyFn._operation = "<="
+        newLazyFn._operands = (self, other)
         return newLazyFn
 
     def __eq__(self, other):
         other = self.convert(other)
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.compatible_coordinate_system(other)
-        newLazyFn.evaluate = lambda *args, **kwargs : self.evaluate(*args, **kwargs) == other.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(np.equal, self, other)
         newLazyFn.description = "({})==({})".format(self.description, other.description)
         newLazyFn.dependency_list |= self.dependency_list | other.dependency_list
+        newLazyFn._operation = "=="
+        newLazyFn._operands = (self, other)
         return newLazyFn
     
     def __ne__(self, other):
         other = self.convert(other)
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.compatible_coordinate_system(other)
-        newLazyFn.evaluate = lambda *args, **kwargs : self.evaluate(*args, **kwargs) != other.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(np.not_equal, self, other)
         newLazyFn.description = "({})!=({})".format(self.description, other.description)
         newLazyFn.dependency_list |= self.dependency_list | other.dependency_list
+        newLazyFn._operation = "!="
+        newLazyFn._operands = (self, other)
         return newLazyFn
 
     def __ge__(self, other):
         other = self.convert(other)
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.compatible_coordinate_system(other)
-        newLazyFn.evaluate = lambda *args, **kwargs : self.evaluate(*args, **kwargs) >= other.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(np.greater_equal, self, other)
         newLazyFn.description = "({})>=({})".format(self.description, other.description)
         newLazyFn.dependency_list |= self.dependency_list | other.dependency_list
+        newLazyFn._operation = ">="
+        newLazyFn._operands = (self, other)
         return newLazyFn
     
     def __gt__(self, other):
         other = self.convert(other)
         newLazyFn = LazyEvaluation()
         newLazyFn.coordinate_system = self.compatible_coordinate_system(other)
-        newLazyFn.evaluate = lambda *args, **kwargs : self.evaluate(*args, **kwargs) > other.evaluate(*args, **kwargs)
+        newLazyFn.evaluate = _pointwise_evaluate(np.greater, self, other)
         newLazyFn.description = "({})>({})".format(self.description, other.description)
         newLazyFn.dependency_list |= self.dependency_list | other.dependency_list
+        newLazyFn._operation = ">"
+        newLazyFn._operands = (self, other)
         return newLazyFn
         
 
@@ -553,24 +891,38 @@ class parameter(LazyEvaluation):
     def value(self):
         return self._value
 
+    @property
+    def version(self):
+        """ Incremented whenever the value is set """
+        return self._version
+
     @value.setter
     def value(self, value):
+        self._version = getattr(self, "_version", 0) + 1
         self._value = float(value)
         self.description = "{:.3g}".format(  int(self._value) if self._value.is_integer() else self._value)
         self.latex = self.description
 
-    def evaluate(self, *args, **kwargs):
+    def evaluate(self, *args, out=None, nodes=None, **kwargs):
 
         if len(args) == 1:
             if quagmire.mesh.check_object_is_a_q_mesh(args[0]):
                 mesh = args[0]
+                if out is not None:
+                    out.fill(self.value)
+                    return out
+                if nodes is not None:
+                    return self.value * np.ones(_node_indices(nodes).shape[0])
                 return self.value * np.ones(mesh.npoints)
             else: # could be a tuple or a single np.array object
                 coords = np.array(args[0]).reshape(-1, 2)
-                return np.ones_like(coords[:,0]) * self.value
         else:  # see if args can be interpreted in the form of coordinate pairs
                 coords = np.array(args).reshape(-1, 2)
-                return np.ones_like(coords[:,0]) * self.value
+
+        if nodes is not None:
+            coords = coords[_node_indices(nodes)]
+
+        return np.ones_like(coords[:,0]) * self.value
  
 
     def derivative(self, *args, **kwargs):
@@ -616,7 +968,10 @@ class vector_field(tuple, LazyEvaluation):
     
     def evaluate(self, *args, **kwargs):
 
-        return ( self[0].evaluate(*args, **kwargs), self[1].evaluate(*args, **kwargs))
+        # the components often share functions (e.g. the mesh gradient)
+
+        with _context:
+            return ( self[0].evaluate(*args, **kwargs), self[1].evaluate(*args, **kwargs))
 
     def derivative(self, dirn, expand=False):
 
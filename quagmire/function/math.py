@@ -20,6 +20,7 @@ import numpy as _np
 from .function_classes import LazyEvaluation as _LazyEvaluation
 from .function_classes import parameter as _parameter 
 from .function_classes import convert as _convert
+from .function_classes import _pointwise_evaluate
 
 
 ## Functions of a single variable
@@ -28,12 +29,14 @@ def _make_npmath_op(op, name, lazyFn, lformat):
     lazyFn = _convert(lazyFn)
     newLazyFn = _LazyEvaluation()
     newLazyFn.coordinate_system = lazyFn.coordinate_system
-    newLazyFn.evaluate = lambda *args, **kwargs : op(lazyFn.evaluate(*args, **kwargs))
+    newLazyFn.evaluate = _pointwise_evaluate(op, lazyFn)
     newLazyFn.description = "{}({})".format(name,lazyFn.description)
     newLazyFn.latex = lformat.format(lazyFn.latex)
     newLazyFn.math  = lambda : lformat.format(lazyFn.math())
 
     newLazyFn.dependency_list = lazyFn.dependency_list
+    newLazyFn._operation = op
+    newLazyFn._operands = (lazyFn,)
     return newLazyFn
 
 ## Trig
@@ -184,11 +187,6 @@ def deg2rad(lazyFn):
 
 def hypot(*args):
     """Lazy evaluation of hypot operator on N fields"""
-    def _hyp(lazyFn_list, *args, **kwargs):
-        lazy_ev = []
-        for lazyFn in lazyFn_list:
-            lazy_ev.append( lazyFn.evaluate(*args, **kwargs) )
-        return _np.hypot(*lazy_ev)
     lazyFn_list = []
     lazyFn_description = ""
     lazyFn_dependency = set()
@@ -199,20 +197,17 @@ def hypot(*args):
     lazyFn_description = lazyFn_description[:-3]
 
     newLazyFn = _LazyEvaluation()
-    newLazyFn.evaluate = lambda *args, **kwargs : _hyp(lazyFn_list, *args, **kwargs)
+    newLazyFn.evaluate = _pointwise_evaluate(_np.hypot, *lazyFn_list)
     newLazyFn.description = "sqrt({})".format(lazyFn_description)
     newLazyFn.dependency_list = lazyFn_dependency
+    newLazyFn._operation = _np.hypot
+    newLazyFn._operands = tuple(lazyFn_list)
 
     return newLazyFn
 
 
 def arctan2(*args):
     """Lazy evaluation of arctan2 operator on N fields"""
-    def _arctan2(lazyFn_list, *args, **kwargs):
-        lazy_ev = []
-        for lazyFn in lazyFn_list:
-            lazy_ev.append( lazyFn.evaluate(*args, **kwargs) )
-        return _np.arctan2(*lazy_ev)
     lazyFn_list = []
     lazyFn_description = ""
     lazyFn_dependency = set()
@@ -223,9 +218,11 @@ def arctan2(*args):
     lazyFn_description = lazyFn_description[:-1]
 
     newLazyFn = _LazyEvaluation()
-    newLazyFn.evaluate = lambda *args, **kwargs : _arctan2(lazyFn_list, *args, **kwargs)
+    newLazyFn.evaluate = _pointwise_evaluate(_np.arctan2, *lazyFn_list)
     newLazyFn.description = "arctan2({})".format(lazyFn_description)
     newLazyFn.dependency_list = lazyFn_dependency
+    newLazyFn._operation = _np.arctan2
+    newLazyFn._operands = tuple(lazyFn_list)
 
     return newLazyFn
 
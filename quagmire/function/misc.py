@@ -20,11 +20,12 @@ import numpy as _np
 import quagmire
 from .function_classes import LazyEvaluation as _LazyEvaluation
 from .function_classes import parameter as _parameter 
+from .function_classes import _pointwise_evaluate
 
 
 def coord(dirn):
 
-    def extract_xs(*args, **kwargs):
+    def extract_xs(*args, nodes=None, **kwargs):
         """ If a mesh, return the coords at the nodes of that mesh
         In all other cases pass through the coordinates given.
         Valid format for coordinates is anything that can be coerced into 
@@ -34,6 +35,8 @@ def coord(dirn):
         if len(args) == 1:
             if  quagmire.mesh.check_object_is_a_q_mesh(args[0]):
                 mesh = args[0]
+                if nodes is not None:
+                    return mesh.coords[nodes,0]
                 return mesh.coords[:,0]
             else:
                 # coerce to np.array 
@@ -42,7 +45,7 @@ def coord(dirn):
         else:
             return args[0]
 
-    def extract_ys(*args, **kwargs):
+    def extract_ys(*args, nodes=None, **kwargs):
         """ If no arguments or the argument is the mesh, return the
             coords at the nodes. In all other cases pass through the
             coordinates given """
@@ -50,6 +53,8 @@ def coord(dirn):
         if len(args) == 1:
             if  quagmire.mesh.check_object_is_a_q_mesh(args[0]):
                 mesh = args[0]
+                if nodes is not None:
+                    return mesh.coords[nodes,1]
                 return mesh.coords[:,1]
             else:
                 # coerce to np.array 
@@ -64,6 +69,7 @@ def coord(dirn):
     newLazyFn_xs.latex = r"\xi_0"
     newLazyFn_xs.math = lambda : newLazyFn_xs.latex
     newLazyFn_xs.derivative = lambda ddirn : _parameter(1.0) if str(ddirn) in '0' else _parameter(0.0)
+    newLazyFn_xs._depends_on = ()
 
     newLazyFn_ys = _LazyEvaluation()
     newLazyFn_ys.evaluate = extract_ys
@@ -71,6 +77,7 @@ def coord(dirn):
     newLazyFn_ys.latex = r"\xi_1"
     newLazyFn_ys.math = lambda : newLazyFn_ys.latex
     newLazyFn_ys.derivative = lambda ddirn : _parameter(1.0) if str(ddirn) in '1' else _parameter(0.0)
+    newLazyFn_ys._depends_on = ()
 
     if dirn == 0:
         return newLazyFn_xs
@@ -158,6 +165,17 @@ def replaceNan(lazyFn1, lazyFn2):
     return newLazyFn
 
 
+def _where(mask, values1, values2, out=None):
+    """ values1 where mask > 0 otherwise values2 (in out if given) """
+
+    if out is None:
+        return _np.where(mask > 0.0, values1, values2)
+
+    out[...] = values2
+    _np.copyto(out, values1, where=mask > 0.0)
+    return out
+
+
 # ToDo - add derivative 
 def where(maskFn, lazyFn1, lazyFn2):
 
@@ -165,20 +183,14 @@ def where(maskFn, lazyFn1, lazyFn2):
     lazyFn1 = _LazyEvaluation.convert(lazyFn1)
     lazyFn2 = _LazyEvaluation.convert(lazyFn2)
 
-    def mask_nodebynode(*args, **kwargs):
-        values1     = lazyFn1.evaluate(*args, **kwargs)
-        values2     = lazyFn2.evaluate(*args, **kwargs)
-        mask_values = maskFn.evaluate(*args, **kwargs)
-
-        replaced_values  = _np.where(mask_values > 0.0, values1, values2)
-        return replaced_values
-
     newLazyFn = _LazyEvaluation()
-    newLazyFn.evaluate = mask_nodebynode
+    newLazyFn.evaluate = _pointwise_evaluate(_where, maskFn, lazyFn1, lazyFn2)
     newLazyFn.description = "where({}: [{}]<-[{}])".format(maskFn.description, lazyFn1.description, lazyFn2.description)
     newLazyFn.latex = r"\left\{{{} \textrm{{ if}} \; {} \textrm{{> 0; else}} \;\; {}\right\}}".format(lazyFn1.latex, maskFn.latex, lazyFn2.latex)
 
     newLazyFn.dependency_list = maskFn.dependency_list | lazyFn1.dependency_list | lazyFn2.dependency_list
+    newLazyFn._operation = "where"
+    newLazyFn._operands = (maskFn, lazyFn1, lazyFn2)
 
     newLazyFn.derivative = lambda dirn: where(maskFn, lazyFn1.derivative(dirn), lazyFn2.derivative(dirn))
 
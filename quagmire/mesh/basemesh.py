@@ -87,10 +87,10 @@ class MeshFunction(_LazyEvaluation):
             self.latex = self.description
 
 
-    def evaluate(self, input=None, **kwargs):
+    def evaluate(self, input=None, nodes=None, **kwargs):
         """
-        If the argument is a mesh, return the values at the nodes.
-        In all other cases call the `interpolate` method.
+        If the argument is a mesh, return the values at the nodes (or at the
+        given subset of nodes). In all other cases call the `interpolate` method.
 
         But note the way that interpolate calls this method with the mesh to 
         get values at the mesh nodes - this needs to be implemented correctly or 
@@ -112,7 +112,7 @@ class MeshFunction(_LazyEvaluation):
                                   quagmire.mesh.pixmesh.PixMesh,
                                   quagmire.mesh.strimesh.sTriMesh)):
                 if input == self._mesh:
-                    return array
+                    return array if nodes is None else array[nodes]
                 else:
                     return self._interpolate(input.coords[:,0], input.coords[:,1], **kwargs)
 
@@ -167,6 +167,48 @@ class MeshFunction(_LazyEvaluation):
 
 
 
+    def _gradient_values_fn(self):
+        """
+        (Lazy) mesh gradient of shape (n,2) on the nodes of this mesh. The
+        component and slope functions all evaluate this one node so that
+        the gradient is computed once per evaluation (see fn.evaluation_context).
+        On a subset of the nodes this function is evaluated on their stencil
+        (see derivative_grad_stencil).
+        """
+
+        try:
+            return self.__gradient_values_fn
+        except AttributeError:
+            pass
+
+        diff_mesh = self._mesh
+
+        def gradient_values(*args, nodes=None, **kwargs):
+            if nodes is None:
+                local_array = self.evaluate(diff_mesh)
+                return diff_mesh.derivative_grad(local_array, nit=10, tol=1e-8)
+
+            # only the values on the stencil of the nodes are needed
+
+            stencil = diff_mesh.derivative_grad_stencil(nodes)
+            if stencil is None:
+                return newLazyFn.evaluate(diff_mesh)[nodes]
+
+            local_array = np.zeros(diff_mesh.npoints)
+            local_array[stencil] = self.evaluate(diff_mesh, nodes=stencil)
+            return diff_mesh.derivative_grad_nodes(local_array, nodes)
+
+        newLazyFn = _LazyEvaluation()
+        newLazyFn.evaluate = gradient_values
+        newLazyFn.description = "grad({})".format(self.description)
+        newLazyFn.dependency_list |= self.dependency_list
+        newLazyFn._depends_on = (self,)
+
+        self.__gradient_values_fn = newLazyFn
+
+        return newLazyFn
+
+
     def derivative(self, dirn):
         """Numerical derivative on the mesh - Note this is the derivative rather than the
         gradient for a curvilinear mesh - hence the companion derivative_grad function"""
@@ -174,31 +216,31 @@ class MeshFunction(_LazyEvaluation):
         import quagmire
 
         diff_mesh = self._mesh
+        gradient_fn = self._gradient_values_fn()
 
-        def new_fn_x(*args, **kwargs):
-            local_array = self.evaluate(diff_mesh)
-            dxy = diff_mesh.derivative_grad(local_array, nit=10, tol=1e-8)
-
+        def new_fn_x(*args, nodes=None, **kwargs):
             if len(args) == 1 and args[0] is diff_mesh:
-                return dxy[:,0]
+                return gradient_fn.evaluate(diff_mesh, nodes=nodes)[:,0]
 
-            elif len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, quagmire.mesh.pixmesh.PixMesh) ):
-                mesh = args[0]
-                return diff_mesh.interpolate(mesh.coords[:,0], mesh.coords[:,1], zdata=dxy[:,0], **kwargs)
+            dxy = gradient_fn.evaluate(diff_mesh)
+
+            if len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, quagmire.mesh.pixmesh.PixMesh) ):
+                coords = args[0].coords if nodes is None else args[0].coords[nodes]
+                return diff_mesh.interpolate(coords[:,0], coords[:,1], zdata=dxy[:,0], **kwargs)
             else:
                 coords = np.array(args).reshape(-1,2)
                 i, ierr = diff_mesh.interpolate(coords[:,0], coords[:,1], zdata=dxy[:,0])
                 return i
 
-        def new_fn_y(*args, **kwargs):
-            local_array = self.evaluate(diff_mesh)
-            dxy = diff_mesh.derivative_grad(local_array, nit=10, tol=1e-8)
-
+        def new_fn_y(*args, nodes=None, **kwargs):
             if len(args) == 1 and args[0] is diff_mesh:
-                return dxy[:,1]
-            elif len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, quagmire.mesh.pixmesh.PixMesh) ):
-                mesh = args[0]
-                return diff_mesh.interpolate(mesh.coords[:,0], mesh.coords[:,1], zdata=dxy[:,1], **kwargs)
+                return gradient_fn.evaluate(diff_mesh, nodes=nodes)[:,1]
+
+            dxy = gradient_fn.evaluate(diff_mesh)
+
+            if len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, quagmire.mesh.pixmesh.PixMesh) ):
+                coords = args[0].coords if nodes is None else args[0].coords[nodes]
+                return diff_mesh.interpolate(coords[:,0], coords[:,1], zdata=dxy[:,1], **kwargs)
             else:
                 coords = np.array(args).reshape(-1,2)
                 i, ierr = diff_mesh.interpolate(coords[:,0], coords[:,1], zdata=dxy[:,1])
@@ -209,12 +251,14 @@ class MeshFunction(_LazyEvaluation):
         newLazyFn_dx.description = "d({})/d0".format(self.description)
         newLazyFn_dx.latex = r"\frac{{ \partial }}{{\partial \xi_0}}{}".format(self.latex)
         newLazyFn_dx.exposed_operator = "d"
+        newLazyFn_dx._depends_on = (gradient_fn,)
 
         newLazyFn_dy = MeshFunction(name="ddx1-"+self._name, mesh=self._mesh)
         newLazyFn_dy.evaluate = new_fn_y
         newLazyFn_dy.description = "d({})/dY".format(self.description)
         newLazyFn_dy.latex = r"\frac{{\partial}}{{\partial \xi_1}}{}".format(self.latex)
         newLazyFn_dy.exposed_operator = "d"
+        newLazyFn_dy._depends_on = (gradient_fn,)
 
 
         if dirn == 0:
@@ -244,45 +288,46 @@ class MeshFunction(_LazyEvaluation):
         import quagmire
 
         diff_mesh = self._mesh
+        gradient_fn = self._gradient_values_fn()
 
-        def new_fn_x(*args, **kwargs):
-            local_array = self.evaluate(diff_mesh)
-            dxy = diff_mesh.derivative_grad(local_array, nit=10, tol=1e-8)
-
+        def new_fn_x(*args, nodes=None, **kwargs):
             if len(args) == 1 and args[0] is diff_mesh:
-                return dxy[:,0]
+                return gradient_fn.evaluate(diff_mesh, nodes=nodes)[:,0]
 
-            elif len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, quagmire.mesh.pixmesh.PixMesh) ):
-                mesh = args[0]
-                return diff_mesh.interpolate(mesh.coords[:,0], mesh.coords[:,1], zdata=dxy[:,0], **kwargs)
+            dxy = gradient_fn.evaluate(diff_mesh)
+
+            if len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, quagmire.mesh.pixmesh.PixMesh) ):
+                coords = args[0].coords if nodes is None else args[0].coords[nodes]
+                return diff_mesh.interpolate(coords[:,0], coords[:,1], zdata=dxy[:,0], **kwargs)
             else:
                 coords = np.array(args).reshape(-1,2)
                 i, ierr = diff_mesh.interpolate(coords[:,0], coords[:,1], zdata=dxy[:,0])
                 return i
 
-        def new_fn_y(*args, **kwargs):
-            local_array = self.evaluate(diff_mesh)
-            dxy = diff_mesh.derivative_grad(local_array, nit=10, tol=1e-8)
-
+        def new_fn_y(*args, nodes=None, **kwargs):
             if len(args) == 1 and args[0] is diff_mesh:
-                return dxy[:,1]
-            elif len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, quagmire.mesh.pixmesh.PixMesh) ):
-                mesh = args[0]
-                return diff_mesh.interpolate(mesh.coords[:,0], mesh.coords[:,1], zdata=dxy[:,1], **kwargs)
+                return gradient_fn.evaluate(diff_mesh, nodes=nodes)[:,1]
+
+            dxy = gradient_fn.evaluate(diff_mesh)
+
+            if len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, quagmire.mesh.pixmesh.PixMesh) ):
+                coords = args[0].coords if nodes is None else args[0].coords[nodes]
+                return diff_mesh.interpolate(coords[:,0], coords[:,1], zdata=dxy[:,1], **kwargs)
             else:
                 coords = np.array(args).reshape(-1,2)
                 i, ierr = diff_mesh.interpolate(coords[:,0], coords[:,1], zdata=dxy[:,1])
                 return i
 
-        def new_fn_slope(*args, **kwargs):
-            local_array = self.evaluate(diff_mesh)
-            dxy = diff_mesh.derivative_grad(local_array, nit=10, tol=1e-8)
-
+        def new_fn_slope(*args, out=None, nodes=None, **kwargs):
             if len(args) == 1 and args[0] is diff_mesh:
-                return np.hypot(dxy[:,0], dxy[:,1])
-            elif len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, quagmire.mesh.pixmesh.PixMesh) ):
-                mesh = args[0]
-                return diff_mesh.interpolate(mesh.coords[:,0], mesh.coords[:,1], zdata=np.hypot(dxy[:,0], dxy[:,1]), **kwargs)
+                dxy = gradient_fn.evaluate(diff_mesh, nodes=nodes)
+                return np.hypot(dxy[:,0], dxy[:,1], out=out)
+
+            dxy = gradient_fn.evaluate(diff_mesh)
+
+            if len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, quagmire.mesh.pixmesh.PixMesh) ):
+                coords = args[0].coords if nodes is None else args[0].coords[nodes]
+                return diff_mesh.interpolate(coords[:,0], coords[:,1], zdata=np.hypot(dxy[:,0], dxy[:,1]), **kwargs)
             else:
                 coords = np.array(args).reshape(-1,2)
                 i, ierr = diff_mesh.interpolate(coords[:,0], coords[:,1], zdata=np.hypot(dxy[:,0], dxy[:,1]))
@@ -294,6 +339,7 @@ class MeshFunction(_LazyEvaluation):
         newLazyFn_dx.description = "grad({})|x0".format(self.description)
         newLazyFn_dx.latex = r"\left. \nabla({})\right|_0".format(self.latex)
         newLazyFn_dx.exposed_operator = "S"
+        newLazyFn_dx._depends_on = (gradient_fn,)
 
         newLazyFn_dy = MeshFunction(name="grad1-"+self._name, mesh=self._mesh)
         newLazyFn_dy.coordinate_system = self._mesh.coordinate_system
@@ -301,6 +347,7 @@ class MeshFunction(_LazyEvaluation):
         newLazyFn_dy.description = "grad({})|x1".format(self.description)
         newLazyFn_dy.latex = r"\left. \nabla({})\right|_1".format(self.latex)
         newLazyFn_dy.exposed_operator = "S"
+        newLazyFn_dy._depends_on = (gradient_fn,)
 
         newLazyFn_slope = MeshFunction(name="slope-"+self._name, mesh=self._mesh)
         newLazyFn_slope.coordinate_system = self._mesh.coordinate_system
@@ -308,6 +355,7 @@ class MeshFunction(_LazyEvaluation):
         newLazyFn_slope.description = "slope({})".format(self.description)
         newLazyFn_slope.latex = r"\left| \nabla {} \right|".format(self.latex)
         newLazyFn_slope.exposed_operator = "S"
+        newLazyFn_slope._depends_on = (gradient_fn,)
 
 
         if dirn == 0:
@@ -339,6 +387,9 @@ class MeshVariable(MeshFunction):
         self._locked = locked
         self.mesh_data = True
 
+        # incremented whenever the data change (see version)
+        self._version = 0
+
         # mesh variable vector
         self._ldata = self._dm.createLocalVector()
         self._ldata.setName(name)
@@ -380,6 +431,15 @@ class MeshVariable(MeshFunction):
 
         return new_mesh_variable
 
+    @property
+    def version(self):
+        """
+        Data version: incremented when the data are set, loaded or synchronised
+        (and for the topography when the mesh is deformed). Functions of this
+        variable keep their values until the version changes.
+        """
+        return self._version
+
     def lock(self):
         self._locked = True
 
@@ -408,9 +468,15 @@ class MeshVariable(MeshFunction):
         # updated
 
 # if self._locked:
-        view = self._ldata.array[:]
-        view.setflags(write=False)
-        return view
+
+        # the view is kept (the array of the vector does not move)
+        try:
+            return self._data_view
+        except AttributeError:
+            view = self._ldata.array[:]
+            view.setflags(write=False)
+            self._data_view = view
+            return view
 
 #        else:
 #            return self._ldata.array
@@ -428,6 +494,8 @@ class MeshVariable(MeshFunction):
         else:
             self._ldata.setArray(val)
 
+        self._version += 1
+
 
 
     ## For printing and other introspection we actually want to look through to the
@@ -470,6 +538,8 @@ class MeshVariable(MeshFunction):
 
         self._dm.restoreGlobalVec(gdata)
 
+        self._version += 1
+
         return
 
 
@@ -574,6 +644,8 @@ class MeshVariable(MeshFunction):
         self._dm.globalToLocal(gdata, self._ldata)
         self._dm.restoreGlobalVec(gdata)
 
+        self._version += 1
+
 
     def load_from_cloud_fs(self, cloud_hdf5_filename, cloud_location_handle=None, name=None):
         """
@@ -634,6 +706,8 @@ class MeshVariable(MeshFunction):
         self._dm.globalToLocal(gdata, self._ldata)
         self._dm.restoreGlobalVec(gdata)
 
+        self._version += 1
+
         return
 
 
@@ -672,6 +746,8 @@ class MeshVariable(MeshFunction):
         self._dm.globalToLocal(gdata, self._ldata)
         self._dm.restoreGlobalVec(gdata)
 
+        self._version += 1
+
         return
 
     def derivative(self, dirn):
@@ -750,26 +826,36 @@ class MeshVariable(MeshFunction):
             return i
 
 
-    def evaluate(self, *args, **kwargs):
+    def evaluate(self, *args, out=None, nodes=None, **kwargs):
         """
         If the argument is a mesh, return the values at the nodes.
         In all other cases call the `interpolate` method.
+
+        If out is given the values are copied into it. If nodes (indices or a
+        boolean mask) is given only the values at those nodes are returned.
         """
 
         import quagmire
+        from ..function.function_classes import _node_indices
 
-        if len(args) == 0:
-            return self._ldata.array
+        if nodes is not None:
+            nodes = _node_indices(nodes)
 
-        if (len(args) == 1 and args[0] is self._mesh):
-            return self._ldata.array
+        if len(args) == 0 or (len(args) == 1 and args[0] is self._mesh):
+            values = self._ldata.array if nodes is None else self._ldata.array[nodes]
+            if out is not None:
+                out[...] = values
+                return out
+            return values
         elif len(args) == 1 and isinstance(args[0], (quagmire.mesh.trimesh.TriMesh, 
                                                      quagmire.mesh.pixmesh.PixMesh,
                                                      quagmire.mesh.strimesh.sTriMesh) ):
-            mesh = args[0]
-            return self._interpolate(mesh.coords[:,0], mesh.coords[:,1], **kwargs).reshape(-1)
+            coords = args[0].coords if nodes is None else args[0].coords[nodes]
+            return self._interpolate(coords[:,0], coords[:,1], **kwargs).reshape(-1)
         else:
             coords = np.array(args).reshape(-1,2)
+            if nodes is not None:
+                coords = coords[nodes]
             return self._interpolate(coords[:,0], coords[:,1], **kwargs).reshape(-1)
 
 
@@ -836,6 +922,8 @@ class VectorMeshVariable(MeshVariable):
 
         name = str(name)
 
+        self._version = 0
+
         # mesh variable vector
         self._ldata = self._dm.createLocalVector()
         self._ldata.setName(name)
@@ -860,6 +948,8 @@ class VectorMeshVariable(MeshVariable):
         else:
             raise ValueError("NumPy array must be of shape ({},{})".format(self._mesh.npoints,2))
 
+        self._version += 1
+
     def gradient(self):
         raise TypeError("VectorMeshVariable does not currently support gradient operations")
 
@@ -114,6 +114,14 @@ class CommonMesh(object):
         self.lgmap_row = lgmap_r
         self.lgmap_col = lgmap_c
 
+        self._workspace = dict()
+
+        # values of lazy functions on this mesh (by default up to 32 node arrays)
+        # and node arrays for the intermediate values of their evaluation
+        from quagmire.function.cache import FunctionCache, ScratchBuffers
+        self._function_cache = FunctionCache(max_bytes=32 * self.lvec.getSize() * np.dtype(PETSc.ScalarType).itemsize)
+        self.scratch_buffers = ScratchBuffers(self.lvec.getSize())
+
 
         ## Attach a coordinate system to the mesh:
 
@@ -153,6 +161,40 @@ class CommonMesh(object):
         from quagmire.mesh import MeshVariable
         return MeshVariable(name=name, mesh=self, lname=lname, locked=locked)
 
+    def _workspace_vectors(self, name, n=1):
+        """
+        A list of n local PETSc vectors kept on the mesh under name and handed
+        out again on every call (e.g. the stage buffers of a time integrator), so
+        that repeated work does not allocate new vectors. Their .array views are
+        the numpy buffers. The contents are not preserved between callers.
+        """
+
+        vectors = self._workspace.setdefault(name, [])
+        while len(vectors) < n:
+            vectors.append(self.dm.createLocalVector())
+
+        return vectors[:n]
+
+    @property
+    def function_cache_size(self):
+        """ Memory budget (bytes) for the stored values of lazy functions evaluated on this mesh """
+        return self._function_cache.max_bytes
+
+    @function_cache_size.setter
+    def function_cache_size(self, value):
+        cache = self._function_cache
+        cache.max_bytes = int(value)
+        if cache.nbytes > cache.max_bytes:
+            cache.clear()
+
+    def derivative_grad_stencil(self, nodes):
+        """
+        The nodes whose values derivative_grad uses to compute the gradient at
+        nodes, or None if that is all of the nodes of the mesh (as it is for the
+        SRFPACK gradients, which are found by iterating over the whole mesh)
+        """
+        return None
+
     def get_label(self, label):
         """
         Retrieves all points in the DM that is marked with a specific label.
@@ -318,6 +318,59 @@ class PixMesh(_CommonMesh):
         return grads
 
 
+    def derivative_grad_stencil(self, nodes):
+        """
+        The nodes whose values derivative_grad uses to compute the gradient at
+        nodes: the nodes and their neighbours in the x and y directions.
+        """
+        nodes = np.asarray(nodes)
+        j, i = np.divmod(nodes, self.nx)
+
+        stencil = [nodes,
+                   np.where(i > 0, nodes - 1, nodes),
+                   np.where(i < self.nx - 1, nodes + 1, nodes),
+                   np.where(j > 0, nodes - self.nx, nodes),
+                   np.where(j < self.ny - 1, nodes + self.nx, nodes)]
+
+        return np.unique(np.concatenate(stencil))
+
+
+    def derivative_grad_nodes(self, PHI, nodes):
+        """
+        Compute derivatives of PHI in the x, y directions at the given nodes only.
+        The values are the same as those of derivative_grad, and only the values of
+        PHI on the derivative_grad_stencil of the nodes are used.
+
+        Arguments
+        ---------
+        PHI : ndarray of floats, shape (n,)
+            compute the derivative of this array
+        nodes : ndarray of ints, shape (l,)
+            indices of the nodes
+
+        Returns
+        -------
+        grads : ndarray of floats, shape(l,2)
+            first partial derivatives of PHI in the x and y directions
+        """
+
+        def difference(index, n, stride, spacing):
+            # central differences in the interior, one-sided on the edges (as np.gradient)
+            lower = np.where(index > 0, nodes - stride, nodes)
+            upper = np.where(index < n - 1, nodes + stride, nodes)
+            interior = np.logical_and(index > 0, index < n - 1)
+            return (PHI[upper] - PHI[lower]) / np.where(interior, 2.0 * spacing, spacing)
+
+        nodes = np.asarray(nodes)
+        j, i = np.divmod(nodes, self.nx)
+
+        grads = np.ndarray((nodes.size, 2))
+        grads[:, 0] = difference(i, self.nx, 1, self.dx)
+        grads[:, 1] = difference(j, self.ny, self.nx, self.dy)
+
+        return grads
+
+
     def derivative_div(self, PHIx, PHIy):
         """
         Compute second order derivative from flux fields PHIx, PHIy
@@ -14,4 +14,6 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with Quagmire.  If not, see <http://www.gnu.org/licenses/>.
 
-from .topomesh import TopoMesh
\ No newline at end of file
+from .topomesh import TopoMesh
+from .flowtree import FlowTreeIndex
+from .streamnetwork import StreamNetwork
@@ -0,0 +1,176 @@
+# Copyright 2016-2020 Louis Moresi, Ben Mather, Romain Beucher
+#
+# This file is part of Quagmire.
+#
+# Quagmire is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or any later version.
+#
+# Quagmire is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Quagmire.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Preorder (Euler-tour) index of a receiver forest.
+
+Each node drains to a single receiver (the roots are their own receivers).
+In a depth-first preorder of the forest, a node and every node that drains
+through it occupy the contiguous interval [start, start+size) so that
+catchment masks, counts and sums reduce to interval operations and prefix sums.
+"""
+
+import numpy as np
+
+
+class FlowTreeIndex(object):
+    """
+    Build the index from an array of receivers, receivers[i] being the node
+    that i drains to. The receiver graph must not have cycles other than
+    the roots (receivers[i] == i).
+
+    Attributes:
+        receivers : the receiver of each node
+        start     : position of each node in the preorder
+        size      : number of nodes in the catchment of each node (including itself)
+        order     : the node at each position of the preorder
+        depth     : number of steps from each node to its root
+        level_order, level_ptr : the nodes in order of depth, those of depth d
+                    being level_order[level_ptr[d]:level_ptr[d+1]]
+    """
+
+    def __init__(self, receivers):
+
+        receivers = np.asarray(receivers)
+        npoints = receivers.shape[0]
+        nodes = np.arange(0, npoints)
+
+        root = receivers == nodes
+        donors = np.where(~root)[0]
+
+        # donors grouped by their receiver
+
+        children = donors[np.argsort(receivers[donors], kind="stable")]
+        child_count = np.bincount(receivers[donors], minlength=npoints)
+        child_start = np.cumsum(child_count) - child_count
+
+        # breadth-first levels from the roots; the children of each node are
+        # contiguous within a level
+
+        levels = [np.where(root)[0]]
+        depth = np.zeros(npoints, dtype=int)
+        found = len(levels[0])
+
+        while True:
+            parents = levels[-1]
+            count = child_count[parents]
+            total = count.sum()
+            if total == 0:
+                break
+
+            offset = np.repeat(child_start[parents] - (np.cumsum(count) - count), count)
+            level = children[offset + np.arange(0, total)]
+            depth[level] = len(levels)
+            levels.append(level)
+            found += total
+
+        if found != npoints:
+            raise ValueError("The receiver graph has cycles ({} nodes do not drain to a root)".format(npoints - found))
+
+        # catchment sizes from the deepest level up
+
+        size = np.ones(npoints, dtype=int)
+        for level in reversed(levels[1:]):
+            np.add.at(size, receivers[level], size[level])
+
+        # preorder positions from the roots down: each child follows its parent
+        # and the catchments of its earlier siblings
+
+        start = np.zeros(npoints, dtype=int)
+        start[levels[0]] = np.cumsum(size[levels[0]]) - size[levels[0]]
+
+        for level in levels[1:]:
+            parents = receivers[level]
+            first = np.ones(len(level), dtype=bool)
+            first[1:] = parents[1:] != parents[:-1]
+
+            before = np.cumsum(size[level]) - size[level]
+            before -= before[first][np.cumsum(first) - 1]
+
+            start[level] = start[parents] + 1 + before
+
+        order = np.empty(npoints, dtype=int)
+        order[start] = nodes
+
+        self.receivers = receivers
+        self.start = start
+        self.size = size
+        self.order = order
+        self.depth = depth
+        self.level_order = np.hstack(levels)
+        self.level_ptr = np.cumsum([0] + [len(level) for level in levels])
+        self.npoints = npoints
+
+        return
+
+
+    def interval(self, nodes):
+        """ The preorder interval [start, end) of the catchment of each of the nodes """
+
+        nodes = np.asarray(nodes)
+        return self.start[nodes], self.start[nodes] + self.size[nodes]
+
+
+    def catchment_nodes(self, node):
+        """ All the nodes that drain through node (including node itself) """
+
+        return self.order[self.start[node]:self.start[node] + self.size[node]]
+
+
+    def catchment_size(self, nodes):
+        """ Number of nodes that drain through each of the nodes """
+
+        return self.size[np.asarray(nodes)]
+
+
+    def catchment_mask(self, nodes):
+        """ Boolean array that is True for every node that drains through any of the nodes """
+
+        start, end = self.interval(nodes)
+
+        cover = np.zeros(self.npoints+1, dtype=int)
+        np.add.at(cover, start, 1)
+        np.add.at(cover, end, -1)
+
+        return (np.cumsum(cover[:-1]) > 0)[self.start]
+
+
+    def prefix_sum(self, values):
+        """
+        Cumulative sum of values (one per node, or rows of a 2D array) in preorder,
+        with a leading zero, for use with catchment_sum
+        """
+
+        values = np.asarray(values)
+        prefix = np.zeros((self.npoints+1,) + values.shape[1:], dtype=np.result_type(values.dtype, float))
+        np.cumsum(values[self.order], axis=0, out=prefix[1:])
+
+        return prefix
+
+
+    def catchment_sum(self, prefix, nodes):
+        """ Sum of the values over the catchment of each of the nodes from their prefix_sum """
+
+        start, end = self.interval(nodes)
+        return prefix[end] - prefix[start]
+
+
+    def is_upstream(self, nodes, of_nodes):
+        """ True where nodes[i] drains through of_nodes[i] """
+
+        nodes = np.asarray(nodes)
+        start, end = self.interval(of_nodes)
+        return np.logical_and(self.start[nodes] >= start, self.start[nodes] < end)
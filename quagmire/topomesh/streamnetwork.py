@@ -0,0 +1,267 @@
+# Copyright 2016-2020 Louis Moresi, Ben Mather, Romain Beucher
+#
+# This file is part of Quagmire.
+#
+# Quagmire is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or any later version.
+#
+# Quagmire is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Quagmire.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stream network held in flat arrays.
+
+The network nodes are the mesh nodes with an upstream area above a threshold.
+They are split into segments (from a channel head or a junction down to the
+next junction or outlet) stored in compressed sparse row form:
+the nodes of segment s are node_index[segment_ptr[s]:segment_ptr[s+1]],
+ordered downstream.
+"""
+
+import numpy as np
+
+
+class StreamNetwork(object):
+    """
+    Build a stream network from the (global) receiver of every mesh node, the
+    distance from each node to its root in the receiver forest (see FlowTreeIndex),
+    the node coordinates, heights and upstream areas and the minimum drainage area
+    of a channel.
+
+    Attributes:
+        gnodes          : mesh (global) node number of each network node
+        receiver        : network node that each node drains to (-1 at outlets)
+        coords, height, area : of each network node
+        segment_ptr, node_index : CSR arrays of the network nodes of each segment
+        segment_receiver: segment that each segment drains into (-1 at outlets)
+        junctions       : network nodes with more than one donor
+        strahler, shreve: stream orders of each segment
+    """
+
+    def __init__(self, receivers, depth, coords, height, area, drainage_area):
+
+        receivers = np.asarray(receivers)
+        nodes = np.arange(0, receivers.shape[0])
+
+        channel = np.asarray(area) >= drainage_area
+
+        gnodes = nodes[channel]
+        position = np.full(receivers.shape[0], -1)
+        position[gnodes] = np.arange(0, len(gnodes))
+
+        # network receivers (channels may leave the network where the downhill
+        # neighbour of a channel node has a smaller upstream area)
+
+        receiver = position[receivers[gnodes]]
+        receiver[receiver == np.arange(0, len(gnodes))] = -1
+
+        nnodes = len(gnodes)
+        links = np.where(receiver >= 0)[0]
+        donor_count = np.bincount(receiver[links], minlength=nnodes)
+
+        # each node continues the segment of its only donor, otherwise it starts one
+
+        start = donor_count != 1
+
+        upstream = np.arange(0, nnodes)
+        single = links[~start[receiver[links]]]
+        upstream[receiver[single]] = single
+
+        segment_start = np.where(start, np.arange(0, nnodes), upstream)
+        while True:
+            jump = segment_start[segment_start]
+            if np.array_equal(jump, segment_start):
+                break
+            segment_start = jump
+
+        node_depth = np.asarray(depth)[gnodes]
+
+        starts = np.where(start)[0]
+
+        # segments in order of decreasing depth of their first node, so that every
+        # segment follows all of the segments that drain into it
+
+        starts = starts[np.argsort(-node_depth[starts], kind="stable")]
+        segment_of_start = np.full(nnodes, -1)
+        segment_of_start[starts] = np.arange(0, len(starts))
+
+        segment = segment_of_start[segment_start]
+        order = np.lexsort((-node_depth, segment))
+
+        segment_ptr = np.searchsorted(segment[order], np.arange(0, len(starts)+1))
+
+        last = order[segment_ptr[1:]-1]
+        segment_receiver = np.where(receiver[last] >= 0, segment[np.maximum(receiver[last], 0)], -1)
+
+        self.gnodes = gnodes
+        self.receiver = receiver
+        self.coords = np.asarray(coords)[gnodes]
+        self.height = np.asarray(height)[gnodes]
+        self.area = np.asarray(area)[gnodes]
+        self.drainage_area = drainage_area
+
+        self.segment = segment
+        self.segment_depth = node_depth[starts]
+        self.segment_ptr = segment_ptr
+        self.node_index = order
+        self.segment_receiver = segment_receiver
+        self.junctions = np.where(donor_count > 1)[0]
+
+        self.strahler, self.shreve = self._stream_orders()
+
+        return
+
+
+    @property
+    def nsegments(self):
+        return len(self.segment_ptr) - 1
+
+
+    def segment_nodes(self, segment):
+        """ Network nodes of a segment, in downstream order """
+
+        return self.node_index[self.segment_ptr[segment]:self.segment_ptr[segment+1]]
+
+
+    def _stream_orders(self):
+        """
+        Strahler and Shreve orders of the segments in one ordered pass. Segments
+        that start at a channel head have order 1. The segments are stored in order
+        of decreasing depth of their first node, and every segment starts deeper than
+        the one it drains into, so the segments that start at the same depth are
+        processed together after all of their donors.
+        """
+
+        nsegments = self.nsegments
+
+        strahler = np.ones(nsegments, dtype=int)
+        shreve = np.ones(nsegments, dtype=int)
+
+        # donor segments grouped by the segment they drain into
+
+        donors = np.where(self.segment_receiver >= 0)[0]
+        donors = donors[np.argsort(self.segment_receiver[donors], kind="stable")]
+        receivers = self.segment_receiver[donors]
+        donor_ptr = np.searchsorted(receivers, np.arange(0, nsegments+1))
+
+        block_ptr = np.flatnonzero(np.diff(self.segment_depth, prepend=np.inf, append=-np.inf))
+
+        for a, b in zip(block_ptr[:-1], block_ptr[1:]):
+            d = donors[donor_ptr[a]:donor_ptr[b]]
+            if len(d) == 0:
+                continue
+
+            r = receivers[donor_ptr[a]:donor_ptr[b]] - a
+
+            top = np.zeros(b-a, dtype=int)
+            np.maximum.at(top, r, strahler[d])
+
+            at_top = np.zeros(b-a, dtype=int)
+            np.add.at(at_top, r, strahler[d] == top[r])
+
+            magnitude = np.zeros(b-a, dtype=int)
+            np.add.at(magnitude, r, shreve[d])
+
+            joined = np.unique(r)
+            strahler[a+joined] = np.where(at_top[joined] > 1, top[joined] + 1, top[joined])
+            shreve[a+joined] = magnitude[joined]
+
+        return strahler, shreve
+
+
+    def _link_length(self):
+        """ Distance from each network node to its receiver (0 at outlets) """
+
+        downstream = np.where(self.receiver >= 0, self.receiver, np.arange(0, len(self.receiver)))
+        return np.linalg.norm(self.coords - self.coords[downstream], axis=1)
+
+
+    def segment_length(self):
+        """ Length of each segment, including the link to the segment it drains into """
+
+        return np.add.reduceat(self._link_length()[self.node_index], self.segment_ptr[:-1])
+
+
+    def segment_drop(self):
+        """ Height difference from the top of each segment to the node it drains into """
+
+        first = self.node_index[self.segment_ptr[:-1]]
+        last = self.node_index[self.segment_ptr[1:]-1]
+        end = np.where(self.receiver[last] >= 0, self.receiver[last], last)
+
+        return self.height[first] - self.height[end]
+
+
+    def segment_slope(self):
+        """ Mean slope of each segment (zero for segments of no length) """
+
+        length = self.segment_length()
+        drop = self.segment_drop()
+
+        return np.divide(drop, length, out=np.zeros_like(drop), where=length > 0)
+
+
+    def segment_drainage_area(self):
+        """ Upstream area at the downstream end of each segment """
+
+        return self.area[self.node_index[self.segment_ptr[1:]-1]]
+
+
+    _saved_arrays = ("gnodes", "receiver", "coords", "height", "area", "segment", "segment_depth",
+                     "segment_ptr", "node_index", "segment_receiver", "junctions", "strahler", "shreve")
+
+    def save(self, hdf5_filename, group="stream_network"):
+        """
+        Save the network arrays to a group of an HDF5 file (appended if the file
+        exists, e.g. after mesh.save). The network is the same on every process
+        and is written by the first.
+        """
+
+        import h5py
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+        hdf5_filename = str(hdf5_filename)
+        if not hdf5_filename.endswith('.h5'):
+            hdf5_filename += '.h5'
+
+        if comm.rank == 0:
+            with h5py.File(hdf5_filename, mode='a') as h5:
+                if group in h5:
+                    del h5[group]
+
+                network = h5.create_group(group)
+                network.attrs['drainage_area'] = self.drainage_area
+
+                for name in self._saved_arrays:
+                    network.create_dataset(name, data=getattr(self, name))
+
+        comm.barrier()
+
+        return
+
+
+    @classmethod
+    def load(cls, hdf5_filename, group="stream_network"):
+        """ Load a network written by save """
+
+        import h5py
+
+        hdf5_filename = str(hdf5_filename)
+        if not hdf5_filename.endswith('.h5'):
+            hdf5_filename += '.h5'
+
+        network = cls.__new__(cls)
+
+        with h5py.File(hdf5_filename, mode='r') as h5:
+            network.drainage_area = h5[group].attrs['drainage_area']
+            for name in cls._saved_arrays:
+                setattr(network, name, h5[group][name][()])
+
+        return network
@@ -31,6 +31,9 @@ from quagmire.mesh import MeshVariable as _MeshVariable
 from quagmire.mesh.basemesh import MeshFunction as _MeshFunction
 from quagmire.function import LazyEvaluation as _LazyEvaluation
 
+from .flowtree import FlowTreeIndex as _FlowTreeIndex
+from .streamnetwork import StreamNetwork as _StreamNetwork
+
 class TopoMesh(object):
     def __init__(self, downhill_neighbours=2, *args, **kwargs):
 
@@ -40,6 +43,28 @@ class TopoMesh(object):
         self._dDX = self.gvec.duplicate()
 
         self.downhillMat = None
+        self.downhillCumulativeMat = None
+        self._downhill_matrix_neighbours = None
+        self._downhill_matrix_weights = None
+        self._flat_increment = None
+
+        # Heights that the downhill matrices were last built from
+        self._downhill_heights = None
+
+        # Receiver graph in topological order for single-sweep accumulation
+        # ("sweep") with the matrix iteration ("iterate") as a fallback, or
+        # a linear solve of (I - D) x = b ("ksp")
+        self.cumulative_flow_method = "sweep"
+        self._flow_edges = None
+        self._flow_edge_ptr = None
+        self._flow_edge_index = None
+        self._flow_ksp = None
+
+        # Preorder index of the receiver forest (built on first use)
+        self._flow_tree = None
+
+        # Local nodes sent to and received from each process by _reduce_to_owners
+        self._shadow_exchange = None
 
         # There is no topography yet set, so we need to avoid
         # triggering the matrix rebuilding in the setter of this property
@@ -77,21 +102,42 @@ class TopoMesh(object):
         if self.topography._locked == True:
             self._update_height()
             self._update_height_for_surface_flows()
+            self.topography._version += 1
 
         return
 
 
-    def _update_height(self):
+    def _update_height(self, changed_nodes=None):
         """
         Update height field
+
+        If the (local) nodes whose height has changed are given, only the rows
+        of the downhill data structures in their neighbourhood are rebuilt
+        (see _update_downhill_matrix_incremental). The heights are kept in
+        self._downhill_heights so that later changes can be found.
         """
 
         t = perf_counter()
-        self._build_downhill_matrix_iterate()
+
+        if self.downhillCumulativeMat is not None:
+            self.downhillCumulativeMat.destroy()
+            self.downhillCumulativeMat = None
+
+        self._flow_tree = None
+
+        if changed_nodes is None or not self._incremental_update_is_possible(changed_nodes):
+            self._build_downhill_matrix_iterate()
+            build = "Build"
+        else:
+            self._update_downhill_matrix_incremental(changed_nodes)
+            build = "Incremental update of"
+
+        self._downhill_heights = self._heightVariable.data.copy()
+
         self.timings['downhill matrices'] = [perf_counter()-t, self.log.getCPUTime(), self.log.getFlops()]
 
         if self.rank==0 and self.verbose:
-            print(("{} - Build downhill matrices {}s".format(self.dm.comm.rank, perf_counter()-t)))
+            print(("{} - {} downhill matrices {}s".format(self.dm.comm.rank, build, perf_counter()-t)))
         return
 
     def _update_height_for_surface_flows(self):
@@ -141,23 +187,24 @@ class TopoMesh(object):
                 return
 
             def __exit__(inner_self, *args):
-                inner_self._topomesh._update_height()
+                # nodes that differ from the heights of the current matrices
+                # (including any writes made outside of this context)
+
+                heights = inner_self._topomesh._downhill_heights
+                if heights is None:
+                    changed_nodes = None
+                else:
+                    changed_nodes = np.where(inner_self._topovar.data != heights)[0]
+
+                inner_self._topomesh._update_height(changed_nodes)
                 inner_self._topomesh._update_height_for_surface_flows()
                 inner_self._topovar.lock()
+                inner_self._topovar._version += 1
                 inner_self._topomesh._topography_modified_count += 1
                 return
 
         return Topomesh_Height_Update_Manager
 
-        self._build_adjacency_matrix_iterate()
-        if self.rank==0 and self.verbose:
-            print((" - Partial rebuild of downhill matrices {}s".format(perf_counter()-t)))
-
-        # revert to specified n-neighbours
-        self.downhill_neighbours = neighbours
-
-        return
-
     def _sort_nodes_by_field(self, height):
         """
         Obsolete ??
@@ -211,13 +258,30 @@ class TopoMesh(object):
 #
 #
 
-    def _build_down_neighbour_arrays(self, nearest=True):
+    def _build_down_neighbour_arrays(self, nearest=True, nodes=None):
+        """
+        Find the downhill neighbours of each node. If nodes is given,
+        only those entries of the existing arrays are recomputed.
+        """
+
+        if nodes is None:
+            nodes = np.arange(0, self.npoints)
+            self.down_neighbour = dict()
+            for n in range(1, self.downhill_neighbours+1):
+                self.down_neighbour[n] = np.empty(self.npoints, dtype=PETSc.IntType)
 
-        nodes = list(range(0,self.npoints))
-        nheight  = self._heightVariable.data[self.natural_neighbours]
-        nheight[np.where(self.natural_neighbours == -1)] = np.finfo(nheight.dtype).max
+        rows = np.arange(0, len(nodes))
+        natural_neighbours = self.natural_neighbours[nodes]
 
-        nheightidx = np.argsort(nheight, axis=1)
+        nheight  = self._heightVariable.data[natural_neighbours]
+        nheight[np.where(natural_neighbours == -1)] = np.finfo(nheight.dtype).max
+
+        if self._flat_increment is None:
+            nheightidx = np.argsort(nheight, axis=1, kind="stable")
+        else:
+            # equal heights are ordered by the flat-resolution increment
+            nincrement = self._flat_increment[natural_neighbours]
+            nheightidx = np.lexsort((nincrement, nheight), axis=1)
 
         ## How many low neighbours are there in each ?
 
@@ -226,11 +290,10 @@ class TopoMesh(object):
         ## First the STD, 1-neighbour
 
         idx  = nheightidx[:,0]
-        index1 = self.natural_neighbours[nodes, idx[nodes]]
+        index1 = natural_neighbours[rows, idx]
 
         # store in neighbour dictionary
-        self.down_neighbour = dict()
-        self.down_neighbour[1] = index1.astype(PETSc.IntType)
+        self.down_neighbour[1][nodes] = index1
 
         ## Now all next-lower-level neighours
 
@@ -238,233 +301,1353 @@ class TopoMesh(object):
             n = i + 1
 
             idx  = nheightidx[:,i]
-            indexN = self.natural_neighbours[nodes, idx[nodes]]
+            indexN = natural_neighbours[rows, idx]
 
             failed = np.where(idxrange < n)
             indexN[failed] = index1[failed]
 
             # store in neighbour dictionary
-            self.down_neighbour[n] = indexN.astype(PETSc.IntType)
+            self.down_neighbour[n][nodes] = indexN
 
 
-    def _build_adjacency_matrix_iterate(self):
+    def _resolve_flats(self):
+        """
+        Flat resolution (Garbrecht & Martz, 1997; Barnes et al., 2014).
 
-        self._build_down_neighbour_arrays(nearest=True)
+        Flats are nodes (not outflow points) with no lower neighbour but at least
+        one neighbour of the same height. The returned increment is a gradient
+        towards the lower edges of each flat and away from the higher terrain
+        around it, built from two breadth-first searches. It is used only to order
+        neighbours of equal height when choosing receivers, and the topography
+        is not modified. Returns None if there are no flats on any process.
+
+        Flats that do not reach a lower edge (closed depressions) are left
+        unresolved and still contain low points.
+        """
+
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+        height = self._heightVariable.data
+
+        natural_neighbours = self.natural_neighbours
+        valid = natural_neighbours >= 0
+        valid[:,0] = False
+
+        nheight = height[natural_neighbours]
+        equal  = np.logical_and(nheight == height.reshape(-1,1), valid)
+        lower  = np.logical_and(nheight <  height.reshape(-1,1), valid).any(axis=1)
+
+        flat = np.logical_and.reduce((~lower, self.bmask, equal.any(axis=1)))
+
+        local_flats = np.array(float(flat.any()))
+        global_flats = np.array(0.0)
+        comm.Allreduce([local_flats, MPI.DOUBLE], [global_flats, MPI.DOUBLE], op=MPI.MAX)
+
+        if not global_flats:
+            return None
+
+        higher = np.logical_and(nheight > height.reshape(-1,1), valid).any(axis=1)
+
+        low_edge  = np.logical_and(~flat, np.logical_and(flat[natural_neighbours], equal).any(axis=1))
+        high_edge = np.logical_and(flat, higher)
+
+        # the neighbours of shadow nodes are incomplete, so take the flags from the owners
+        flat      = self.sync(flat.astype(float)) > 0.5
+        low_edge  = self.sync(low_edge.astype(float)) > 0.5
+        high_edge = self.sync(high_edge.astype(float)) > 0.5
+
+        towards_lower = self._flat_distance(low_edge, flat, height)
+        away_from_higher = self._flat_distance(high_edge, flat, height)
+        away_from_higher[~np.isfinite(away_from_higher)] = 0.0
+
+        resolved = np.logical_and(flat, np.isfinite(towards_lower))
+
+        # nodes that drain the flats come first among neighbours of equal height
+        increment = np.full(self.npoints, -np.inf)
+        increment[flat] = 0.0
+        increment[resolved] = 2.0*towards_lower[resolved] - away_from_higher[resolved]
+
+        return increment
+
+
+    def _flat_distance(self, sources, region, height):
+        """
+        Number of steps from the nearest source node through region nodes of the
+        same height (np.inf if not reachable). In parallel the search is repeated
+        from the values in the shadows until no process changes.
+        """
+
+        from mpi4py import MPI
+        from collections import deque
+        comm = MPI.COMM_WORLD
+
+        # Links between the nodes of the search, taken from owned rows only
+        # (the neighbours of shadow nodes are incomplete) and made symmetric
+
+        nodes = np.where(np.logical_or(sources, region))[0]
+        position = np.full(self.npoints, -1)
+        position[nodes] = np.arange(0, len(nodes))
+
+        gnodes = self.lgmap_row.apply(nodes.astype(PETSc.IntType))
+        gstart, gend = self.gvec.getOwnershipRange()
+        rows = nodes[np.logical_and(gnodes >= gstart, gnodes < gend)]
+
+        neighbours = self.natural_neighbours[rows,1:]
+        i, j = np.nonzero(neighbours >= 0)
+        node0, node1 = rows[i], neighbours[i,j]
+
+        link = np.logical_and(position[node1] >= 0, height[node0] == height[node1])
+        node0, node1 = position[node0[link]], position[node1[link]]
+
+        src = np.hstack((node0, node1))
+        dst = np.hstack((node1, node0))
+        order = np.argsort(src, kind="stable")
+        ptr = np.searchsorted(src[order], np.arange(0, len(nodes)+1))
+        links = np.split(dst[order], ptr[1:-1])
+        links = [l.tolist() for l in links]
+
+        passable = region[nodes].tolist()
+
+        distance = np.full(self.npoints, np.inf)
+        distance[sources] = 0.0
+
+        while True:
+            dist = distance[nodes].tolist()
+            queue = deque(sorted(np.where(np.isfinite(distance[nodes]))[0].tolist(), key=lambda n: dist[n]))
+
+            # a node may be queued more than once if its distance is reduced later
+            while queue:
+                n = queue.popleft()
+                d = dist[n] + 1.0
+
+                for neighbour in links[n]:
+                    if passable[neighbour] and d < dist[neighbour]:
+                        dist[neighbour] = d
+                        queue.append(neighbour)
 
-        self.adjacency = dict()
-        self.uphill = dict()
-        data = np.ones(self.npoints)
+            new_distance = np.full(self.npoints, np.inf)
+            new_distance[nodes] = dist
 
-        indptr = np.arange(0, self.npoints+1, dtype=PETSc.IntType)
-        nodes = indptr[:-1]
+            if comm.Get_size() == 1:
+                return new_distance
 
-        for i in range(1, self.downhill_neighbours+1):
+            new_distance = self.sync(new_distance)
 
-            data[self.down_neighbour[i]==nodes] = 0.0
+            local_changes = np.array(float((new_distance != distance).sum()))
+            global_changes = np.array(0.0)
+            comm.Allreduce([local_changes, MPI.DOUBLE], [global_changes, MPI.DOUBLE], op=MPI.SUM)
 
-            adjacency = self._adjacency_matrix_template()
-            adjacency.assemblyBegin()
-            adjacency.setValuesLocalCSR(indptr, self.down_neighbour[i], data)
-            adjacency.assemblyEnd()
+            distance = new_distance
 
-            self.uphill[i] = adjacency.copy()
-            self.adjacency[i] = adjacency.transpose()
+            if not global_changes:
+                return distance
 
-            # self.down_neighbour[i] = down_neighbour.copy()
 
     def _build_downhill_matrix_iterate(self):
 
-        self._build_adjacency_matrix_iterate()
-        weights = np.empty((self.downhill_neighbours, self.npoints))
+        # any existing solver refers to the old downhill matrix
+        if self._flow_ksp is not None:
+            self._flow_ksp.destroy()
+            self._flow_ksp = None
+
+        self._flat_increment = self._resolve_flats()
+        self._build_down_neighbour_arrays(nearest=True)
+
+        self._downhill_matrix_weights = self._downhill_weights(nodes=None)
+        self._downhill_matrix_neighbours = self.downhill_neighbours
+
+        self._assemble_downhill_matrix(self._downhill_matrix_weights)
+
+        return
+
+
+    def _assemble_downhill_matrix(self, weights):
+        """
+        Assemble the downhill matrix directly from the down_neighbour arrays and weights
+        (and rebuild the flow ordering). Column i holds the weights of the receivers of
+        node i so that downhillMat.mult moves information downhill and
+        downhillMat.multTranspose moves it uphill. Low points and outflow points have
+        empty columns.
+        """
+
+        self._build_flow_ordering(weights)
+
+        if self.downhillMat is not None:
+            self.downhillMat.destroy()
+
+        nodes = np.arange(0, self.npoints, dtype=PETSc.IntType)
+        rows, cols, values = self._downhill_matrix_entries(nodes, weights)
+
+        # Preallocation: each node is the donor of entries in the rows of its receivers.
+        # Receivers owned by another process see the donor in their off-diagonal block.
+
+        gstart, gend = self.gvec.getOwnershipRange()
+        grows = self.lgmap_row.apply(rows)
+        off_process = np.logical_or(grows < gstart, grows >= gend)
+
+        nnz = []
+        for block in [~off_process, off_process]:
+            self.lvec.setArray(np.bincount(rows[block], minlength=self.npoints).astype(float))
+            count = self.gvec.duplicate()
+            count.zeroEntries()
+            self.dm.localToGlobal(self.lvec, count, addv=PETSc.InsertMode.ADD_VALUES)
+            nnz.append(count.array.astype(PETSc.IntType))
+            count.destroy()
+
+        indptr = np.searchsorted(rows, np.arange(0, self.npoints+1)).astype(PETSc.IntType)
+
+        downhillMat = self._adjacency_matrix_template(nnz=tuple(nnz))
+        downhillMat.setValuesLocalCSR(indptr, cols, values)
+        downhillMat.assemble()
+
+        self.downhillMat = downhillMat
+
+        return
+
+
+    def _downhill_matrix_entries(self, nodes, weights):
+        """
+        Entries (receiver, donor, weight) of the downhill matrix for the given
+        nodes, sorted by receiver. Only owned donors contribute so that each entry
+        is set by exactly one process, and repeated receivers of a node (when it
+        has fewer lower neighbours than downhill_neighbours) are summed.
+        """
+
+        gstart, gend = self.gvec.getOwnershipRange()
+        gnodes = self.lgmap_row.apply(nodes)
+        owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+        receivers = np.vstack([self.down_neighbour[i+1][nodes] for i in range(0, self.downhill_neighbours)])
+        active = np.logical_and(receivers != nodes, owned)
+        weights = weights.copy()
+
+        # only the steepest receiver is ever repeated
+        repeated = receivers[1:] == receivers[0]
+        weights[0] += (weights[1:] * repeated).sum(axis=0)
+        active[1:] &= ~repeated
+
+        rows = receivers[active]
+        cols = np.broadcast_to(nodes, receivers.shape)[active]
+        values = weights[active]
+
+        order = np.argsort(rows, kind="stable")
+
+        return rows[order], cols[order].astype(PETSc.IntType), values[order]
+
+
+    def _downhill_weights(self, nodes=None):
+        """
+        Weights of each of the downhill neighbours of the given nodes (all nodes if None),
+        proportional to the square root of the gradient and normalised to sum to one.
+        """
+
+        if nodes is None:
+            nodes = np.arange(0, self.npoints)
+
+        weights = np.empty((self.downhill_neighbours, len(nodes)))
 
         height = self._heightVariable.data
 
         # Process weights
         for i in range(0, self.downhill_neighbours):
-            down_N = self.down_neighbour[i+1]
-            grad = np.abs(height - height[down_N]+1.0e-10) / (1.0e-10 + \
-                   np.linalg.norm(self.data - self.data[down_N], axis=1))
+            down_N = self.down_neighbour[i+1][nodes]
+            grad = np.abs(height[nodes] - height[down_N]+1.0e-10) / (1.0e-10 + \
+                   np.linalg.norm(self.data[nodes] - self.data[down_N], axis=1))
 
             weights[i,:] = np.sqrt(grad)
 
         weights /= weights.sum(axis=0)
-        w = self.gvec.duplicate()
 
+        return weights
 
-        # Store weighted downhill matrices
-        downhill_matrices = [None]*self.downhill_neighbours
-        for i in range(0, self.downhill_neighbours):
-            N = i + 1
-            self.lvec.setArray(weights[i])
-            self.dm.localToGlobal(self.lvec, w)
 
-            D = self.adjacency[N].copy()
-            D.diagonalScale(R=w)
-            downhill_matrices[i] = D
+    def _incremental_update_is_possible(self, changed_nodes, max_fraction=0.25):
+        """
+        An incremental update needs existing matrices for the same number of
+        downhill neighbours and is only worthwhile if a modest fraction of the
+        mesh is affected. The decision is made collectively.
+        """
+
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+        if self.downhillMat is None or self._downhill_matrix_neighbours != self.downhill_neighbours:
+            local_fraction = np.array(1.0)
+        else:
+            local_fraction = np.array(float(len(changed_nodes)) * self.natural_neighbours.shape[1] / self.npoints)
+
+        global_fraction = np.array(0.0)
+        comm.Allreduce([local_fraction, MPI.DOUBLE], [global_fraction, MPI.DOUBLE], op=MPI.MAX)
 
+        return global_fraction <= max_fraction
 
-        # Sum downhill matrices
-        self.downhillMat = downhill_matrices[0]
-        for i in range(1, self.downhill_neighbours):
-            self.downhillMat += downhill_matrices[i]
-            downhill_matrices[i].destroy()
+
+    def _update_downhill_matrix_incremental(self, changed_nodes):
+        """
+        Rebuild the downhill neighbours and weights only for nodes that have a
+        changed node in their natural neighbourhood.
+
+        If none of the receivers have changed the nonzero pattern of the matrices
+        and the flow ordering are reused and only the weights are written in place.
+        Otherwise the matrices are reassembled from the updated arrays.
+        """
+
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+        # any existing solver refers to the old downhill matrix values
+        if self._flow_ksp is not None:
+            self._flow_ksp.destroy()
+            self._flow_ksp = None
+
+        # a change of height can resolve (or create) flats beyond the neighbourhood
+        old_increment = self._flat_increment
+        self._flat_increment = self._resolve_flats()
+
+        if old_increment is not None or self._flat_increment is not None:
+            no_flats = np.full(self.npoints, -np.inf)
+            old_increment = no_flats if old_increment is None else old_increment
+            new_increment = no_flats if self._flat_increment is None else self._flat_increment
+            changed_nodes = np.union1d(changed_nodes, np.where(old_increment != new_increment)[0])
+
+        neighbourhood = self.natural_neighbours[changed_nodes]
+        nodes = np.unique(np.hstack((changed_nodes, neighbourhood[neighbourhood >= 0]))).astype(PETSc.IntType)
+
+        old_receivers = np.vstack([self.down_neighbour[i+1][nodes] for i in range(0, self.downhill_neighbours)])
+
+        self._build_down_neighbour_arrays(nearest=True, nodes=nodes)
+
+        weights = self._downhill_weights(nodes=nodes)
+        self._downhill_matrix_weights[:,nodes] = weights
+
+        receivers = np.vstack([self.down_neighbour[i+1][nodes] for i in range(0, self.downhill_neighbours)])
+
+        local_moved = np.array(float((receivers != old_receivers).any()))
+        moved = np.array(0.0)
+        comm.Allreduce([local_moved, MPI.DOUBLE], [moved, MPI.DOUBLE], op=MPI.MAX)
+
+        if moved:
+            self._assemble_downhill_matrix(self._downhill_matrix_weights)
+            return
+
+        # Same pattern: overwrite the existing entries with the new weights
+
+        rows, cols, values = self._downhill_matrix_entries(nodes, weights)
+        rows = self.lgmap_row.apply(rows)
+        cols = self.lgmap_col.apply(cols)
+
+        self.downhillMat.setValuesRCV(rows.reshape(-1,1), cols.reshape(-1,1), values.reshape(-1,1))
+        self.downhillMat.assemble()
+
+        if self._flow_edges is not None:
+            src, dst, wts = self._flow_edges
+            wts[...] = self._downhill_matrix_weights.ravel()[self._flow_edge_index]
 
         return
 
 
-    def build_cumulative_downhill_matrix(self):
+    def _build_flow_ordering(self, weights):
+        """
+        Arrange the edges of the receiver graph (node -> down_neighbour[i] with the
+        weights used in the downhill matrix) into topological levels. Every node lies
+        in a later level than all of its donors, so a single pass through the levels
+        accumulates flow all the way to the outlets. This is a height ordering of the
+        nodes, grouped so that each level can be processed as one vector operation.
+
+        Low points, outflow points and shadow nodes do not pass anything on.
+        If the receiver graph is not acyclic (e.g. ties on perfectly flat ground)
+        no ordering is stored and cumulative_flow falls back to the matrix iteration.
         """
-        Build non-sparse, single hit matrices to cumulative_flow information downhill
-        (self.sweepDownToOutflowMat and self.downhillCumulativeMat)
 
-        This may be expensive in terms of storage so this is only done if
-        self.storeDense == True and the matrices are also out of date (which they
-        will be if the height field is changed)
+        nodes = np.arange(0, self.npoints, dtype=PETSc.IntType)
+        gnodes = self.lgmap_row.apply(nodes)
+        gstart, gend = self.gvec.getOwnershipRange()
+        owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+        receivers = np.vstack([self.down_neighbour[i+1] for i in range(0, self.downhill_neighbours)])
+        active = np.logical_and(receivers != nodes, owned)
+
+        # Kahn's algorithm - peel off the nodes with no remaining donors one level at a time
+
+        in_degree = np.bincount(receivers[active], minlength=self.npoints)
+        level = np.full(self.npoints, -1, dtype=PETSc.IntType)
+
+        frontier = np.where(in_degree == 0)[0]
+        nlevels = 0
+
+        while frontier.size:
+            level[frontier] = nlevels
+            downstream = receivers[:,frontier][active[:,frontier]]
+            np.subtract.at(in_degree, downstream, 1)
+            frontier = np.unique(downstream[in_degree[downstream] == 0])
+            nlevels += 1
+
+        self._flow_owned = owned
+
+        if (level < 0).any():
+            self._flow_edges = None
+            self._flow_edge_ptr = None
+            self._flow_edge_index = None
+            if self.rank == 0 and self.verbose:
+                print(" - Receiver graph has cycles, cumulative flow will use matrix iteration")
+            return
+
+        src = np.broadcast_to(nodes, receivers.shape)[active]
+        dst = receivers[active]
+        wts = weights[active]
+
+        order = np.argsort(level[src], kind="stable")
+        src, dst, wts = src[order], dst[order], wts[order]
+
+        self._flow_edges = (src, dst, wts)
+        self._flow_edge_index = np.flatnonzero(active)[order]
+        self._flow_edge_ptr = np.searchsorted(level[src], np.arange(0, nlevels+1))
+
+        return
+
+
+    def build_cumulative_downhill_matrix(self, drop_tolerance=1.0e-12, max_memory=1.0e9, max_its=64):
+        """
+        Build the cumulative downhill matrix (self.downhillCumulativeMat)
 
         downhillCumulativeMat = I + D + D**2 + D**3 + ... D**N where N is the length of the graph
 
+        so that cumulative_flow(method="matrix") is a single matrix-vector product.
+        The sum is formed by repeated squaring, S <- S + P S and P <- P P starting from
+        S = I and P = D, which needs about log2(N) matrix products. Entries smaller
+        than drop_tolerance are dropped after each product.
+
+        This may be expensive in terms of storage. Before each product the number of
+        nonzeros is projected (from the sparsity patterns and the growth in the previous
+        squaring) and a MemoryError is raised if the matrices would need more than
+        max_memory bytes. The actual size is checked again after each product.
+        The number of nonzeros, the fill-in relative to I + D and the number of
+        squarings are stored in self.timings['cumulative downhill matrix fill'].
+        The matrix is discarded whenever the topography changes.
         """
 
-        comm = self.dm.comm
+        t = perf_counter()
 
-        downSweepMat    = self.accumulatorMat.copy()
-        downHillaccuMat = self.downhillMat.copy()
-        accuM           = self.downhillMat.copy()   # work matrix
+        if self.downhillCumulativeMat is not None:
+            self.downhillCumulativeMat.destroy()
+            self.downhillCumulativeMat = None
 
-        DX0 = self._DX0
-        DX1 = self._DX1
-        dDX = self._dDX
-        DX0.set(1.0)
+        bytes_per_nonzero = np.dtype(PETSc.ScalarType).itemsize + np.dtype(PETSc.IntType).itemsize
+
+        gstart, gend = self.gvec.getOwnershipRange()
+        nrows = gend - gstart
+
+        indptr = np.arange(0, nrows+1, dtype=PETSc.IntType)
+        columns = np.arange(gstart, gend, dtype=PETSc.IntType)
+        S = PETSc.Mat().createAIJ(self.downhillMat.getSizes(), csr=(indptr, columns, np.ones(nrows)), comm=self.dm.comm)
+        S_rows = np.ones(nrows)
+
+        P, P_rows, P_pattern = self._drop_matrix_entries(self.downhillMat, drop_tolerance, pattern=True)
+
+        nnz_D = P.getInfo()['nz_used']
+
+        row_count = self.gvec.duplicate()
+        nnz_bound = self.gvec.duplicate()
+
+        nnz_S0 = None
+        nnz_P0 = None
+
+        for its in range(0, max_its):
+
+            nnz_S = S.getInfo()['nz_used']
+            nnz_P = P.getInfo()['nz_used']
+
+            memory = bytes_per_nonzero * (nnz_S + nnz_P)
+
+            if nnz_P == 0 or memory > max_memory:
+                break
+
+            # An upper bound on the nonzeros of P S and P P (counting every path), which
+            # is exact for a single receiver and reduced to the last growth rate otherwise
+
+            row_count.setArray(S_rows)
+            P_pattern.mult(row_count, nnz_bound)
+            nnz_S1 = nnz_S + nnz_bound.sum()
+
+            row_count.setArray(P_rows)
+            P_pattern.mult(row_count, nnz_bound)
+            nnz_P1 = nnz_bound.sum()
+
+            if nnz_S0 is not None:
+                nnz_S1 = min(nnz_S1, nnz_S * nnz_S / nnz_S0)
+                nnz_P1 = min(nnz_P1, nnz_P * nnz_P / nnz_P0)
+
+            memory = bytes_per_nonzero * (nnz_S + nnz_P + 2*nnz_S1 + nnz_P1)
+
+            if memory > max_memory:
+                break
+
+            nnz_S0 = nnz_S
+            nnz_P0 = nnz_P
+
+            PS = P.matMult(S)
+            PS.axpy(1.0, S, structure=PETSc.Mat.Structure.DIFFERENT_NONZERO_PATTERN)
+            S.destroy()
+            S, S_rows = self._drop_matrix_entries(PS, drop_tolerance)
+            PS.destroy()
+
+            PP = P.matMult(P)
+            for matrix in (P, P_pattern):
+                matrix.destroy()
+            P, P_rows, P_pattern = self._drop_matrix_entries(PP, drop_tolerance, pattern=True)
+            PP.destroy()
+
+        else:
+            for matrix in (S, P, P_pattern):
+                matrix.destroy()
+            raise RuntimeError("Cumulative downhill matrix did not converge in {} squarings (does the receiver graph have cycles ?)".format(max_its))
+
+        for matrix in (P, P_pattern):
+            matrix.destroy()
+
+        if nnz_P > 0:
+            S.destroy()
+            raise MemoryError("Cumulative downhill matrix needs about {:.3g} bytes after {} squarings (max_memory={:.3g})".format(
+                               memory, its, max_memory))
+
+        self.downhillCumulativeMat = S
+
+        nnz = S.getInfo()['nz_used']
+        fill = nnz / (self.downhillMat.getSize()[0] + nnz_D)
+
+        self.timings['cumulative downhill matrix'] = [perf_counter()-t, self.log.getCPUTime(), self.log.getFlops()]
+        self.timings['cumulative downhill matrix fill'] = [nnz, fill, its]
+
+        if self.rank==0 and self.verbose:
+            print("{} - Build cumulative downhill matrix: {} nonzeros, fill {:.3g} x (I + D), {} squarings ({}s)".format(
+                   self.dm.comm.rank, int(nnz), fill, its, perf_counter()-t))
+
+        return
+
+
+    def _drop_matrix_entries(self, matrix, tolerance, pattern=False):
+        """
+        Copy of an AIJ matrix without the entries smaller than tolerance (absolute value)
+        and the number of entries in each local row. If pattern, also a matrix with the
+        same nonzero structure and all entries equal to one.
+        """
+
+        indptr, indices, values = matrix.getValuesCSR()
+
+        rows = np.repeat(np.arange(0, len(indptr)-1), np.diff(indptr))
+        keep = np.abs(values) > tolerance
+
+        row_nnz = np.bincount(rows[keep], minlength=len(indptr)-1)
+        indptr = np.hstack(([0], np.cumsum(row_nnz))).astype(PETSc.IntType)
+        indices = indices[keep]
+
+        filtered = PETSc.Mat().createAIJ(matrix.getSizes(), csr=(indptr, indices, values[keep]), comm=matrix.comm)
+
+        if not pattern:
+            return filtered, row_nnz.astype(float)
+
+        ones = PETSc.Mat().createAIJ(matrix.getSizes(), csr=(indptr, indices, np.ones(indices.size)), comm=matrix.comm)
+
+        return filtered, row_nnz.astype(float), ones
+
+
+    def _cumulative_flow_matrix(self, vector, uphill=False):
+        """
+        Cumulative flow as a single product with the cumulative downhill matrix
+        (or its transpose if uphill), which is built if necessary.
+        """
+
+        if self.downhillCumulativeMat is None:
+            self.build_cumulative_downhill_matrix()
+
+        self.lvec.setArray(vector)
+        self.dm.localToGlobal(self.lvec, self._DX0, addv=PETSc.InsertMode.INSERT_VALUES)
+
+        if uphill:
+            self.downhillCumulativeMat.multTranspose(self._DX0, self._DX1)
+        else:
+            self.downhillCumulativeMat.mult(self._DX0, self._DX1)
+
+        if self.dm.comm.Get_size() == 1:
+            return 1, self._DX1.array.copy()
+        else:
+            self.dm.globalToLocal(self._DX1, self.lvec)
+            return 1, self.lvec.array.copy()
+
+
+    @property
+    def flow_tree(self):
+        """
+        FlowTreeIndex of the receiver forest (down_neighbour[1]) of the whole mesh
+        in global node numbers. It is built on first use after the topography
+        has changed, by gathering the receivers of every node onto every process,
+        so it is meant for global queries (e.g. extract_stream_network). See
+        catchment_size, catchment_mask and catchment_sum for the scalable
+        queries with local nodes.
+        """
+
+        if self._flow_tree is None:
+            t = perf_counter()
+
+            greceivers = self.lgmap_col.apply(self.down_neighbour[1].astype(PETSc.IntType))
+            receivers = self._global_node_values(greceivers)
+
+            self._flow_tree = _FlowTreeIndex(receivers)
+
+            self.timings['flow tree index'] = [perf_counter()-t, self.log.getCPUTime(), self.log.getFlops()]
+
+            if self.rank==0 and self.verbose:
+                print(("{} - Build flow tree index {}s".format(self.dm.comm.rank, perf_counter()-t)))
+
+        return self._flow_tree
+
+
+    def _global_node_values(self, values):
+        """
+        Values (one per local node, or rows of a 2D array) of the whole mesh in
+        global node order on every process. This is a collective operation.
+        """
+
+        comm = MPI.COMM_WORLD
+
+        values = np.asarray(values)
+
+        nodes = np.arange(0, self.npoints, dtype=PETSc.IntType)
+        gnodes = self.lgmap_row.apply(nodes)
+        gstart, gend = self.gvec.getOwnershipRange()
+        owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+        global_values = np.empty((self.gvec.getSize(),) + values.shape[1:], dtype=values.dtype)
+        for gnodes_p, values_p in comm.allgather((gnodes[owned], values[owned])):
+            global_values[gnodes_p] = values_p
+
+        return global_values
+
+
+    def catchment_size(self, nodes):
+        """
+        Number of nodes in the whole mesh that drain through each of the (local)
+        nodes. This is a collective operation.
+        """
+
+        return np.rint(self.catchment_sum(np.ones(self.npoints), nodes)).astype(int)
+
+
+    def catchment_mask(self, nodes):
+        """
+        Boolean array that is True for the local nodes draining through any of
+        the (local) nodes given on any process. This is a collective operation.
+
+        The nodes are marked and the marks are carried up the steepest flow paths
+        (down_neighbour[1]) with an uphill scan, so only values at the partition
+        boundaries are exchanged between processes.
+        """
+
+        marked = np.zeros(self.npoints)
+        marked[np.asarray(nodes, dtype=int)] = 1.0
+
+        # a node may be given by a process that only holds it as a shadow
+        marked = self.sync(self._reduce_to_owners(marked, np.maximum))
+
+        mask = self.flow_scan(marked, operator="max", uphill=True, weighted=self._flow_edge_steepest())
+
+        return mask > 0.0
+
+
+    def catchment_sum(self, values, nodes):
+        """
+        Sum of the values (one per local node) over the catchment of each of
+        the (local) nodes, following the steepest flow paths (down_neighbour[1]).
+        This is a collective operation (a downhill flow_scan, which exchanges
+        only the values at the partition boundaries).
+        """
+
+        total = self.flow_scan(values, operator="sum", weighted=self._flow_edge_steepest())
+
+        return total[np.asarray(nodes, dtype=int)]
+
+
+    def upstream_integral_fn(self, meshVar, method=None):
+        """Upsream integral implemented as an area-weighted upstream summation
+        (method is passed to cumulative_flow)"""
+
+        import quagmire
+
+        def integral_fn(input=None, **kwargs):
+            node_values = meshVar.evaluate(self) * self.area
+            node_integral = self.cumulative_flow(node_values, method=method)
+
+            if input is not None:
+                if isinstance(input, (quagmire.mesh.trimesh.TriMesh, 
+                                      quagmire.mesh.pixmesh.PixMesh,
+                                      quagmire.mesh.strimesh.sTriMesh)):
+                    if input == self:
+                        return node_integral
+                    else:
+                        return self.interpolate(input.coords[:,0], input.coords[:,1], zdata=node_integral)
+
+                elif isinstance(input, (tuple, list, np.ndarray)):
+                    input = np.array(input)
+                    input = np.reshape(input, (-1, 2))
+                    return self.interpolate(input[:,0], input[:,1], zdata=node_integral)
+            else:
+                return node_integral
+
+        newLazyFn = _MeshFunction(name="int", mesh=self)
+        newLazyFn.evaluate = integral_fn
+        newLazyFn.description = "UpInt({})dA".format(meshVar.description)
+        newLazyFn.latex = r"\int {}".format(meshVar.latex) + r" \mathrm{dA}"
+        newLazyFn.exposed_operator = "I"
+
+        # the downhill matrices change with the topography
+        newLazyFn._depends_on = (meshVar, self.topography)
+        return newLazyFn
+
+
+    def cumulative_flow(self, vector, *args, **kwargs):
+        """
+        Accumulate the values in vector downhill (or uphill with uphill=True).
+
+        method="sweep" (the default, see self.cumulative_flow_method) makes a single
+        ordered pass over the receiver graph. method="iterate" repeatedly applies the
+        downhill matrix until the increments fall below 1e-8 of the maximum value.
+        method="ksp" solves (I - D) x = vector with a PETSc KSP (see _cumulative_flow_ksp).
+        method="matrix" multiplies by the cumulative downhill matrix, which is built on
+        first use (see build_cumulative_downhill_matrix).
+
+        vector may also be an (npoints, k) block of k fields. The sweep carries all
+        of the fields through the receiver graph together; the matrix-based methods
+        take them one column at a time.
+        """
+
+        niter, cumulative_flow_vector = self._cumulative_flow_verbose(vector, *args, **kwargs)
+        return cumulative_flow_vector
+
+
+    _scan_operators = {"sum": np.add, "max": np.maximum, "min": np.minimum}
+
+    def flow_scan(self, vector, operator="sum", uphill=False, edge_values=None, weighted=None, maximum_its=None, verbose=False):
+        """
+        Scan values over the receiver graph in one ordered sweep (see cumulative_flow).
+
+        Downhill (the default) every node combines its own value with those
+        passed on by its donors, so the result is a reduction over the catchment
+        upstream of each node. Uphill every node combines its own value with those
+        of its receivers, so the result is a reduction along the flow paths down
+        to the outlets.
+
+        operator is "sum", "max", "min" or an associative and commutative numpy ufunc
+        (it is applied with ufunc.at). Each value passed along an edge has edge_values
+        added to it: None, "length" (the distance between the nodes) or an array with
+        one value for each edge of self._flow_edges. If weighted is True (the default
+        for "sum") it is then multiplied by the downhill weight of the edge, or by
+        weighted[i] for edge i if an array is given (see _flow_edge_steepest).
+
+        Downhill, operators other than "sum" must be idempotent (like "max") in parallel,
+        and edge_values cannot be used with a downhill sum.
+        """
+
+        ufunc = self._scan_operators.get(operator, operator)
+
+        if not isinstance(ufunc, np.ufunc):
+            raise ValueError("Unknown scan operator {} - use 'sum', 'max', 'min' or a numpy ufunc".format(operator))
+
+        if weighted is None:
+            weighted = ufunc is np.add
+        elif not isinstance(weighted, bool):
+            weighted = np.asarray(weighted, dtype=float)
+
+        if edge_values is not None and ufunc is np.add and not uphill:
+            raise ValueError("edge_values cannot be accumulated downhill with a sum")
+
+        if self._flow_edges is None:
+            raise RuntimeError("The receiver graph has cycles and cannot be scanned")
+
+        if not maximum_its:
+            maximum_its = 1000000000000
+
+        if isinstance(edge_values, str):
+            if edge_values != "length":
+                raise ValueError("Unknown edge values {} - use 'length' or an array".format(edge_values))
+            edge_values = self._flow_edge_lengths()
+
+        niter, scan = self._cumulative_flow_sweep(vector, uphill=uphill, maximum_its=maximum_its, verbose=verbose,
+                                                  ufunc=ufunc, weighted=weighted, edge_values=edge_values)
+
+        return scan
+
+
+    def _flow_edge_lengths(self):
+        """ Distance between the nodes at either end of each edge of self._flow_edges """
+
+        src, dst, wts = self._flow_edges
+        return np.linalg.norm(self.data[src] - self.data[dst], axis=1)
+
+
+    def _flow_edge_steepest(self):
+        """ True for the edges of self._flow_edges from a node to down_neighbour[1] """
+
+        return self._flow_edge_index < self.npoints
+
+
+    def upstream_maximum(self, vector):
+        """ The largest value in the catchment upstream of each node (including itself) """
+
+        return self.flow_scan(vector, operator="max")
+
+
+    def upstream_minimum(self, vector):
+        """ The smallest value in the catchment upstream of each node (including itself) """
+
+        return self.flow_scan(vector, operator="min")
+
+
+    def downstream_maximum(self, vector):
+        """ The largest value on the flow paths from each node to the outlets """
+
+        return self.flow_scan(vector, operator="max", uphill=True)
+
+
+    def downstream_minimum(self, vector):
+        """ The smallest value on the flow paths from each node to the outlets """
+
+        return self.flow_scan(vector, operator="min", uphill=True)
+
+
+    def upstream_path_length(self):
+        """ The length of the longest flow path that ends at each node """
+
+        return self.flow_scan(np.zeros(self.npoints), operator="max", edge_values="length")
+
+
+    def downstream_path_length(self):
+        """
+        The length of the flow path from each node to its outlet (averaged over
+        the downhill neighbours with the downhill weights)
+        """
+
+        return self.flow_scan(np.zeros(self.npoints), operator="sum", uphill=True, edge_values="length")
+
+
+    def downstream_integral(self, vector):
+        """
+        The integral of vector along the flow path from each node to its outlet
+        (trapezoidal rule, averaged over the downhill neighbours with the downhill
+        weights)
+        """
+
+        src, dst, wts = self._flow_edges
+        vector = np.asarray(vector)
+        edge_integral = 0.5 * (vector[src] + vector[dst]) * self._flow_edge_lengths()
+
+        return self.flow_scan(np.zeros(self.npoints), operator="sum", uphill=True, edge_values=edge_integral)
+
+
+    def flow_distance_to_outlet(self):
+        """
+        Distance along the steepest flow path (down_neighbour[1]) from each node
+        to its outlet, returned as a locked MeshVariable
+        """
+
+        steepest = self._flow_edge_steepest()
+        distance = self.flow_scan(np.zeros(self.npoints), operator="sum", uphill=True,
+                                  edge_values="length", weighted=steepest)
+
+        return self._locked_variable("L(x,y)", distance, r"L")
+
+
+    def chi(self, concavity=0.45, reference_area=1.0):
+        """
+        The chi coordinate of river profile analysis: the integral of
+        (reference_area / A)**concavity along the steepest flow path from the outlet
+        to each node, where A is the upstream area. Returned as a locked MeshVariable.
+        """
+
+        src, dst, wts = self._flow_edges
+
+        integrand = (reference_area / self.upstream_area.data)**concavity
+        edge_integral = 0.5 * (integrand[src] + integrand[dst]) * self._flow_edge_lengths()
+
+        steepest = self._flow_edge_steepest()
+        chi = self.flow_scan(np.zeros(self.npoints), operator="sum", uphill=True,
+                             edge_values=edge_integral, weighted=steepest)
+
+        return self._locked_variable("chi(x,y)", chi, r"\chi")
+
+
+    def height_above_nearest_drainage(self, drainage_area):
+        """
+        Height of each node above the first node on its steepest flow path with an
+        upstream area of at least drainage_area (or above its outlet if there is none),
+        returned as a locked MeshVariable.
+        """
+
+        src, dst, wts = self._flow_edges
+
+        nodes = np.arange(0, self.npoints)
+        height = self.topography.data
+
+        drainage = np.logical_or(self.upstream_area.data >= drainage_area, self.down_neighbour[1] == nodes)
+
+        # drainage nodes keep their own height, the others take their receiver's
+        drainage_height = np.where(drainage, height, 0.0)
+        passed = np.logical_and(self._flow_edge_steepest(), ~drainage[src])
+
+        drainage_height = self.flow_scan(drainage_height, operator="sum", uphill=True, weighted=passed)
+
+        return self._locked_variable("HAND(x,y)", height - drainage_height, r"\mathrm{HAND}")
+
+
+    def extract_stream_network(self, drainage_area):
+        """
+        StreamNetwork of the nodes of the whole mesh with an upstream area of at least
+        drainage_area, following the steepest flow path (down_neighbour[1]). The network
+        is in global node numbers and is the same on every process.
+        """
+
+        t = perf_counter()
+
+        tree = self.flow_tree
+
+        values = self._global_node_values(np.column_stack((self.coords, self.topography.data, self.upstream_area.data)))
+
+        network = _StreamNetwork(tree.receivers, tree.depth, values[:,:-2], values[:,-2], values[:,-1], drainage_area)
+
+        self.timings['stream network'] = [perf_counter()-t, self.log.getCPUTime(), self.log.getFlops()]
+
+        if self.rank==0 and self.verbose:
+            print(("{} - Extract stream network ({} segments) {}s".format(self.dm.comm.rank, network.nsegments, perf_counter()-t)))
+
+        return network
+
+
+    def _locked_variable(self, name, data, lname=None):
+        """ A new locked MeshVariable holding data """
+
+        variable = self.add_variable(name=name, lname=lname)
+        variable.data = data
+        variable.lock()
+
+        return variable
+
+
+    def flow_scan_fn(self, meshVar, operator="sum", uphill=False, edge_values=None, weighted=None):
+        """
+        Lazy function for a flow_scan of meshVar (any quagmire function) with the
+        given operator (see flow_scan)
+        """
+
+        import quagmire
+
+        def scan_fn(input=None, **kwargs):
+            node_values = meshVar.evaluate(self)
+            node_scan = self.flow_scan(node_values, operator=operator, uphill=uphill,
+                                       edge_values=edge_values, weighted=weighted)
+
+            if input is not None:
+                if isinstance(input, (quagmire.mesh.trimesh.TriMesh,
+                                      quagmire.mesh.pixmesh.PixMesh,
+                                      quagmire.mesh.strimesh.sTriMesh)):
+                    if input == self:
+                        return node_scan
+                    else:
+                        return self.interpolate(input.coords[:,0], input.coords[:,1], zdata=node_scan)
+
+                elif isinstance(input, (tuple, list, np.ndarray)):
+                    input = np.array(input)
+                    input = np.reshape(input, (-1, 2))
+                    return self.interpolate(input[:,0], input[:,1], zdata=node_scan)
+            else:
+                return node_scan
+
+        name = getattr(operator, "__name__", operator)
+        direction = "Dn" if uphill else "Up"
+
+        newLazyFn = _MeshFunction(name="scan", mesh=self)
+        newLazyFn.evaluate = scan_fn
+        newLazyFn.description = "{}Scan_{}({})".format(direction, name, meshVar.description)
+        newLazyFn.latex = r"\mathrm{{{}scan}}_{{{}}}\left({}\right)".format(direction, name, meshVar.latex)
+        newLazyFn.exposed_operator = "S"
+        newLazyFn.dependency_list |= meshVar.dependency_list
+
+        # the receiver graph changes with the topography
+        newLazyFn._depends_on = (meshVar, self.topography)
+        return newLazyFn
+
+
+    def _cumulative_flow_verbose(self, vector, verbose=False, maximum_its=None, uphill=False, method=None):
+
+        if not maximum_its:
+            maximum_its = 1000000000000
+
+        if method is None:
+            method = self.cumulative_flow_method
+
+        if method not in ("sweep", "iterate", "ksp", "matrix"):
+            raise ValueError("Unknown cumulative flow method {} - use 'sweep', 'iterate', 'ksp' or 'matrix'".format(method))
+
+        # This is what happens if the mesh topography has never been set
+        if not self.downhillMat:
+            print("No downhill matrix exists ")
+            temp_vec = self.lvec.array.copy()
+            temp_vec = 0.0
+            return 0, temp_vec
+
+        if method == "sweep" and self._flow_edges is not None:
+            return self._cumulative_flow_sweep(vector, uphill=uphill, maximum_its=maximum_its, verbose=verbose)
+
+        # The matrix-based methods take the columns of a block one at a time
+        if np.ndim(vector) == 2:
+            niter = 0
+            cumulative_flow_block = np.empty(np.shape(vector))
+            for j in range(0, cumulative_flow_block.shape[1]):
+                its, cumulative_flow_block[:,j] = self._cumulative_flow_verbose(vector[:,j], verbose=verbose,
+                                                  maximum_its=maximum_its, uphill=uphill, method=method)
+                niter = max(niter, its)
+            return niter, cumulative_flow_block
+
+        if method == "ksp":
+            return self._cumulative_flow_ksp(vector, uphill=uphill, verbose=verbose)
+
+        if method == "matrix":
+            return self._cumulative_flow_matrix(vector, uphill=uphill)
+
+
+        # downhillMat2 = self.downhillMat * self.downhillMat
+        # downhillMat4 = downhillMat2 * downhillMat2
+        # downhillMat8 = downhillMat4 * downhillMat4
+        if uphill:
+            downhillMat = self.downhillMat.copy()
+            downhillMat = downhillMat.transpose()
+        else:
+            downhillMat = self.downhillMat
+
+        DX0 = self._DX0
+        DX1 = self._DX1
+        dDX = self._dDX
+
+        self.lvec.setArray(vector)
+        self.dm.localToGlobal(self.lvec, DX0, addv=PETSc.InsertMode.INSERT_VALUES)
+
+        DX1.setArray(DX0)
+        # DX0.assemble()
+        # DX1.assemble()
+
+        niter = 0
+        equal = False
+
+        tolerance = 1e-8 * DX1.max()[1]
+
+        while not equal and niter < maximum_its:
+            dDX.setArray(DX1)
+            #dDX.assemble()
+
+            downhillMat.mult(DX1, self.gvec)
+            DX1.setArray(self.gvec)
+            DX1.assemble()
+
+            DX0 += DX1
+
+            dDX.axpy(-1.0, DX1)
+            dDX.abs()
+            max_dDX = dDX.max()[1]
+
+            equal = max_dDX < tolerance
+
+            if self.dm.comm.rank==0 and verbose and niter%10 == 0:
+                print("{}: Max Delta - {} ".format(niter, max_dDX))
+
+            niter += 1
+
+        if self.dm.comm.Get_size() == 1:
+            return niter, DX0.array.copy()
+        else:
+            self.dm.globalToLocal(DX0, self.lvec)
+            return niter, self.lvec.array.copy()
+
+
+    def _flow_sweep(self, vector, uphill=False, ufunc=np.add, weighted=True, edge_values=None):
+        """
+        One pass through the levels of the receiver graph on the local domain.
+        Downhill, each level pushes its accumulated value to its receivers;
+        uphill, each level pulls from its (already complete) receivers.
+        vector may be a single field or an (npoints, k) block of fields.
+
+        Values are combined with ufunc (np.add by default). Each value passed along
+        an edge has edge_values (one per edge of self._flow_edges) added to it and
+        is then multiplied by the edge weight if weighted is True (or by the given
+        edge weights if weighted is an array).
+        """
+
+        src, dst, wts = self._flow_edges
+        ptr = self._flow_edge_ptr
+
+        acc = np.empty((self.npoints,) + np.shape(vector)[1:])
+        acc[...] = vector
+
+        shape = (-1,) + (1,)*(acc.ndim-1)
+        if weighted is True:
+            weighted = wts
+        if weighted is not False:
+            weighted = np.reshape(weighted, shape)
+        if edge_values is not None:
+            edge_values = np.reshape(edge_values, shape)
+
+        if not uphill:
+            levels, source, target = range(0, ptr.size-1), src, dst
+        else:
+            levels, source, target = range(ptr.size-2, -1, -1), dst, src
+
+        for l in levels:
+            s = slice(ptr[l], ptr[l+1])
+            passed = acc[source[s]]
+            if edge_values is not None:
+                passed = passed + edge_values[s]
+            if weighted is not False:
+                passed = weighted[s] * passed
+            ufunc.at(acc, target[s], passed)
+
+        return acc
+
+
+    def _sync_columns(self, block):
+        """ sync each column of an (npoints, k) block (or a single field) """
+
+        columns = block.reshape(self.npoints, -1)
+        for j in range(0, columns.shape[1]):
+            columns[:,j] = self.sync(columns[:,j].copy())
+
+        return block
+
+
+    def _cumulative_flow_sweep(self, vector, uphill=False, maximum_its=1000000000000, verbose=False, **scan):
+        """
+        Cumulative flow by ordered sweeps of the receiver graph. In serial this is
+        a single sweep. In parallel, flow that leaves the local domain is passed
+        to the owning process and swept again until nothing crosses a boundary.
+
+        Other scans of the receiver graph are given by the keyword arguments of
+        _flow_sweep (ufunc, weighted, edge_values). Downhill, an operator other
+        than np.add must be idempotent (like np.maximum) in parallel.
+        """
+
+        if self.dm.comm.Get_size() == 1:
+            return 1, self._flow_sweep(vector, uphill=uphill, **scan)
+
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+        values = np.empty((self.npoints,) + np.shape(vector)[1:])
+        values[...] = vector
+
+        owned = self._flow_owned.reshape((-1,) + (1,)*(values.ndim-1))
+        niter = 0
+
+        ufunc = scan.get("ufunc", np.add)
+
+        if not uphill and ufunc is not np.add:
+            # the owners combine what reaches their nodes on other processes
+            # with their own values and sweep again until nothing changes
+
+            values = self._sync_columns(values)
+            inputs = values.copy()
+
+            while niter < maximum_its:
+                acc = self._flow_sweep(inputs, **scan)
+                niter += 1
+
+                arriving = self._reduce_to_owners(acc, ufunc)
+                new_inputs = ufunc(inputs, arriving)
+
+                local_change = np.array(float(np.count_nonzero(new_inputs[self._flow_owned] != inputs[self._flow_owned])))
+                global_change = np.array(0.0)
+                comm.Allreduce([local_change, MPI.DOUBLE], [global_change, MPI.DOUBLE], op=MPI.SUM)
+
+                if self.dm.comm.rank==0 and verbose:
+                    print("{}: Nodes changed at boundaries - {} ".format(niter, global_change))
+
+                if global_change == 0.0:
+                    break
+
+                inputs = new_inputs
+
+            return niter, self._sync_columns(acc)
+
+        if not uphill:
+            source = np.where(owned, values, 0.0)
+            cumulative_flow_vector = np.zeros_like(values)
+
+            while niter < maximum_its:
+                acc = self._flow_sweep(source, **scan)
+                cumulative_flow_vector += np.where(owned, acc, 0.0)
+                niter += 1
+
+                # flow collected at the shadow nodes is added to the owners
+                outflow = np.where(owned, 0.0, acc).reshape(self.npoints, -1)
+                inflow = np.empty_like(outflow)
+                max_crossing = 0.0
+
+                for j in range(0, outflow.shape[1]):
+                    self.gvec.set(0.0)
+                    self.lvec.setArray(outflow[:,j])
+                    self.dm.localToGlobal(self.lvec, self.gvec, addv=PETSc.InsertMode.ADD_VALUES)
+                    max_crossing = max(max_crossing, self.gvec.norm(PETSc.NormType.NORM_INFINITY))
+                    self.dm.globalToLocal(self.gvec, self.lvec)
+                    inflow[:,j] = self.lvec.array
+
+                if self.dm.comm.rank==0 and verbose:
+                    print("{}: Max boundary flux - {} ".format(niter, max_crossing))
+
+                if max_crossing == 0.0:
+                    break
+
+                source = np.where(owned, inflow.reshape(values.shape), 0.0)
+
+            return niter, self._sync_columns(cumulative_flow_vector)
+
+        else:
+            cumulative_flow_vector = values.copy()
+
+            while niter < maximum_its:
+                # shadow values are held fixed while the owned nodes are swept
+                acc = self._flow_sweep(np.where(owned, values, cumulative_flow_vector), uphill=True, **scan)
+                acc = self._sync_columns(acc)
+                niter += 1
+
+                local_change = np.array(np.abs(acc - cumulative_flow_vector)[~self._flow_owned].max(initial=0.0))
+                global_change = np.array(0.0)
+                comm.Allreduce([local_change, MPI.DOUBLE], [global_change, MPI.DOUBLE], op=MPI.MAX)
+
+                cumulative_flow_vector = acc
 
-        err = np.array([True])
-        err_proc = np.ones(comm.size, dtype=bool)
+                if self.dm.comm.rank==0 and verbose:
+                    print("{}: Max boundary change - {} ".format(niter, global_change))
 
-        while err_proc.any():
-            downSweepMat    = downSweepMat*self.accumulatorMat  # N applications of the accumulator
-            accuM           = accuM*self.downhillMat
-            downHillaccuMat = downHillaccuMat + accuM
-            DX0 = self.downhillMat*DX1
+                if global_change == 0.0:
+                    break
 
-            err[0] = np.any(DX0)
-            comm.Allgather([err, MPI.BOOL], [err_proc, MPI.BOOL])
+            return niter, cumulative_flow_vector
 
-        # add identity matrix
-        I = np.arange(0, self.npoints+1, dtype=PETSc.IntType)
-        J = np.arange(0, self.npoints, dtype=PETSc.IntType)
-        V = np.ones(self.npoints)
-        identityMat = self._adjacency_matrix_template()
-        identityMat.assemblyBegin()
-        identityMat.setValuesLocalCSR(I, J, V)
-        identityMat.assemblyEnd()
 
-        downHillaccuMat += identityMat
+    def _reduce_to_owners(self, values, ufunc):
+        """
+        Combine the values at shadow nodes into the values of the owned nodes with
+        ufunc. Returns a copy of values (one per node, or an (npoints, k) block)
+        with the owned nodes updated.
+        """
 
-        self.downhillCumulativeMat = downHillaccuMat
-        self.sweepDownToOutflowMat = downSweepMat
+        comm = MPI.COMM_WORLD
 
+        if self._shadow_exchange is None:
+            nodes = np.arange(0, self.npoints, dtype=PETSc.IntType)
+            gnodes = self.lgmap_row.apply(nodes)
+            gstart, gend = self.gvec.getOwnershipRange()
+            shadow = np.logical_or(gnodes < gstart, gnodes >= gend)
 
-    def upstream_integral_fn(self, meshVar):
-        """Upsream integral implemented as an area-weighted upstream summation"""
+            # local positions of the owned global nodes
+            position = np.full(gend-gstart, -1, dtype=PETSc.IntType)
+            position[gnodes[~shadow]-gstart] = nodes[~shadow]
 
-        import quagmire
+            ranges = self.gvec.getOwnershipRanges()
+            owner = np.searchsorted(ranges, gnodes[shadow], side="right") - 1
 
-        def integral_fn(input=None, **kwargs):
-            node_values = meshVar.evaluate(self) * self.area
-            node_integral = self.cumulative_flow(node_values)
+            send = [nodes[shadow][owner == p] for p in range(0, comm.size)]
+            asked = comm.alltoall([gnodes[n] for n in send])
+            receive = [position[g-gstart] for g in asked]
 
-            if input is not None:
-                if isinstance(input, (quagmire.mesh.trimesh.TriMesh, 
-                                      quagmire.mesh.pixmesh.PixMesh,
-                                      quagmire.mesh.strimesh.sTriMesh)):
-                    if input == self:
-                        return node_integral
-                    else:
-                        return self.interpolate(input.coords[:,0], input.coords[:,1], zdata=node_integral)
+            self._shadow_exchange = (send, receive)
 
-                elif isinstance(input, (tuple, list, np.ndarray)):
-                    input = np.array(input)
-                    input = np.reshape(input, (-1, 2))
-                    return self.interpolate(input[:,0], input[:,1], zdata=node_integral)
-            else:
-                return node_integral
+        send, receive = self._shadow_exchange
 
-        newLazyFn = _MeshFunction(name="int", mesh=self)
-        newLazyFn.evaluate = integral_fn
-        newLazyFn.description = "UpInt({})dA".format(meshVar.description)
-        newLazyFn.latex = r"\int {}".format(meshVar.latex) + r" \mathrm{dA}"
-        newLazyFn.exposed_operator = "I"
-        return newLazyFn
+        arrived = comm.alltoall([values[n] for n in send])
 
+        result = np.array(values, dtype=float)
+        for nodes, shadow_values in zip(receive, arrived):
+            ufunc.at(result, nodes, shadow_values)
 
-    def cumulative_flow(self, vector, *args, **kwargs):
+        return result
 
-        niter, cumulative_flow_vector = self._cumulative_flow_verbose(vector, *args, **kwargs)
-        return cumulative_flow_vector
 
+    def _build_cumulative_flow_ksp(self):
+        """
+        Set up a KSP for the operator (I - D) where D is the downhill matrix.
+
+        The defaults are GMRES preconditioned by block Jacobi with an exact (LU)
+        solve on each block. D is acyclic, so each local block is a permuted
+        triangular matrix and is factored without difficulty. In serial this is
+        a direct solve; in parallel the iteration count depends on the number of
+        partition boundaries that the flow crosses, not on the length of the flow
+        paths. Options can be changed with the "cumulative_flow_" prefix, e.g.
+        -cumulative_flow_pc_type ilu
+        """
 
-    def _cumulative_flow_verbose(self, vector, verbose=False, maximum_its=None, uphill=False):
+        flowMat = self.downhillMat.copy()
+        flowMat.setOption(PETSc.Mat.Option.NEW_NONZERO_ALLOCATION_ERR, False)
+        flowMat.scale(-1.0)
+        flowMat.shift(1.0)
 
-        if not maximum_its:
-            maximum_its = 1000000000000
+        ksp = PETSc.KSP().create(comm=self.dm.comm)
+        ksp.setOptionsPrefix("cumulative_flow_")
+        ksp.setOperators(flowMat)
+        ksp.setType("gmres")
+        ksp.getPC().setType("bjacobi")
+        ksp.setTolerances(rtol=1.0e-10)
+        ksp.setFromOptions()
+        ksp.setUp()
 
-        # This is what happens if the mesh topography has never been set
-        if not self.downhillMat:
-            print("No downhill matrix exists ")
-            temp_vec = self.lvec.array.copy()
-            temp_vec = 0.0
-            return 0, temp_vec
+        # exact solves on the blocks unless the user has chosen a sub_pc_type
 
+        pc = ksp.getPC()
+        if pc.getType() == "bjacobi" and not PETSc.Options("cumulative_flow_").hasName("sub_pc_type"):
+            for sub_ksp in pc.getBJacobiSubKSP():
+                sub_ksp.getPC().setType("lu")
 
-        # downhillMat2 = self.downhillMat * self.downhillMat
-        # downhillMat4 = downhillMat2 * downhillMat2
-        # downhillMat8 = downhillMat4 * downhillMat4
-        if uphill:
-            downhillMat = self.downhillMat.copy()
-            downhillMat = downhillMat.transpose()
-        else:
-            downhillMat = self.downhillMat
+        flowMat.destroy()
 
-        DX0 = self._DX0
-        DX1 = self._DX1
-        dDX = self._dDX
+        return ksp
 
-        self.lvec.setArray(vector)
-        self.dm.localToGlobal(self.lvec, DX0, addv=PETSc.InsertMode.INSERT_VALUES)
 
-        DX1.setArray(DX0)
-        # DX0.assemble()
-        # DX1.assemble()
+    def _cumulative_flow_ksp(self, vector, uphill=False, verbose=False):
+        """
+        Cumulative flow as the solution of (I - D) x = vector, or (I - D^T) x = vector
+        if uphill. The solver is built once per downhill matrix. Timing and
+        convergence (iterations, converged reason, residual norm) are stored in
+        self.timings['cumulative flow ksp'] and self.timings['cumulative flow ksp convergence']
+        """
 
-        niter = 0
-        equal = False
+        t = perf_counter()
 
-        tolerance = 1e-8 * DX1.max()[1]
+        if self._flow_ksp is None:
+            self._flow_ksp = self._build_cumulative_flow_ksp()
 
-        while not equal and niter < maximum_its:
-            dDX.setArray(DX1)
-            #dDX.assemble()
+        ksp = self._flow_ksp
 
-            downhillMat.mult(DX1, self.gvec)
-            DX1.setArray(self.gvec)
-            DX1.assemble()
+        b = self._DX0
+        x = self._DX1
 
-            DX0 += DX1
+        self.lvec.setArray(vector)
+        self.dm.localToGlobal(self.lvec, b, addv=PETSc.InsertMode.INSERT_VALUES)
 
-            dDX.axpy(-1.0, DX1)
-            dDX.abs()
-            max_dDX = dDX.max()[1]
+        if uphill:
+            ksp.solveTranspose(b, x)
+        else:
+            ksp.solve(b, x)
 
-            equal = max_dDX < tolerance
+        niter = ksp.getIterationNumber()
+        reason = ksp.getConvergedReason()
 
-            if self.dm.comm.rank==0 and verbose and niter%10 == 0:
-                print("{}: Max Delta - {} ".format(niter, max_dDX))
+        self.timings['cumulative flow ksp'] = [perf_counter()-t, self.log.getCPUTime(), self.log.getFlops()]
+        self.timings['cumulative flow ksp convergence'] = [niter, reason, ksp.getResidualNorm()]
 
-            niter += 1
+        if self.rank==0 and (verbose or reason < 0):
+            print("{} - Cumulative flow KSP: {} iterations, reason {}, residual {} ({}s)".format(self.dm.comm.rank,
+                    niter, reason, ksp.getResidualNorm(), perf_counter()-t))
 
         if self.dm.comm.Get_size() == 1:
-            return niter, DX0.array.copy()
+            return niter, x.array.copy()
         else:
-            self.dm.globalToLocal(DX0, self.lvec)
+            self.dm.globalToLocal(x, self.lvec)
             return niter, self.lvec.array.copy()
 
 
@@ -964,6 +2147,365 @@ class TopoMesh(object):
 
 
 
+    def low_points_priority_flood_fill(self, epsilon=0.0, ref_height=0.0, its=100):
+        """
+        Remove all depressions in one pass with a priority-flood (Barnes et al., 2014):
+        the mesh is flooded inwards from the outflow boundary (and any nodes at or
+        below ref_height) in order of height, and every node is raised to at least
+        the lowest level at which it can drain.
+
+          - epsilon is a small height increment added from node to node across filled
+            areas so that they slope towards their outlet. If epsilon is zero, filled
+            areas are flat.
+          - its is the maximum number of exchanges between processes when epsilon > 0
+
+        In parallel each process floods its own nodes with the shadow nodes as
+        additional seeds. The levels at which the resulting regions spill into one
+        another (and into the outflow) are resolved on a global spill graph
+        (Barnes, 2016) and the filled heights are raised to those levels.
+        With epsilon > 0 the sloped surface depends on the path to the outlet, so the
+        shadow values are instead exchanged and the local floods repeated until
+        they no longer change (each pass can only lower the filled heights).
+        """
+
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+        t0 = perf_counter()
+
+        height = self.topography.data.copy()
+
+        nodes = np.arange(0, self.npoints, dtype=PETSc.IntType)
+        gnodes = self.lgmap_row.apply(nodes)
+        gstart, gend = self.gvec.getOwnershipRange()
+        shadow = np.logical_or(gnodes < gstart, gnodes >= gend)
+
+        outlets = np.logical_or(self.bmask == False, height <= ref_height)
+        seeds = np.where(np.logical_or(outlets, shadow))[0]
+
+        # the outflow is label 0, the regions that drain to a shadow node
+        # are labelled by its global node number + 1
+
+        seed_labels = np.where(outlets[seeds], 0, gnodes[seeds].astype(np.int64) + 1)
+
+        if comm.Get_size() == 1:
+            filled, labels, spills = self._priority_flood(height, seeds, seed_labels, epsilon)
+
+        elif epsilon > 0.0:
+            shadow_seeds = np.logical_and(shadow, ~outlets)
+
+            filled = height.copy()
+            filled[shadow_seeds] = np.inf
+
+            for p in range(0, its):
+                seed_height = np.where(shadow_seeds, filled, height)
+                new_filled, labels, spills = self._priority_flood(seed_height, seeds, seed_labels, epsilon)
+                new_filled = self.sync(new_filled)
+
+                changes = np.array(float(np.count_nonzero(new_filled != filled)))
+                comm.Allreduce(MPI.IN_PLACE, [changes, MPI.DOUBLE], op=MPI.SUM)
+
+                filled = new_filled
+
+                if changes == 0.0:
+                    break
+
+        else:
+            filled, labels, spills = self._priority_flood(height, seeds, seed_labels, 0.0)
+
+            # The region of each shadow node joins the region that its owner
+            # assigned to that node at the height the owner filled it to
+
+            owner_labels = self.sync(labels.astype(float))
+            owner_filled = self.sync(filled)
+
+            shadow_seeds = np.where(np.logical_and(shadow, ~outlets))[0]
+
+            spill_edges = np.empty((len(spills) + len(shadow_seeds), 3))
+            if len(spills):
+                spill_edges[:len(spills),0:2] = list(spills.keys())
+                spill_edges[:len(spills),2] = list(spills.values())
+            spill_edges[len(spills):,0] = gnodes[shadow_seeds] + 1
+            spill_edges[len(spills):,1] = owner_labels[shadow_seeds]
+            spill_edges[len(spills):,2] = owner_filled[shadow_seeds]
+
+            list_of_spill_edges = comm.gather(spill_edges, root=0)
+
+            if self.rank == 0:
+                spill_levels = self._spill_graph_levels(np.vstack(list_of_spill_edges))
+            else:
+                spill_levels = None
+
+            spill_levels = comm.bcast(spill_levels, root=0)
+
+            level = np.array([spill_levels.get(l, -np.inf) for l in labels.tolist()])
+            filled = self.sync(np.maximum(filled, level))
+
+        with self.deform_topography():
+            self.topography.data = filled
+
+        if self.rank==0 and self.verbose:
+            print("Low point priority flood fill ",  perf_counter()-t0, " seconds")
+
+        return
+
+
+    def low_points_breach(self, max_depth=np.inf, max_length=100, ref_height=0.0, fill=True, epsilon=0.0):
+        """
+        Drain low points by carving channels rather than raising the basins around them
+        (least-cost breaching, Lindsay 2016).
+
+        For each low point (lowest first) a Dijkstra search on the natural-neighbour graph
+        finds the path to a lower node with the least total height above the low point.
+        The nodes on the path are lowered onto a straight profile from the low point to
+        the end of the path.
+
+          - max_depth limits the height above the low point of any node on the path
+          - max_length limits the number of nodes on the path
+          - if fill, any low points that cannot be breached within these limits are
+            filled with low_points_priority_flood_fill(epsilon)
+
+        In parallel only the nodes owned by a process are carved, so a channel can end
+        at a shadow node but cannot pass through one.
+        """
+
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+        t0 = perf_counter()
+
+        height = self.topography.data.copy()
+
+        nodes = np.arange(0, self.npoints, dtype=PETSc.IntType)
+        gnodes = self.lgmap_row.apply(nodes)
+        gstart, gend = self.gvec.getOwnershipRange()
+        owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+        low_points = self.identify_low_points(include_shadows=True, ref_height=ref_height)
+        low_points = low_points[owned[low_points]]
+        low_points = low_points[np.argsort(height[low_points], kind="stable")]
+
+        breached = 0
+        for low_point in low_points.tolist():
+
+            # an earlier channel may already drain this point
+            neighbours = self.natural_neighbours[low_point,1:self.natural_neighbours_count[low_point]]
+            if (height[neighbours] < height[low_point]).any():
+                breached += 1
+                continue
+
+            path = self._breach_path(height, low_point, max_depth, max_length, owned)
+
+            if path is None:
+                continue
+
+            h0 = height[low_point]
+            h1 = height[path[-1]]
+            profile = h0 + (h1 - h0) * np.arange(0, len(path)) / (len(path) - 1)
+
+            height[path[1:-1]] = np.minimum(height[path[1:-1]], profile[1:-1])
+            breached += 1
+
+        height = self.sync(height)
+
+        with self.deform_topography():
+            self.topography.data = height
+
+        counts = np.array([breached, len(low_points)], dtype=float)
+        comm.Allreduce(MPI.IN_PLACE, [counts, MPI.DOUBLE], op=MPI.SUM)
+
+        if self.rank==0 and self.verbose:
+            print("Low point breach: {} of {} low points breached in {} seconds".format(int(counts[0]), int(counts[1]), perf_counter()-t0))
+
+        if fill and counts[0] < counts[1]:
+            self.low_points_priority_flood_fill(epsilon=epsilon, ref_height=ref_height)
+
+        return
+
+
+    def _breach_path(self, height, low_point, max_depth, max_length, passable):
+        """
+        Least-cost path (an array of nodes) from low_point to a lower node, where
+        each node on the path costs its height above the low point. Only passable nodes
+        can be on the path (but not at its end), nodes more than max_depth above the low
+        point are avoided and the path has at most max_length nodes. Returns None if there
+        is no such path.
+        """
+
+        import heapq
+
+        h0 = height[low_point]
+
+        cost = {low_point: 0.0}
+        previous = {low_point: None}
+        length = {low_point: 1}
+
+        heap = [(0.0, low_point)]
+
+        while heap:
+            node_cost, node = heapq.heappop(heap)
+
+            if node_cost > cost[node]:
+                continue
+
+            if height[node] < h0:
+                path = [node]
+                while previous[path[-1]] is not None:
+                    path.append(previous[path[-1]])
+                return np.array(path[::-1])
+
+            if not passable[node] or length[node] >= max_length:
+                continue
+
+            for neighbour in self.natural_neighbours[node,1:self.natural_neighbours_count[node]].tolist():
+                depth = height[neighbour] - h0
+
+                if depth > max_depth:
+                    continue
+
+                neighbour_cost = node_cost + max(depth, 0.0)
+
+                if neighbour_cost < cost.get(neighbour, np.inf):
+                    cost[neighbour] = neighbour_cost
+                    previous[neighbour] = node
+                    length[neighbour] = length[node] + 1
+                    heapq.heappush(heap, (neighbour_cost, neighbour))
+
+        return None
+
+
+    def _node_neighbour_lists(self):
+        """
+        List of the natural neighbours of each local node (without the node itself).
+        The neighbours of shadow nodes are taken from the owned nodes that list them.
+        """
+
+        neighbours = [row[1:count] for row, count in zip(self.natural_neighbours.tolist(), self.natural_neighbours_count.tolist())]
+
+        # The neighbours of shadow nodes are incomplete and may include nodes that are
+        # not neighbours in the global mesh, so use the owned nodes that list them instead
+
+        gnodes = self.lgmap_row.apply(np.arange(0, self.npoints, dtype=PETSc.IntType))
+        gstart, gend = self.gvec.getOwnershipRange()
+        shadow = np.logical_or(gnodes < gstart, gnodes >= gend)
+
+        if shadow.any():
+            owned_rows = np.where(~shadow)[0]
+            rows, columns = np.nonzero(self.natural_neighbours[owned_rows,1:] >= 0)
+            donors = owned_rows[rows]
+            shadow_neighbours = self.natural_neighbours[owned_rows,1:][rows, columns]
+
+            link = shadow[shadow_neighbours]
+            order = np.argsort(shadow_neighbours[link], kind="stable")
+            shadow_neighbours = shadow_neighbours[link][order]
+            donors = donors[link][order]
+
+            shadow_nodes = np.where(shadow)[0]
+            ptr = np.searchsorted(shadow_neighbours, np.hstack((shadow_nodes, [self.npoints])))
+            for i, node in enumerate(shadow_nodes.tolist()):
+                neighbours[node] = donors[ptr[i]:ptr[i+1]].tolist()
+
+        return neighbours
+
+
+    def _priority_flood(self, height, seeds, seed_labels, epsilon=0.0):
+        """
+        Priority-flood of the local nodes from the seed nodes, using a queue for nodes
+        in pits (which are processed at the current level) and a heap for the rest.
+
+        Returns the filled heights, the label of the seed that each node drains to
+        and a dictionary of the lowest spill height between each pair of labels that
+        meet, {(label_a, label_b): height}. Nodes that cannot be reached from a seed
+        keep their height and have label -1.
+        """
+
+        import heapq
+        from collections import deque
+
+        neighbours = self._node_neighbour_lists()
+
+        filled = height.tolist()
+        labels = [-1] * self.npoints
+
+        heap = []
+        for node, label in zip(seeds.tolist(), seed_labels.tolist()):
+            labels[node] = label
+            heap.append((filled[node], node))
+
+        heapq.heapify(heap)
+        pits = deque()
+        spills = dict()
+
+        while heap or pits:
+            if pits:
+                node = pits.popleft()
+            else:
+                node = heapq.heappop(heap)[1]
+
+            h = filled[node]
+            label = labels[node]
+
+            for neighbour in neighbours[node]:
+                if neighbour < 0:
+                    break
+
+                neighbour_label = labels[neighbour]
+
+                if neighbour_label == label:
+                    continue
+
+                if neighbour_label >= 0:
+                    key = (min(label, neighbour_label), max(label, neighbour_label))
+                    spill = max(h, filled[neighbour])
+                    if spills.get(key, np.inf) > spill:
+                        spills[key] = spill
+                    continue
+
+                labels[neighbour] = label
+
+                if filled[neighbour] <= h + epsilon:
+                    filled[neighbour] = h + epsilon
+                    pits.append(neighbour)
+                else:
+                    heapq.heappush(heap, (filled[neighbour], neighbour))
+
+        filled = np.array(filled)
+        filled[np.array(labels) < 0] = height[np.array(labels) < 0]
+
+        return filled, np.array(labels, dtype=np.int64), spills
+
+
+    def _spill_graph_levels(self, spill_edges):
+        """
+        Water level of each label in the spill graph given as rows of
+        (label_a, label_b, spill height): a priority-flood of the graph from
+        the outflow (label 0). Returns a dictionary {label: level}.
+        """
+
+        import heapq
+
+        graph = dict()
+        for a, b, h in spill_edges.tolist():
+            graph.setdefault(int(a), []).append((h, int(b)))
+            graph.setdefault(int(b), []).append((h, int(a)))
+
+        levels = dict()
+        heap = [(-np.inf, 0)]
+
+        while heap:
+            level, label = heapq.heappop(heap)
+            if label in levels:
+                continue
+
+            levels[label] = level
+
+            for h, neighbour in graph.get(label, []):
+                if neighbour not in levels:
+                    heapq.heappush(heap, (max(level, h), neighbour))
+
+        return levels
+
+
     def backfill_points(self, fill_points, heights, its):
         """
         Handles *selected* low points by backfilling height array.
@@ -973,35 +2515,51 @@ class TopoMesh(object):
         if len(fill_points) == 0:
             return self.heightVariable.data
 
-        new_height = self.lvec.duplicate()
-        new_height.setArray(heights)
-        height = np.maximum(self.height, new_height.array)
+        height = np.maximum(self.height, heights)
 
         # Now march the new height to all the uphill nodes of these nodes
-        # height = np.maximum(self.height, delta_height.array)
 
-        self.dm.localToGlobal(new_height, self.gvec)
-        global_dH = self.gvec.copy()
+        new_height = self.sync(np.array(heights, dtype=float))
 
         for p in range(0, its):
-            self.adjacency[1].multTranspose(global_dH, self.gvec)
-            global_dH.setArray(self.gvec)
-            global_dH.scale(1.001)  # Maybe !
-            self.dm.globalToLocal(global_dH, new_height)
+            new_height = self._receiver_values(new_height)
+            new_height *= 1.001  # Maybe !
 
-            height = np.maximum(height, new_height.array)
+            height = np.maximum(height, new_height)
 
         return height
 
-    def uphill_propagation(self, points, values, scale=1.0, its=1000, fill=-1):
+    def _receiver_values(self, values):
+        """
+        Pull values from the steepest downhill neighbour of each node back to the node
+        (zero at low points and outflow points). This moves information one step uphill
+        along the receiver graph without a matrix.
+        """
 
-        t0 = perf_counter()
+        nodes = np.arange(0, self.npoints)
+        receivers = self.down_neighbour[1]
+
+        uphill_values = values[receivers]
+        uphill_values[receivers == nodes] = 0.0
+
+        return self.sync(uphill_values)
+
+    def uphill_propagation(self, points, values, scale=1.0, its=1000, fill=-1):
+        """
+        Propagate values from the given points to all the nodes that drain through
+        them (following down_neighbour[1]). Each node takes the largest value found
+        downstream, multiplied by scale for every step, or fill if there is none.
+
+        The receiver chains on each process are followed by pointer jumping, so that
+        every node adopts its receiver's receiver, in O(log L) steps for chains of
+        length L. Only the values of the shadow nodes are then exchanged between
+        processes, for at most its rounds.
+        """
 
-        local_ID = self.lvec.copy()
-        global_ID = self.gvec.copy()
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
 
-        local_ID.set(fill+1)
-        global_ID.set(fill+1)
+        t0 = perf_counter()
 
         identifier = np.empty_like(self.topography.data)
         identifier.fill(fill+1)
@@ -1009,50 +2567,105 @@ class TopoMesh(object):
         if len(points):
             identifier[points] = values + 1
 
-        local_ID.setArray(identifier)
-        self.dm.localToGlobal(local_ID, global_ID)
+        identifier = self.sync(identifier)
 
-        delta = global_ID.copy()
-        delta.abs()
-        rtolerance = delta.max()[1] * 1.0e-10
+        value, exit_node, exit_steps = self._receiver_chain_maximum(identifier, scale)
 
-        uphill_matrix = self.uphill[1]
-        gvec  = self.gvec
-        delta = gvec.duplicate()
+        # chains that continue on another process take the value of the shadow
+        # node they reach from its owner
 
-        for p in range(0, its):
+        through = np.where(exit_node >= 0)[0]
+        scale_through = float(scale)**exit_steps[through]
 
-            # self.adjacency[1].multTranspose(global_ID, self.gvec)
-            uphill_matrix.mult(global_ID, gvec)
-            # delta = global_ID - gvec
-            delta.setArray(gvec)
-            delta.axpy(-1.0, global_ID)
-            delta.abs()
-            max_delta = delta.max()[1]
+        ID = value.copy()
+        changes = np.array(0.0)
 
-            if max_delta < rtolerance:
-                break
+        for p in range(0, its if comm.Get_size() > 1 else 0):
 
-            if scale != 1.0:
-                gvec.scale(scale)
+            shadow_ID = self.sync(ID)
 
-            if self.dm.comm.Get_size() == 1:
-                local_ID.setArray(gvec)
-            else:
-                self.dm.globalToLocal(gvec, local_ID)
+            new_ID = value.copy()
+            new_ID[through] = np.maximum(value[through], scale_through * shadow_ID[exit_node[through]])
 
-            global_ID.setArray(gvec)
+            changes.fill(np.count_nonzero(new_ID != ID))
+            comm.Allreduce(MPI.IN_PLACE, [changes, MPI.DOUBLE], op=MPI.SUM)
 
-            identifier = np.maximum(identifier, local_ID.array)
-            identifier = self.sync(identifier)
+            ID = new_ID
+
+            if changes == 0:
+                break
 
         # Note, the -1 is used to identify out of bounds values
 
         if self.rank == 0 and self.verbose:
-            print(p, " iterations, time = ", perf_counter() - t0)
+            print("Uphill propagation, time = ", perf_counter() - t0)
+
+        return ID - 1
+
+
+    def _receiver_chain_maximum(self, values, scale=1.0):
+        """
+        Pointer jumping along the receivers (down_neighbour[1]) of the owned nodes.
+
+        Returns the largest of the values (multiplied by scale for every step)
+        on the chain from each node to a sink, counting 0 beyond the sink, or to the
+        first shadow node, excluding it. Also returns that shadow node (or -1) and
+        the number of steps to it. Shadow nodes end at themselves after 0 steps.
+
+        Every chain without a cycle ends within log2(npoints) jumps. A chain that
+        enters a cycle in the receivers never ends; it takes the largest value on
+        the nodes it reaches (including the whole cycle) and has no shadow node.
+        """
+
+        npoints = self.npoints
+        nodes = np.arange(0, npoints)
+
+        gnodes = self.lgmap_row.apply(nodes.astype(PETSc.IntType))
+        gstart, gend = self.gvec.getOwnershipRange()
+        shadow = np.logical_or(gnodes < gstart, gnodes >= gend)
+
+        # two extra nodes: beyond a sink (value 0) and the end of every chain (no value)
+        beyond_sink, end = npoints, npoints+1
+
+        pointer = np.empty(npoints+2, dtype=int)
+        pointer[:npoints] = self.down_neighbour[1]
+        pointer[:npoints][pointer[:npoints] == nodes] = beyond_sink
+        pointer[:npoints][shadow] = end
+        pointer[npoints:] = end
+
+        value = np.empty(npoints+2)
+        value[:npoints] = values
+        value[:npoints][shadow] = -np.inf
+        value[npoints:] = 0.0, -np.inf
+
+        steps = np.ones(npoints+2)
+
+        exit_node = np.full(npoints+2, -1)
+        exit_node[:npoints][shadow] = nodes[shadow]
+        exit_steps = np.zeros(npoints+2)
+
+        active = np.where(pointer != end)[0]
+
+        # after this many jumps the remaining active nodes drain into a cycle
+        max_jumps = int(np.ceil(np.log2(npoints+2))) + 1
+
+        for p in range(0, max_jumps):
+            if not len(active):
+                break
+
+            jump = pointer[active]
+
+            reached = np.logical_and(exit_node[active] < 0, exit_node[jump] >= 0)
+            exit_node[active[reached]] = exit_node[jump[reached]]
+            exit_steps[active[reached]] = steps[active[reached]] + exit_steps[jump[reached]]
+
+            value[active] = np.maximum(value[active], float(scale)**steps[active] * value[jump])
+            steps[active] += steps[jump]
+            pointer[active] = pointer[jump]
 
-        return identifier - 1
+            active = active[pointer[active] != end]
 
+        return value[:npoints], exit_node[:npoints], exit_steps[:npoints]
 
 
     def identify_low_points(self, include_shadows=False, ref_height=0):
@@ -0,0 +1,376 @@
+import pytest
+import numpy as np
+import quagmire
+from quagmire import function as fn
+from quagmire import QuagMesh
+from quagmire.equation_systems import DiffusionEquation
+from quagmire.equation_systems import ErosionDepositionEquation
+from quagmire.equation_systems import LandscapeEvolution
+
+from conftest import load_triangulated_mesh_DM
+from conftest import load_pixelated_mesh_DM
+
+
+@pytest.fixture(scope="module", params=["PixMesh", "TriMesh"])
+def DM(request, load_pixelated_mesh_DM, load_triangulated_mesh_DM):
+
+    DM_dict = {"PixMesh": load_pixelated_mesh_DM,
+               "TriMesh": load_triangulated_mesh_DM}
+
+    return DM_dict[request.param]
+
+
+def _diffusion_equation(mesh, kappa):
+    """ Diffusion with fixed values on the boundary and a gaussian initial condition """
+
+    equation = DiffusionEquation(mesh, diffusivity_fn=kappa,
+                                 dirichlet_mask=mesh.mask,
+                                 neumann_x_mask=fn.parameter(1.0),
+                                 neumann_y_mask=fn.parameter(1.0))
+
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+    phi0 = np.exp(-(x**2 + y**2))
+
+    return equation, phi0
+
+
+def test_diffusion_crank_nicolson(DM):
+    mesh = QuagMesh(DM)
+    equation, phi0 = _diffusion_equation(mesh, fn.parameter(1.0))
+
+    timestep = equation.diffusion_timestep()
+    Delta_t = 20.0 * timestep
+
+    solutions = []
+    for steps in [10, 20, 40, 640]:
+        equation.phi.data = phi0
+        equation.time_integration_implicit(Delta_t/steps, steps=steps, theta=0.5)
+        solutions.append(equation.phi.data.copy())
+
+    reference = solutions[-1]
+    errors = [np.abs(phi - reference).max() for phi in solutions[:-1]]
+
+    # second order: halving the timestep quarters the error
+    for coarse, fine in zip(errors[:-1], errors[1:]):
+        assert 3.5 < coarse / fine < 4.5, "{}: Crank-Nicolson is not second order in time {}".format(mesh.id, errors)
+
+    # and it approximates the explicit solution with small timesteps
+    equation.phi.data = phi0
+    equation.time_integration(0.1*timestep, steps=200)
+
+    err_msg = "{}: Crank-Nicolson does not match the explicit solution"
+    assert np.abs(equation.phi.data - reference).max() < 0.05 * np.abs(reference - phi0).max(), err_msg.format(mesh.id)
+
+
+def test_diffusion_implicit_operator_tracks_diffusivity(DM):
+    mesh = QuagMesh(DM)
+    kappa = fn.parameter(1.0)
+    equation, phi0 = _diffusion_equation(mesh, kappa)
+
+    timestep = equation.diffusion_timestep()
+
+    equation.phi.data = phi0
+    equation.time_integration_implicit(timestep, steps=2)
+
+    # changing the diffusivity must rebuild the assembled operator
+    kappa.value = 2.0
+    equation.phi.data = phi0
+    equation.time_integration_implicit(timestep, steps=2)
+
+    fresh_equation, phi0 = _diffusion_equation(mesh, fn.parameter(2.0))
+    fresh_equation.phi.data = phi0
+    fresh_equation.time_integration_implicit(timestep, steps=2)
+
+    err_msg = "{}: implicit diffusion used the operator of a previous diffusivity"
+    assert np.allclose(equation.phi.data, fresh_equation.phi.data), err_msg.format(mesh.id)
+
+
+def _stream_power_mesh(DM, downhill_neighbours=2):
+    """ A QuagMesh on a cone with small ridges, depressions filled """
+
+    mesh = QuagMesh(DM, downhill_neighbours=downhill_neighbours)
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    height  = 0.5 * (1.0 - 0.2*np.hypot(x, y))
+    height += 0.01 * np.sin(3.0*x) * np.cos(2.0*y)
+
+    with mesh.deform_topography():
+        mesh.topography.data = height
+
+    mesh.low_points_priority_flood_fill(epsilon=1.0e-4)
+
+    return mesh
+
+
+def test_erosion_deposition_steady_state(DM):
+    mesh = _stream_power_mesh(DM, downhill_neighbours=1)
+    equation = ErosionDepositionEquation(mesh, rainfall_fn=fn.parameter(1.0), m=0.5, n=1.0)
+
+    uplift, efficiency = 1.0e-3, 1.0e-2
+
+    with pytest.warns(RuntimeWarning):
+        its, changed = equation.solve_steady_state(uplift, efficiency=efficiency, max_its=1)
+    assert changed > 0, "{}: receivers changed but none were reported".format(mesh.id)
+
+    entries = len(mesh._function_cache)
+
+    its, changed = equation.solve_steady_state(uplift, efficiency=efficiency, max_its=100)
+    assert changed == 0, "{}: steady state not reached in {} iterations".format(mesh.id, its)
+
+    # the upstream rainfall of each iteration replaces that of the last one
+    assert len(mesh._function_cache) <= entries + 1, "{}: each iteration added cache entries".format(mesh.id)
+
+    # uplift balances the stream power erosion along the steepest paths
+    height = mesh.topography.data
+    receivers = mesh.down_neighbour[1]
+    area = mesh.upstream_integral_fn(fn.parameter(1.0)).evaluate(mesh)
+
+    free = np.logical_and(receivers != np.arange(mesh.npoints), mesh.mask.data != 0.0)
+    length = np.linalg.norm(mesh.data[free] - mesh.data[receivers[free]], axis=1)
+    slope = (height[free] - height[receivers[free]]) / length
+
+    residual = np.abs(uplift - efficiency * area[free]**0.5 * slope)
+
+    assert residual.max() < 1.0e-8 * uplift, "{}: steady state residual is {}".format(mesh.id, residual.max())
+
+
+def test_landscape_evolution_rebuilds(DM):
+    mesh = _stream_power_mesh(DM, downhill_neighbours=1)
+
+    erosion_deposition = ErosionDepositionEquation(mesh, rainfall_fn=fn.parameter(1.0), m=0.5, n=1.0)
+
+    # uplift and erosion on patches of the mesh, so that the matrices are
+    # updated incrementally
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+    efficiency = mesh.add_variable(name="efficiency")
+    efficiency.data = np.where(np.hypot(x - 2.0, y) < 0.3, 1.0e-2, 0.0)
+    uplift = mesh.add_variable(name="uplift")
+    uplift.data = np.where(np.hypot(x + 2.0, y) < 0.3, 1.0e-3, 0.0)
+
+    evolution = LandscapeEvolution(mesh, erosion_deposition=erosion_deposition,
+                                   efficiency=efficiency, uplift=uplift)
+
+    # count the rebuilds of the downhill matrices
+    rebuilds = []
+    update_height = mesh._update_height
+
+    def counted_update_height(*args, **kwargs):
+        rebuilds.append(args)
+        return update_height(*args, **kwargs)
+
+    mesh._update_height = counted_update_height
+
+    steps = 3
+    evolution.time_integration(10.0, steps=steps, erosion_substeps=4)
+
+    assert len(rebuilds) == steps, "{}: {} rebuilds of the downhill matrices in {} steps".format(mesh.id, len(rebuilds), steps)
+
+    # the matrices follow the final topography although the erosion substeps
+    # wrote it without rebuilding them
+    receivers = mesh.down_neighbour[1].copy()
+    upstream_area = mesh.upstream_area.data.copy()
+
+    mesh._update_height()
+    mesh._update_height_for_surface_flows()
+
+    err_msg = "{}: downhill matrices are stale after landscape evolution"
+    assert np.array_equal(receivers, mesh.down_neighbour[1]), err_msg.format(mesh.id)
+    assert np.allclose(upstream_area, mesh.upstream_area.data), err_msg.format(mesh.id)
+
+
+def test_erosion_rate_compiled_once(DM):
+    mesh = _stream_power_mesh(DM)
+    equation = ErosionDepositionEquation(mesh, rainfall_fn=fn.parameter(1.0), m=0.5, n=1.0)
+
+    erosion_rate_fn = equation._erosion_rate_fn(1.0e-2)
+    equation.erosion_deposition_local_equilibrium(1.0e-2)
+    equation.erosion_deposition_transport_limited_flow(1.0e-2, 1.0)
+
+    assert equation._erosion_rate_fn(1.0e-2) is erosion_rate_fn, "{}: erosion rate compiled again".format(mesh.id)
+    assert equation._erosion_rate_fn(2.0e-2) is not erosion_rate_fn, "{}: erosion rate of another efficiency reused".format(mesh.id)
+
+    # the kept function follows the topography
+    with mesh.deform_topography():
+        mesh.topography.data = 0.5 * mesh.topography.data
+
+    erosion_rate, deposition_rate = equation.erosion_deposition_local_equilibrium(1.0e-2)
+    expected = (1.0e-2 * equation.stream_power_fn()).evaluate(mesh)
+
+    assert np.allclose(erosion_rate, expected), "{}: kept erosion rate is stale".format(mesh.id)
+
+    equation.m = 0.4
+    assert equation._erosion_rate_fn(1.0e-2) is not erosion_rate_fn, "{}: erosion rate of another m reused".format(mesh.id)
+
+
+def test_implicit_stream_power(DM):
+    from quagmire.equation_systems.erosion_deposition import _implicit_stream_power_solve
+
+    mesh = _stream_power_mesh(DM, downhill_neighbours=1)
+    height0 = mesh.topography.data.copy()
+    receivers = mesh.down_neighbour[1]
+
+    Delta_t = 0.5
+
+    for n in [1.0, 1.5]:
+        equation = ErosionDepositionEquation(mesh, rainfall_fn=fn.parameter(1.0), m=0.5, n=n)
+        coefficient = equation._stream_power_coefficient(5.0e-2)
+
+        # fine explicit steps on the same receivers
+        explicit = height0.copy()
+        steps = 10000
+        for step in range(0, steps):
+            explicit -= Delta_t/steps * coefficient * np.maximum(explicit - explicit[receivers], 0.0)**n
+
+        errors = []
+        for steps in [1, 10]:
+            implicit = height0.copy()
+            for step in range(0, steps):
+                implicit = _implicit_stream_power_solve(mesh, implicit, Delta_t/steps * coefficient, n)
+            errors.append(np.abs(implicit - explicit).max())
+
+        err_msg = "{}: implicit stream power (n={}) does not match the explicit solution {}"
+        assert errors[1] < 1.0e-4, err_msg.format(mesh.id, n, errors)
+        assert errors[0] > 5.0 * errors[1], err_msg.format(mesh.id, n, errors)
+
+
+def test_stream_power_coefficient_cached(DM):
+    mesh = _stream_power_mesh(DM, downhill_neighbours=1)
+    equation = ErosionDepositionEquation(mesh, rainfall_fn=fn.parameter(1.0), m=0.5, n=1.0)
+
+    cache = mesh._function_cache
+
+    coefficient = equation._stream_power_coefficient(1.0e-2)
+    entries, hits = len(cache), cache.hits
+
+    # the upstream rainfall of the unchanged topography is reused
+    assert np.array_equal(equation._stream_power_coefficient(1.0e-2), coefficient)
+    assert len(cache) == entries, "{}: repeated coefficient added cache entries".format(mesh.id)
+    assert cache.hits > hits, "{}: repeated coefficient missed the cache".format(mesh.id)
+
+
+@pytest.mark.parametrize("method", ["RK23", "RK45"])
+def test_embedded_runge_kutta(DM, method):
+    from quagmire.equation_systems import EmbeddedRungeKutta
+
+    mesh = QuagMesh(DM)
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    # dy/dt = -decay * y with a range of decay rates
+    decay = 1.0 + 0.5 * (x**2 + y**2)
+    y0 = 1.0 + np.cos(x) * np.sin(y)
+    Delta_t = 1.0
+
+    last_rate = []
+
+    def rate(values):
+        last_rate[:] = [values.copy()]
+        return -decay * values
+
+    integrator = EmbeddedRungeKutta(mesh, method=method, rtol=1.0e-6, atol=1.0e-8)
+
+    values = y0.copy()
+    steps, rejected, elapsed_time, timestep = integrator.integrate(rate, values, Delta_t, timestep=Delta_t)
+
+    exact = y0 * np.exp(-decay * Delta_t)
+
+    assert np.isclose(elapsed_time, Delta_t), "{}: {} stopped at t = {}".format(mesh.id, method, elapsed_time)
+    assert rejected > 0, "{}: {} accepted a first step of Delta_t".format(mesh.id, method)
+    assert np.abs(values - exact).max() < 1.0e-4, "{}: {} error is {}".format(mesh.id, method, np.abs(values - exact).max())
+
+    # the state set by rate is that of the accepted solution
+    assert np.array_equal(last_rate[0], values), "{}: {} last called rate away from the solution".format(mesh.id, method)
+
+
+def test_nested_runge_kutta(DM):
+    from quagmire.equation_systems import EmbeddedRungeKutta
+
+    mesh = QuagMesh(DM)
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    decay = 1.0 + 0.5 * (x**2 + y**2)
+    y0 = 1.0 + np.cos(x) * np.sin(y)
+    Delta_t = 1.0
+
+    inner = EmbeddedRungeKutta(mesh, rtol=1.0e-3, atol=1.0e-6)
+
+    def inner_rate(values):
+        return -values
+
+    def rate(values):
+        # another adaptive solve on the same mesh within each stage
+        inner.integrate(inner_rate, np.ones(mesh.npoints), 0.1)
+        return -decay * values
+
+    outer = EmbeddedRungeKutta(mesh, rtol=1.0e-6, atol=1.0e-8)
+
+    values = y0.copy()
+    steps, rejected, elapsed_time, timestep = outer.integrate(rate, values, Delta_t, max_steps=1000)
+
+    exact = y0 * np.exp(-decay * Delta_t)
+
+    err_msg = "{}: an integrator inside the rate changed the stages of the outer one"
+    assert np.isclose(elapsed_time, Delta_t), err_msg.format(mesh.id)
+    assert np.abs(values - exact).max() < 1.0e-4, err_msg.format(mesh.id)
+
+
+def test_diffusion_adaptive(DM):
+    mesh = QuagMesh(DM)
+    equation, phi0 = _diffusion_equation(mesh, fn.parameter(1.0))
+
+    Delta_t = 5.0 * equation.diffusion_timestep()
+
+    # the adaptive steps use the rate of the explicit scheme, so the reference
+    # is the explicit solution with small steps
+    equation.phi.data = phi0
+    equation.time_integration(Delta_t / 100.0, steps=100)
+    reference = equation.phi.data.copy()
+
+    for method in ["RK23", "RK45"]:
+        equation.phi.data = phi0
+        equation._adaptive_timestep = None
+        steps, rejected, elapsed_time = equation.time_integration_adaptive(Delta_t, method=method, rtol=1.0e-5, atol=1.0e-7)
+
+        err_msg = "{}: {} does not match the explicit solution"
+        assert np.abs(equation.phi.data - reference).max() < 1.0e-3 * np.abs(reference - phi0).max(), err_msg.format(mesh.id, method)
+
+
+def test_erosion_deposition_ensemble(DM):
+    mesh = _stream_power_mesh(DM)
+    equation = ErosionDepositionEquation(mesh, rainfall_fn=fn.parameter(1.0), m=0.5, n=1.0)
+
+    efficiency = [1.0e-2, 2.0e-2, 1.0e-2]
+    m = [0.5, 0.5, 0.4]
+    n = [1.0, 1.0, 1.5]
+
+    erosion_rates, deposition_rates = equation.erosion_deposition_ensemble(efficiency, m=m, n=n)
+
+    for k in range(0, len(efficiency)):
+        equation.m = m[k]
+        equation.n = n[k]
+        erosion_rate, deposition_rate = equation.erosion_deposition_local_equilibrium(efficiency[k])
+
+        err_msg = "{}: ensemble member {} differs from a single run"
+        assert np.allclose(erosion_rates[:,k], erosion_rate), err_msg.format(mesh.id, k)
+        assert np.allclose(deposition_rates[:,k], deposition_rate), err_msg.format(mesh.id, k)
+
+
+def test_diffusion_ensemble(DM):
+    mesh = QuagMesh(DM)
+    equation, phi0 = _diffusion_equation(mesh, fn.parameter(1.0))
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    scale = [1.0, 0.5]
+    phi = np.column_stack((phi0, np.exp(-((x - 1.0)**2 + y**2))))
+    timestep = 0.2 * equation.diffusion_timestep()
+
+    ensemble = phi.copy()
+    equation.time_integration_ensemble(ensemble, timestep, steps=10, diffusivity_scale=scale)
+
+    for k in range(0, len(scale)):
+        single_equation, phi0 = _diffusion_equation(mesh, fn.parameter(scale[k]))
+
+        single = phi[:,k:k+1].copy()
+        single_equation.time_integration_ensemble(single, timestep, steps=10)
+
+        err_msg = "{}: ensemble member {} differs from a single run"
+        assert np.allclose(ensemble[:,k], single[:,0]), err_msg.format(mesh.id, k)
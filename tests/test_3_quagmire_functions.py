@@ -238,4 +238,144 @@ def test_function_gt(DM):
     func = func1 > 4.0
     assert(np.all(func.evaluate(mesh)) == False)
     func = func2 > func1
-    assert(np.all(func.evaluate(mesh)) == False)
\ No newline at end of file
+    assert(np.all(func.evaluate(mesh)) == False)
+
+
+def test_function_compile(DM):
+    mesh = QuagMesh(DM, downhill_neighbours=1)
+
+    height = mesh.add_variable(name="h(X,Y)")
+    height.data = 1.0 + mesh.coords[:,0]**2 + mesh.coords[:,1]**2
+
+    A = fn.parameter(2.0)
+    func = A * fn.math.sqrt(height) + fn.math.sin(height)**2 / (height - 0.5) - fn.misc.where(height > 1.5, A, height)
+    func_compiled = func.compile()
+
+    assert(np.allclose(func_compiled.evaluate(mesh), func.evaluate(mesh)))
+    assert(func_compiled.description == func.description)
+
+    ## parameters are inputs of the kernel
+
+    A.value = 3.0
+    assert(np.allclose(func_compiled.evaluate(mesh), func.evaluate(mesh)))
+
+    ## blocked numpy kernel with several (partial) blocks
+
+    func_numpy = func.compile(backend="numpy")
+    func_numpy._kernel.block_size = 7
+    assert(np.allclose(func_numpy.evaluate(mesh), func.evaluate(mesh)))
+    assert(np.all((height > 1.5).compile().evaluate(mesh) == (height > 1.5).evaluate(mesh)))
+
+def test_function_evaluation_context(DM):
+    mesh = QuagMesh(DM, downhill_neighbours=1)
+
+    height = mesh.add_variable(name="h(X,Y)")
+    height.data = mesh.coords[:,0]**2 + mesh.coords[:,1]
+
+    calls = []
+    derivative_grad = mesh.derivative_grad
+    mesh.derivative_grad = lambda *args, **kwargs : calls.append(1) or derivative_grad(*args, **kwargs)
+
+    ## the gradient is shared by the components and the slope
+
+    dx, dy = height.grad()
+    func = dx*dx + dy*dy - height.slope()**2
+    assert(np.allclose(func.evaluate(mesh), 0.0))
+    assert(len(calls) == 1)
+
+    height.data = height.data + 1.0
+
+    with fn.evaluation_context():
+        dx.evaluate(mesh)
+        height.slope().evaluate(mesh)
+    assert(len(calls) == 2)
+
+    ## values are not kept between evaluations
+
+    height.data = 2.0 * height.data
+    assert(np.allclose(dx.evaluate(mesh), derivative_grad(height.data)[:,0]))
+
+def test_function_cached_values(DM):
+    mesh = QuagMesh(DM, downhill_neighbours=1)
+
+    height = mesh.add_variable(name="h(X,Y)")
+    height.data = mesh.coords[:,0]**2 + mesh.coords[:,1]
+
+    A = fn.parameter(2.0)
+    func = A * height.slope() + fn.math.sin(height)
+
+    values = func.evaluate(mesh)
+    hits = mesh._function_cache.hits
+    assert(np.array_equal(func.evaluate(mesh), values))
+    assert(mesh._function_cache.hits > hits)
+
+    ## the caller owns the values it is given, the cache keeps its own
+
+    values += 1.0
+    assert(np.allclose(func.evaluate(mesh), values - 1.0))
+
+    ## new data or parameter values give new versions
+
+    version = height.version
+    height.data = 2.0 * height.data
+    assert(height.version > version)
+    assert(np.allclose(func.evaluate(mesh), A.value * height.slope().evaluate(mesh) + np.sin(height.data)))
+
+    A.value = 3.0
+    assert(np.allclose(func.evaluate(mesh), 3.0 * height.slope().evaluate(mesh) + np.sin(height.data)))
+
+    ## functions of the topography follow deform_topography
+
+    with mesh.deform_topography():
+        mesh.topography.data = height.data
+    area = mesh.upstream_integral_fn(fn.parameter(1.0)).evaluate(mesh)
+    assert(np.allclose(area, mesh.upstream_area.data))
+
+    with mesh.deform_topography():
+        mesh.topography.data = -height.data
+    area = mesh.upstream_integral_fn(fn.parameter(1.0)).evaluate(mesh)
+    assert(np.allclose(area, mesh.upstream_area.data))
+
+def test_function_evaluate_out(DM):
+    mesh = QuagMesh(DM, downhill_neighbours=1)
+
+    height = mesh.add_variable(name="h(X,Y)")
+    height.data = 1.0 + mesh.coords[:,0]**2 + mesh.coords[:,1]**2
+
+    A = fn.parameter(0.5)
+    func = height + A * fn.math.sqrt(height) / (1.0 + height**2) - fn.misc.where(height > 1.5, A, height)
+
+    out = np.empty(mesh.npoints)
+    values = func.evaluate(mesh, out=out)
+
+    assert(values is out)
+    assert(np.allclose(out, func.evaluate(mesh)))
+    assert(np.all(height.evaluate(mesh, out=np.empty(mesh.npoints)) == height.data))
+
+    ## the intermediate values are held in scratch arrays of the mesh
+
+    assert(len(mesh.scratch_buffers) > 0)
+    buffer = mesh.scratch_buffers.get()
+    assert(buffer.shape == (mesh.npoints,))
+    mesh.scratch_buffers.release(buffer)
+
+
+def test_function_evaluate_nodes(DM):
+    mesh = QuagMesh(DM, downhill_neighbours=1)
+
+    height = mesh.add_variable(name="h(X,Y)")
+    height.data = 1.0 + mesh.coords[:,0]**2 + mesh.coords[:,1]**2
+
+    A = fn.parameter(0.5)
+    func = height * fn.math.sqrt(height) + A * fn.misc.coord(0) - fn.misc.where(height > 1.5, A, height)
+    grad_fn = height.slope() + A * height.derivative(1) + fn.math.exp(height).fn_gradient(0)
+
+    nodes = np.arange(0, mesh.npoints, 7)
+
+    for f in [height, A, func, func.compile(backend="numpy"), grad_fn, mesh.upstream_area]:
+        assert(np.allclose(f.evaluate(mesh, nodes=nodes), f.evaluate(mesh)[nodes]))
+
+    ## a boolean mask of the nodes
+
+    mask = height.data > 1.5
+    assert(np.allclose(func.evaluate(mesh, nodes=mask), func.evaluate(mesh)[mask]))
@@ -158,7 +158,7 @@ def test_swamp_fill(DM):
     index = np.abs(mesh.coords - [xpt, ypt]).sum(axis=1).argmin()
     d, idx = mesh.cKDTree.query(mesh.data[index], k=30)
 
-    height[idx] = height[idx].min()
+    height[idx] = height[idx].min() - 0.2
 
     with mesh.deform_topography():
         mesh.topography.data = height
@@ -173,3 +173,484 @@ def test_swamp_fill(DM):
     slope1 = mesh.slope.evaluate(mesh)
 
     assert slope1[idx].mean() > slope0[idx].mean(), "{}: swamp fill has not filled a pit in the side of a hill".format(mesh.id)
+
+
+def _test_topography(mesh, rough=False):
+    """ The height field of the tests (with local depressions if rough) """
+
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    radius  = np.sqrt((x**2 + y**2))
+    theta   = np.arctan2(y,x) + 0.1
+
+    height  = np.exp(-0.025*(x**2 + y**2)**2) + 0.25 * (0.2*radius)**4  * np.cos(5.0*theta)**2 ## Less so
+    height  += 0.5 * (1.0-0.2*radius)
+
+    if rough:
+        height  += 0.1 * np.sin(3.0*x) * np.cos(2.0*y) + 0.5
+
+    return height
+
+
+def _topo_mesh(DM, downhill_neighbours=2, rough=False):
+    """ A QuagMesh with the test height field as its topography """
+
+    mesh = QuagMesh(DM, downhill_neighbours=downhill_neighbours)
+    height = _test_topography(mesh, rough)
+
+    with mesh.deform_topography():
+        mesh.topography.data = height
+
+    return mesh, height
+
+
+def test_cumulative_flow_sweep(DM):
+
+    for i in range(1,4):
+        mesh, height = _topo_mesh(DM, downhill_neighbours=i)
+
+        flow_sweep = mesh.cumulative_flow(mesh.pointwise_area.data, method="sweep")
+        flow_iterate = mesh.cumulative_flow(mesh.pointwise_area.data, method="iterate")
+
+        err_msg = "{}: ordered sweep does not match iterative cumulative flow ({} downhill neighbours)"
+        assert np.allclose(flow_sweep, flow_iterate, rtol=1.0e-6, atol=1.0e-6*flow_iterate.max()), err_msg.format(mesh.id, i)
+
+
+def test_cumulative_flow_ksp(DM):
+    mesh, height = _topo_mesh(DM)
+
+    rainfall = mesh.add_variable(name='rainfall')
+    rainfall.data = np.ones(mesh.npoints)
+
+    upstream_rain_ksp = mesh.upstream_integral_fn(rainfall, method="ksp").evaluate(mesh)
+    upstream_rain = mesh.upstream_integral_fn(rainfall).evaluate(mesh)
+
+    its, reason, rnorm = mesh.timings['cumulative flow ksp convergence']
+
+    assert reason > 0, "{}: cumulative flow KSP did not converge".format(mesh.id)
+    assert np.allclose(upstream_rain_ksp, upstream_rain), "{}: KSP upstream integral does not match the sweep".format(mesh.id)
+
+    # the default block solver is set on the KSP, not in the global options database
+    sub_ksp = mesh._flow_ksp.getPC().getBJacobiSubKSP()[0]
+    assert sub_ksp.getPC().getType() == "lu", "{}: cumulative flow KSP blocks are not solved exactly".format(mesh.id)
+    assert not PETSc.Options().hasName("cumulative_flow_sub_pc_type")
+
+
+def test_cumulative_flow_block(DM):
+    mesh, height = _topo_mesh(DM)
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    fields = np.column_stack([mesh.pointwise_area.data, np.ones(mesh.npoints), x**2])
+    flow_block = mesh.cumulative_flow(fields)
+
+    assert flow_block.shape == fields.shape, "{}: cumulative flow block has the wrong shape".format(mesh.id)
+
+    for j in range(0, fields.shape[1]):
+        flow_j = mesh.cumulative_flow(fields[:,j])
+        assert np.allclose(flow_block[:,j], flow_j), "{}: cumulative flow block column {} differs".format(mesh.id, j)
+
+
+def test_incremental_downhill_update(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=2)
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    # a local bump changes receivers, a tiny tilt only changes weights
+    bump = np.exp(-10.0*((x-0.5)**2 + (y-0.25)**2)) * np.sin(7.0*x)
+    bump[np.abs(bump) < 1.0e-3] = 0.0
+
+    patch = (x+0.5)**2 + (y+0.5)**2 < 0.1
+    tilt = np.where(patch, 1.0e-6*(height - 1.0), 0.0)
+
+    for dh in [0.1*bump, tilt]:
+        with mesh.deform_topography():
+            mesh.topography.data = mesh.topography.data + dh
+
+        down_neighbour = [mesh.down_neighbour[i].copy() for i in range(1, 3)]
+        flow_incremental = mesh.cumulative_flow(mesh.pointwise_area.data)
+
+        vec = mesh.gvec.duplicate()
+        mesh.lvec.setArray(flow_incremental)
+        mesh.dm.localToGlobal(mesh.lvec, vec)
+        D_incremental = mesh.downhillMat * vec
+
+        # full rebuild
+        mesh._update_height()
+
+        for i in range(1, 3):
+            assert (down_neighbour[i-1] == mesh.down_neighbour[i]).all(), "{}: incremental down_neighbour[{}] differs from full rebuild".format(mesh.id, i)
+
+        flow_full = mesh.cumulative_flow(mesh.pointwise_area.data)
+        D_full = mesh.downhillMat * vec
+
+        assert np.allclose(flow_incremental, flow_full), "{}: incremental update gives different cumulative flow".format(mesh.id)
+        assert np.allclose(D_incremental.array, D_full.array), "{}: incremental update gives a different downhill matrix".format(mesh.id)
+
+
+def test_incremental_update_after_unlocked_write(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=2)
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    bump = np.exp(-10.0*((x-0.5)**2 + (y-0.25)**2)) * np.sin(7.0*x)
+    bump[np.abs(bump) < 1.0e-3] = 0.0
+
+    # write the heights outside of deform_topography, then update with the same heights
+    mesh.topography.unlock()
+    mesh.topography.data = height + 0.1*bump
+    mesh.topography.lock()
+
+    with mesh.deform_topography():
+        mesh.topography.data = height + 0.1*bump
+
+    down_neighbour = [mesh.down_neighbour[i].copy() for i in range(1, 3)]
+    upstream_area = mesh.upstream_area.data.copy()
+
+    mesh._update_height()
+    mesh._update_height_for_surface_flows()
+
+    for i in range(1, 3):
+        assert (down_neighbour[i-1] == mesh.down_neighbour[i]).all(), "{}: down_neighbour[{}] is stale after an unlocked write".format(mesh.id, i)
+
+    assert np.allclose(upstream_area, mesh.upstream_area.data), "{}: upstream area is stale after an unlocked write".format(mesh.id)
+
+
+def test_downhill_matrix_from_receivers(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=3)
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    # downhill and uphill products built from the receiver arrays
+
+    nodes = np.arange(0, mesh.npoints)
+    values = np.cos(x) + 2.0
+    weights = mesh._downhill_matrix_weights
+
+    downhill = np.zeros(mesh.npoints)
+    uphill = np.zeros(mesh.npoints)
+    for i in range(0, 3):
+        receivers = mesh.down_neighbour[i+1]
+        flows = receivers != nodes
+        np.add.at(downhill, receivers[flows], weights[i][flows]*values[flows])
+        uphill[flows] += weights[i][flows]*values[receivers[flows]]
+
+    vec = mesh.gvec.duplicate()
+    mesh.lvec.setArray(values)
+    mesh.dm.localToGlobal(mesh.lvec, vec)
+
+    result = mesh.gvec.duplicate()
+
+    mesh.downhillMat.mult(vec, result)
+    mesh.dm.globalToLocal(result, mesh.lvec)
+    assert np.allclose(mesh.lvec.array, downhill), "{}: downhill matrix does not match receivers".format(mesh.id)
+
+    mesh.downhillMat.multTranspose(vec, result)
+    mesh.dm.globalToLocal(result, mesh.lvec)
+    assert np.allclose(mesh.lvec.array, uphill), "{}: transpose of downhill matrix does not match receivers".format(mesh.id)
+
+
+def test_cumulative_downhill_matrix(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=1)
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    with pytest.raises(MemoryError):
+        mesh.build_cumulative_downhill_matrix(max_memory=1000)
+
+    mesh.build_cumulative_downhill_matrix()
+
+    nnz, fill, its = mesh.timings['cumulative downhill matrix fill']
+    assert fill >= 1.0, "{}: cumulative downhill matrix has less fill than I + D".format(mesh.id)
+
+    for uphill in [False, True]:
+        flow_matrix = mesh.cumulative_flow(mesh.pointwise_area.data, method="matrix", uphill=uphill)
+        flow_sweep  = mesh.cumulative_flow(mesh.pointwise_area.data, method="sweep", uphill=uphill)
+
+        assert np.allclose(flow_matrix, flow_sweep), "{}: cumulative downhill matrix does not match the sweep".format(mesh.id)
+
+    # the matrix is discarded when the topography changes
+    with mesh.deform_topography():
+        mesh.topography.data = height + 0.01*x
+
+    assert mesh.downhillCumulativeMat is None, "{}: cumulative downhill matrix not discarded after deform_topography".format(mesh.id)
+
+
+def test_priority_flood_fill(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=2, rough=True)
+
+    assert len(mesh.identify_low_points()), "{}: test landscape has no low points".format(mesh.id)
+
+    # flat fill: heights only increase and the filled areas are level
+    mesh.low_points_priority_flood_fill()
+    flat_height = mesh.topography.data.copy()
+
+    assert (flat_height >= height).all(), "{}: priority flood lowered the topography".format(mesh.id)
+
+    # sloping fill: no low points remain
+    with mesh.deform_topography():
+        mesh.topography.data = height
+
+    mesh.low_points_priority_flood_fill(epsilon=1.0e-6)
+
+    assert len(mesh.identify_low_points()) == 0, "{}: priority flood with epsilon left low points".format(mesh.id)
+    assert np.allclose(mesh.topography.data, flat_height, atol=1.0e-6*mesh.npoints), "{}: priority flood fill heights depend on epsilon".format(mesh.id)
+
+
+def test_low_points_breach(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=2, rough=True)
+
+    nlows = len(mesh.identify_low_points())
+
+    # breaching only lowers the topography
+    mesh.low_points_breach(max_depth=0.05, max_length=10, fill=False)
+
+    assert (mesh.topography.data <= height).all(), "{}: breaching raised the topography".format(mesh.id)
+    assert len(mesh.identify_low_points()) < nlows, "{}: breaching did not drain any low points".format(mesh.id)
+
+    # with the fill fallback no low points remain
+    mesh.low_points_breach(max_depth=0.05, max_length=10, epsilon=1.0e-6)
+
+    assert len(mesh.identify_low_points()) == 0, "{}: breach with fill left low points".format(mesh.id)
+
+
+def test_flat_resolution(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=2, rough=True)
+
+    # a level fill leaves flats that drain across to their spill points
+    mesh.low_points_priority_flood_fill()
+
+    assert mesh._flat_increment is not None, "{}: level fill did not create any flats".format(mesh.id)
+    assert len(mesh.identify_low_points()) == 0, "{}: flats were not resolved".format(mesh.id)
+
+
+
+def test_flow_tree_index(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=1)
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    # catchment sums are the single-receiver upstream integrals
+    nodes = np.arange(0, mesh.npoints)
+    area = mesh.catchment_sum(mesh.pointwise_area.data, nodes)
+    upstream_area = mesh.cumulative_flow(mesh.pointwise_area.data)
+
+    assert np.allclose(area, upstream_area), "{}: catchment sums do not match the upstream area".format(mesh.id)
+
+    ones = np.ones(mesh.npoints)
+    assert np.allclose(mesh.catchment_size(nodes), mesh.catchment_sum(ones, nodes)), "{}: catchment sizes are inconsistent".format(mesh.id)
+
+    # the local scans agree with the intervals of the global index
+    gnodes = mesh.lgmap_col.apply(nodes.astype(PETSc.IntType))
+    assert np.array_equal(mesh.catchment_size(nodes), mesh.flow_tree.catchment_size(gnodes)), "{}: catchment sizes differ from the flow tree index".format(mesh.id)
+
+    # every node drains through one of the sinks
+    sinks = nodes[mesh.down_neighbour[1] == nodes]
+    assert mesh.catchment_mask(sinks).all(), "{}: some nodes do not drain to a sink".format(mesh.id)
+
+    # the index is rebuilt after the topography changes
+    tree = mesh.flow_tree
+
+    with mesh.deform_topography():
+        mesh.topography.data = height + 0.1*x
+
+    assert mesh.flow_tree is not tree, "{}: flow tree index was not rebuilt".format(mesh.id)
+
+    area = mesh.catchment_sum(mesh.pointwise_area.data, nodes)
+    upstream_area = mesh.cumulative_flow(mesh.pointwise_area.data)
+
+    assert np.allclose(area, upstream_area), "{}: flow tree index does not follow the new receivers".format(mesh.id)
+
+
+def test_uphill_propagation(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=1, rough=True)
+
+    # label the catchment of every sink
+    nodes = np.arange(0, mesh.npoints)
+    sinks = nodes[mesh.down_neighbour[1] == nodes]
+    gsinks = mesh.lgmap_col.apply(sinks.astype(PETSc.IntType))
+
+    catchment = mesh.uphill_propagation(sinks, gsinks, fill=-1)
+
+    assert (catchment >= 0).all(), "{}: some nodes were not labelled".format(mesh.id)
+
+    gnodes = mesh.lgmap_col.apply(nodes.astype(PETSc.IntType))
+    labelled = mesh.flow_tree.is_upstream(gnodes, catchment.astype(int))
+
+    assert labelled.all(), "{}: catchment labels do not match the flow tree".format(mesh.id)
+
+    # scaled values decay along the receiver chains
+    if mesh.downhillMat.getComm().size == 1:
+        scale = 0.9
+        fill_height = mesh.uphill_propagation(sinks, height[sinks], scale=scale, fill=0.0)
+
+        node = np.argmax(mesh.catchment_size(nodes) == 1)
+        path = [node]
+        while mesh.down_neighbour[1][path[-1]] != path[-1]:
+            path.append(mesh.down_neighbour[1][path[-1]])
+
+        weights = scale**np.arange(0, len(path))
+        values = np.where(np.isin(path, sinks), height[path] + 1.0, 1.0)
+        expected = (weights * values).max() - 1.0
+
+        assert np.isclose(fill_height[node], expected), "{}: scaled propagation is incorrect".format(mesh.id)
+
+
+def test_uphill_propagation_cycle(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=1, rough=True)
+
+    if mesh.downhillMat.getComm().size > 1:
+        return
+
+    nodes = np.arange(0, mesh.npoints)
+    sinks = nodes[mesh.down_neighbour[1] == nodes]
+    gsinks = mesh.lgmap_col.apply(sinks.astype(PETSc.IntType))
+
+    catchment = mesh.uphill_propagation(sinks, gsinks, fill=-1)
+
+    # a sink that drains back into one of its donors still labels its catchment
+    sink = sinks[np.argmax(mesh.catchment_size(sinks))]
+    donor = np.where(np.logical_and(mesh.down_neighbour[1] == sink, nodes != sink))[0][0]
+
+    receivers = mesh.down_neighbour[1]
+    mesh.down_neighbour[1] = receivers.copy()
+    mesh.down_neighbour[1][sink] = donor
+
+    try:
+        cycle_catchment = mesh.uphill_propagation(sinks, gsinks, fill=-1)
+    finally:
+        mesh.down_neighbour[1] = receivers
+
+    assert np.array_equal(cycle_catchment, catchment), "{}: propagation through a receiver cycle is incorrect".format(mesh.id)
+
+
+def test_flow_scan(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=1, rough=True)
+    x, y = mesh.coords[:,0], mesh.coords[:,1]
+
+    nodes = np.arange(0, mesh.npoints)
+    gnodes = mesh.lgmap_col.apply(nodes.astype(PETSc.IntType))
+
+    # the sum is the cumulative flow
+    area = mesh.flow_scan(mesh.pointwise_area.data, operator="sum")
+    assert np.allclose(area, mesh.cumulative_flow(mesh.pointwise_area.data)), "{}: scan sum is not the cumulative flow".format(mesh.id)
+
+    # the upstream maximum of the global node numbers is found in the catchment
+    upstream_max = mesh.upstream_maximum(gnodes.astype(float)).astype(int)
+    assert mesh.flow_tree.is_upstream(upstream_max, gnodes).all(), "{}: upstream maximum is not in the catchment".format(mesh.id)
+
+    upstream_min = mesh.upstream_minimum(gnodes.astype(float))
+    assert (upstream_min <= gnodes).all() and (upstream_max >= gnodes).all(), "{}: upstream extrema exclude the node".format(mesh.id)
+
+    # downstream maximum is the propagation of values from every node
+    values = np.abs(np.sin(x+y))
+    downstream_max = mesh.downstream_maximum(values)
+    propagated = mesh.uphill_propagation(nodes, values, fill=-1)
+    assert np.allclose(downstream_max, propagated), "{}: downstream maximum does not match uphill propagation".format(mesh.id)
+
+    # path lengths are integrals of one along the path
+    length = mesh.downstream_path_length()
+    assert np.allclose(length, mesh.downstream_integral(np.ones(mesh.npoints))), "{}: path length is not the integral of one".format(mesh.id)
+
+    gstart, gend = mesh.gvec.getOwnershipRange()
+    owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+    receivers = mesh.down_neighbour[1][owned]
+    step = np.linalg.norm(mesh.data[owned] - mesh.data[receivers], axis=1)
+    assert np.allclose(length[owned], length[receivers] + step), "{}: path lengths do not follow the receivers".format(mesh.id)
+
+    longest = mesh.upstream_path_length()
+    assert (longest[receivers] >= longest[owned] + step - 1.0e-12).all(), "{}: longest upstream paths are too short".format(mesh.id)
+
+    # lazy function wrapper
+    scan_fn = mesh.flow_scan_fn(mesh.topography, operator="max")
+    assert np.allclose(scan_fn.evaluate(mesh), mesh.upstream_maximum(mesh.topography.data)), "{}: lazy scan function is inconsistent".format(mesh.id)
+
+    # its values are cached until the topography changes
+    hits = mesh._function_cache.hits
+    scan_fn.evaluate(mesh)
+    assert mesh._function_cache.hits > hits, "{}: lazy scan function is not cached".format(mesh.id)
+
+    with mesh.deform_topography():
+        mesh.topography.data = 2.0 * height
+    assert np.allclose(scan_fn.evaluate(mesh), mesh.upstream_maximum(mesh.topography.data)), "{}: cached scan function is stale".format(mesh.id)
+
+
+def test_river_profile_metrics(DM):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=2)
+
+    gnodes = mesh.lgmap_row.apply(np.arange(0, mesh.npoints, dtype=PETSc.IntType))
+    gstart, gend = mesh.gvec.getOwnershipRange()
+    owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+    receivers = mesh.down_neighbour[1][owned]
+    step = np.linalg.norm(mesh.data[owned] - mesh.data[receivers], axis=1)
+
+    distance = mesh.flow_distance_to_outlet()
+    assert distance._locked, "{}: distance to outlet is not locked".format(mesh.id)
+    assert np.allclose(distance.data[owned], distance.data[receivers] + step), "{}: distance to outlet does not follow the steepest path".format(mesh.id)
+
+    # with no concavity chi is the distance from the outlet
+    chi = mesh.chi(concavity=0.0)
+    assert np.allclose(chi.data, distance.data), "{}: chi with zero concavity is not the flow distance".format(mesh.id)
+
+    chi = mesh.chi(concavity=0.5, reference_area=1.0)
+    area = mesh.upstream_area.data
+    increment = 0.5 * step * (area[owned]**-0.5 + area[receivers]**-0.5)
+    assert np.allclose(chi.data[owned], chi.data[receivers] + increment), "{}: chi is not integrated along the flow path".format(mesh.id)
+
+    # HAND is zero on the drainage network and the drainage height is carried upstream
+    drainage_area = np.percentile(area, 90)
+    hand = mesh.height_above_nearest_drainage(drainage_area)
+    drainage_height = height - hand.data
+
+    channel = (area >= drainage_area)[owned]
+    assert np.allclose(hand.data[owned][channel], 0.0), "{}: HAND is not zero on the drainage network".format(mesh.id)
+    assert np.allclose(drainage_height[owned][~channel], drainage_height[receivers][~channel]), "{}: HAND drainage heights do not follow the flow path".format(mesh.id)
+
+
+def test_stream_network(DM, tmp_path):
+    mesh, height = _topo_mesh(DM, downhill_neighbours=2)
+
+    # the same threshold on every process
+    from mpi4py import MPI
+    drainage_area = MPI.COMM_WORLD.allreduce(np.percentile(mesh.upstream_area.data, 80), op=MPI.MAX)
+    network = mesh.extract_stream_network(drainage_area)
+
+    nnodes = len(network.gnodes)
+    assert np.all(network.area >= drainage_area), "{}: stream network includes nodes below the drainage area".format(mesh.id)
+    assert np.array_equal(np.sort(network.node_index), np.arange(0, nnodes)), "{}: stream network segments do not cover the network nodes".format(mesh.id)
+    assert network.segment_ptr[-1] == nnodes
+
+    # every segment drains into a later one and ends at a junction or an outlet
+    drains = network.segment_receiver >= 0
+    assert np.all(network.segment_receiver[drains] > np.where(drains)[0]), "{}: stream network segments are not in flow order".format(mesh.id)
+
+    last = network.node_index[network.segment_ptr[1:]-1]
+    assert np.all(np.isin(network.receiver[last][drains], network.junctions)), "{}: stream network segments do not end at junctions".format(mesh.id)
+
+    # stream orders against a segment by segment loop
+    strahler = np.ones(network.nsegments, dtype=int)
+    shreve = np.ones(network.nsegments, dtype=int)
+    for s in range(network.nsegments):
+        donors = np.where(network.segment_receiver == s)[0]
+        if len(donors):
+            top = strahler[donors].max()
+            strahler[s] = top + 1 if np.count_nonzero(strahler[donors] == top) > 1 else top
+            shreve[s] = shreve[donors].sum()
+
+    assert np.array_equal(network.strahler, strahler), "{}: Strahler orders are incorrect".format(mesh.id)
+    assert np.array_equal(network.shreve, shreve), "{}: Shreve orders are incorrect".format(mesh.id)
+
+    heads = np.count_nonzero(np.isin(np.arange(0, network.nsegments), network.segment_receiver, invert=True))
+    assert shreve[~drains].sum() == heads, "{}: Shreve orders of the outlets do not count the channel heads".format(mesh.id)
+
+    length = network.segment_length()
+    assert np.all(length >= 0.0)
+    assert np.allclose(length.sum(), np.linalg.norm(network.coords[network.receiver >= 0] - network.coords[network.receiver[network.receiver >= 0]], axis=1).sum())
+    assert np.all(network.segment_drainage_area() >= drainage_area)
+    assert np.all(network.segment_slope() >= 0.0), "{}: stream network segments slope uphill".format(mesh.id)
+
+    # save / load round trip
+    filename = str(tmp_path / "stream_network_{}.h5".format(mesh.id))
+    network.save(filename)
+    loaded = quagmire.topomesh.StreamNetwork.load(filename)
+
+    assert np.array_equal(loaded.segment_ptr, network.segment_ptr)
+    assert np.array_equal(loaded.node_index, network.node_index)
+    assert np.array_equal(loaded.strahler, network.strahler)
+    assert np.allclose(loaded.segment_length(), length)